@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Archive codec benchmark.
+
+Builds a synthetic mod tree with every available codec and reports build
+time, archive size and install (verify + extract) time for each. Codecs
+that can't be used here (such as zstd without the zstandard module) are
+reported as skipped.
+
+    python benchmarks/bench_codecs.py [--scale N] [--json]
+"""
+
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+from golddust import build, signify
+from golddust.compression import CODECS
+from golddust.pipeline import verify_and_extract
+from golddust.pkgcache import PackageCache
+
+
+def make_mod_tree(root, scale, seed=0):
+    """Create a package tree resembling a typical mod.
+
+    A mod is mostly JARs (already-deflated class files), PNG textures
+    (incompressible) and text configs (very compressible).
+
+    Takes:
+        root (str): Directory to create the tree in.
+        scale (int): Roughly the tree size in MiB.
+        seed (int): Random seed, so runs are comparable.
+    """
+    rand = random.Random(seed)
+    game = os.path.join(root, "game")
+    for sub in ("mods", "config", "resourcepacks"):
+        os.makedirs(os.path.join(game, sub))
+    with open(os.path.join(root, build.SPEC_FILE_NAME), mode="w") as spec:
+        json.dump({"name": "benchmod", "version": "1.0"}, spec)
+
+    words = [bytes(rand.choice(b"abcdefghijklmnop") for _ in range(6))
+             for _ in range(500)]
+    for index in range(max(1, scale)):
+        jar_path = os.path.join(game, "mods", "mod{}.jar".format(index))
+        with zipfile.ZipFile(jar_path, mode="w",
+                             compression=zipfile.ZIP_DEFLATED) as jar:
+            for cls in range(40):
+                body = b" ".join(rand.choice(words) for _ in range(3000))
+                jar.writestr("com/example/C{}.class".format(cls), body)
+        with open(os.path.join(game, "resourcepacks",
+                               "tex{}.png".format(index)), mode="wb") as tex:
+            tex.write(rand.getrandbits(8 * 512 * 1024)
+                      .to_bytes(512 * 1024, "little"))
+        with open(os.path.join(game, "config",
+                               "mod{}.cfg".format(index)), mode="wb") as cfg:
+            cfg.write(b"\n".join(b"key" + rand.choice(words) + b"=true"
+                                 for _ in range(5000)))
+
+
+def run(scale):
+    """Benchmark every available codec.
+
+    Returns a list of result dicts, one per codec.
+    """
+    work = tempfile.mkdtemp()
+    results = []
+    try:
+        spec = os.path.join(work, "spec")
+        os.mkdir(spec)
+        make_mod_tree(spec, scale)
+        public_key, secret_key = signify.generate_keypair()
+
+        for name, codec in CODECS.items():
+            if not codec.available():
+                sys.stderr.write("Skipping {}: it can't be used here.\n"
+                                 .format(name))
+                continue
+            out = os.path.join(work, "out-" + name)
+            os.mkdir(out)
+
+            started = time.perf_counter()
+            package = build.build_package(spec, out, codecs=[name],
+                                          secret_key=secret_key)
+            build_time = time.perf_counter() - started
+
+            cache = PackageCache(os.path.join(work, "cache-" + name))
+            archive = os.path.join(out, package.tarball)
+            signature = signify.Signature.load(
+                os.path.join(out, package.sig_file))
+            started = time.perf_counter()
+            with open(archive, mode="rb") as source:
+                verify_and_extract(io.BufferedReader(source), signature,
+                                   public_key, cache)
+            install_time = time.perf_counter() - started
+
+            results.append({"codec": name,
+                            "build_seconds": build_time,
+                            "archive_bytes": package.archives[name]["size"],
+                            "install_seconds": install_time})
+    finally:
+        shutil.rmtree(work)
+    return results
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-s', '--scale', type=int, default=8,
+                           help="Approximate mod tree size in MiB.")
+    argparser.add_argument('--json', action='store_true',
+                           help="Print machine-readable results.")
+    args = argparser.parse_args()
+
+    results = run(args.scale)
+    if args.json:
+        json.dump(results, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+        return
+
+    sys.stdout.write("{:<8} {:>10} {:>14} {:>12}\n".format(
+        "codec", "build (s)", "size (bytes)", "install (s)"))
+    for result in results:
+        sys.stdout.write("{codec:<8} {build_seconds:>10.2f} "
+                         "{archive_bytes:>14} {install_seconds:>12.2f}\n"
+                         .format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dependency resolver benchmark.
+
+Resolves synthetic dependency graphs of increasing size and reports the
+time taken. Every graph is satisfiable (the oldest version of everything
+always works), but the newest versions conflict with each other often
+enough that the resolver has to backtrack.
+
+    python benchmarks/bench_resolver.py [--packages N ...] [--json]
+"""
+
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from golddust.packages import Package
+from golddust.repoindex import RepositoryIndex
+from golddust.resolver import Resolver
+
+
+def make_index(packages, versions=5, dependencies=4, conflict_rate=0.05,
+               seed=0):
+    """Generate a synthetic repository index.
+
+    Package i only depends on packages below i. Dependency ranges always
+    include version 1.0, and conflicts only ever name the newest version of
+    a package.
+
+    Returns a golddust.repoindex.RepositoryIndex.
+    """
+    rand = random.Random(seed)
+    index = RepositoryIndex()
+    for number in range(packages):
+        for minor in range(versions):
+            package = Package()
+            package.name = "pkg{}".format(number)
+            package.version = "1.{}".format(minor)
+            for _ in range(min(number, rand.randint(0, dependencies))):
+                target = "pkg{}".format(rand.randrange(number))
+                package.dependencies[target] = "<=1.{}".format(
+                    rand.randrange(versions))
+            if number and rand.random() < conflict_rate:
+                target = "pkg{}".format(rand.randrange(number))
+                package.conflicts[target] = ">=1.{}".format(versions - 1)
+            index.add(package)
+    return index
+
+
+def run(sizes, roots=None):
+    """Benchmark resolving each graph size.
+
+    Takes:
+        sizes (list of int): Numbers of package names to generate.
+        roots (int): How many of the newest names to require; None requires
+                     every name, so the whole graph gets installed.
+
+    Returns a list of result dicts, one per size.
+    """
+    results = []
+    for size in sizes:
+        index = make_index(size)
+        first = 0 if roots is None else max(0, size - roots)
+        requirements = {"pkg{}".format(number): ""
+                        for number in range(first, size)}
+        started = time.perf_counter()
+        plan = Resolver(index).resolve(requirements)
+        results.append({"packages": size,
+                        "installed": len(plan),
+                        "seconds": time.perf_counter() - started})
+    return results
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-p', '--packages', type=int, nargs='+',
+                           default=[100, 1000, 5000],
+                           help="Graph sizes (package names) to resolve.")
+    argparser.add_argument('-r', '--roots', type=int, default=None,
+                           help="Require only the newest N package names.")
+    argparser.add_argument('--json', action='store_true',
+                           help="Print machine-readable results.")
+    args = argparser.parse_args()
+
+    results = run(args.packages, args.roots)
+    if args.json:
+        json.dump(results, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+        return
+
+    sys.stdout.write("{:>9} {:>10} {:>10}\n".format("packages", "installed",
+                                                     "seconds"))
+    for result in results:
+        sys.stdout.write("{packages:>9} {installed:>10} {seconds:>10.3f}\n"
+                         .format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Package search benchmark.
+
+Builds a search index of a synthetic repository index, times queries of
+several kinds against it, then times an incremental update from a delta
+touching a few names.
+
+The median time of the slowest query is checked against a budget; the
+exit status is 1 if it's over.
+
+    python benchmarks/bench_search.py [--packages N] [--budget MS] [--json]
+"""
+
+
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from golddust.packages import Package
+from golddust.repoindex import RepositoryIndex
+from golddust.search import SearchIndex
+
+
+WORDS = ["adds", "the", "new", "blocks", "items", "machines", "power",
+         "magic", "world", "generation", "tools", "armor", "library", "core",
+         "api", "tweaks", "mod"]
+
+GAME_VERSIONS = ["1.7.10", "1.10.2", "1.12.2", "1.16.5"]
+
+LOADERS = ["forge", "fabric", ""]
+
+
+def make_index(packages, versions=3, seed=0):
+    """Generate a synthetic repository index with search metadata.
+
+    Names and descriptions mix random words with a few common ones, so
+    some queries match many packages and others only a handful.
+
+    Returns a tuple of the golddust.repoindex.RepositoryIndex and the
+    list of random words.
+    """
+    rand = random.Random(seed)
+    vocabulary = ["".join(rand.choice("abcdefghijklmnopqrstuvwxyz")
+                          for _ in range(rand.randint(3, 10)))
+                  for _ in range(3000)]
+    index = RepositoryIndex()
+    index.generation = 1
+    for number in range(packages):
+        name = "{}-{}{}".format(rand.choice(vocabulary),
+                                rand.choice(vocabulary), number)
+        for minor in range(versions):
+            package = Package()
+            package.name = name
+            package.version = "1.{}".format(minor)
+            package.description = " ".join(
+                rand.choice(WORDS + vocabulary)
+                for _ in range(rand.randint(5, 15)))
+            package.game_versions = [rand.choice(GAME_VERSIONS)]
+            package.loader = rand.choice(LOADERS)
+            for _ in range(rand.randint(0, 3)):
+                package.dependencies["dep{}".format(
+                    rand.randrange(200))] = ">=1.0"
+            index.add(package)
+    return index, vocabulary
+
+
+def queries(vocabulary):
+    """Get the queries to time, as keyword arguments of `search`."""
+    return [{"query": "magic"},
+            {"query": "magic power"},
+            {"query": "the core api library"},
+            {"query": vocabulary[5]},
+            {"query": vocabulary[5][:4]},
+            {"query": "ma"},
+            {"query": "zzzqqq"},
+            {"game_version": "1.12"},
+            {"loader": "fabric"},
+            {"dependency": "dep7"},
+            {"query": "tools", "dependency": "dep7"},
+            {"query": "machines", "game_version": "1.7.10",
+             "loader": "forge"}]
+
+
+def run(packages, versions=3, runs=20, changed=50):
+    """Benchmark building, querying and updating a search index.
+
+    Takes:
+        packages (int): Number of package names to generate.
+        versions (int): Versions of each name.
+        runs (int): Times to run each query.
+        changed (int): Names the delta of the update touches.
+
+    Returns a dict of results.
+    """
+    index, vocabulary = make_index(packages, versions)
+    results = {"packages": packages, "versions": versions, "queries": []}
+    with tempfile.TemporaryDirectory() as work:
+        search = SearchIndex(os.path.join(work, "search.db"))
+        started = time.perf_counter()
+        search.update(index)
+        results["build_seconds"] = time.perf_counter() - started
+
+        for query in queries(vocabulary):
+            search.search(**query)
+            times = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                found = search.search(**query)
+                times.append(time.perf_counter() - started)
+            results["queries"].append({
+                "query": query, "results": len(found),
+                "milliseconds": statistics.median(times) * 1000})
+
+        older = copy.deepcopy(index)
+        for name in sorted(index.packages)[:changed]:
+            package = index.get(name, "1.0")
+            package.version = "2.0"
+            package.description = "brand new machines"
+            index.add(package)
+        index.generation += 1
+        started = time.perf_counter()
+        search.update(index, older.delta_to(index))
+        results["update_seconds"] = time.perf_counter() - started
+        search.close()
+    return results
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-p', '--packages', type=int, default=50000,
+                           help="Package names in the repository.")
+    argparser.add_argument('-V', '--versions', type=int, default=3,
+                           help="Versions of each package.")
+    argparser.add_argument('-n', '--runs', type=int, default=20,
+                           help="Times to run each query.")
+    argparser.add_argument('-b', '--budget', type=float, default=10.0,
+                           help="Allowed median query time in "
+                                "milliseconds.")
+    argparser.add_argument('--json', action='store_true',
+                           help="Print machine-readable results.")
+    args = argparser.parse_args()
+
+    results = run(args.packages, args.versions, args.runs)
+    if args.json:
+        json.dump(results, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+    else:
+        sys.stdout.write("build of {} packages: {:.1f} s\n".format(
+            results["packages"] * results["versions"],
+            results["build_seconds"]))
+        for query in results["queries"]:
+            sys.stdout.write("{:<60} {:>4} {:>8.2f} ms\n".format(
+                json.dumps(query["query"], sort_keys=True),
+                query["results"], query["milliseconds"]))
+        sys.stdout.write("update: {:.3f} s\n".format(
+            results["update_seconds"]))
+
+    slowest = max(query["milliseconds"] for query in results["queries"])
+    if slowest > args.budget:
+        sys.stderr.write("Slowest query {:.1f} ms is over the budget of "
+                         "{:.1f} ms.\n".format(slowest, args.budget))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""gdgame startup benchmark.
+
+Times gdgame invocations as separate processes, the way scripts call it:
+a bare interpreter for reference, importing gdgame, `listinstances` run in
+the process, and `listinstances` forwarded to a running `gdgame daemon`.
+
+The startup overhead of gdgame (importing it, less the bare interpreter)
+is checked against a budget; the exit status is 1 if it's over.
+
+    python benchmarks/bench_startup.py [--runs N] [--budget MS] [--json]
+"""
+
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import golddust
+from golddust import daemon
+
+
+def _median_ms(command, runs, env):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.check_call(command, env=env, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1000
+
+
+def run(runs, instances=20):
+    """Run the benchmark.
+
+    Returns a dict of median milliseconds by case.
+    """
+    work = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(golddust.__file__)))]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    gdgame = [sys.executable, "-m", "golddust.clitools.gdgame"]
+    try:
+        home = os.path.join(work, "home")
+        golddust.install_home_dir(home)
+        gdust = golddust.GoldDust(home)
+        for number in range(instances):
+            gdust.create_instance("inst{}".format(number), "",
+                                  os.path.join(work, "inst{}".format(number)))
+        gdust.instances.close()
+
+        results = {
+            "python": _median_ms([sys.executable, "-c", "pass"], runs, env),
+            "import": _median_ms([sys.executable, "-c",
+                                  "import golddust.clitools.gdgame"],
+                                 runs, env),
+            "listinstances": _median_ms(
+                gdgame + ["-H", home, "--no-daemon", "listinstances"],
+                runs, env),
+        }
+
+        server = subprocess.Popen(gdgame + ["-H", home, "daemon"], env=env)
+        try:
+            deadline = time.monotonic() + 10
+            while daemon.request(home, {"argv": None}) is None:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("The daemon didn't start.")
+                time.sleep(0.05)
+            results["listinstances_daemon"] = _median_ms(
+                gdgame + ["-H", home, "listinstances"], runs, env)
+        finally:
+            daemon.stop(home)
+            server.wait()
+    finally:
+        shutil.rmtree(work)
+    results["startup_overhead"] = results["import"] - results["python"]
+    return results
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-n', '--runs', type=int, default=20,
+                           help="Invocations per case; the median counts.")
+    argparser.add_argument('-b', '--budget', type=float, default=50.0,
+                           help="Allowed startup overhead in milliseconds.")
+    argparser.add_argument('--json', action='store_true',
+                           help="Print machine-readable results.")
+    args = argparser.parse_args()
+
+    results = run(args.runs)
+    if args.json:
+        json.dump(results, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+    else:
+        for name, milliseconds in results.items():
+            sys.stdout.write("{:<22} {:>8.1f} ms\n".format(name,
+                                                           milliseconds))
+
+    if results["startup_overhead"] > args.budget:
+        sys.stderr.write("Startup overhead {:.1f} ms is over the budget of "
+                         "{:.1f} ms.\n".format(results["startup_overhead"],
+                                               args.budget))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GoldDust benchmark suite.
+
+Generates a synthetic repository and GoldDust home at the requested scale
+and times the main operations end to end: home installation, instance
+creation, config loads and saves, package builds, signature verification
+(one by one and batched), extraction, bundling, dependency resolution,
+package installs and instance removal.
+
+Each operation is run in a fresh work directory `--repeat` times and the
+fastest run is reported. Results can be saved as JSON (`--out`) and
+compared against an earlier run (`--compare`), for example across commits:
+
+    python benchmarks/bench_suite.py --out before.json
+    git checkout other-branch
+    python benchmarks/bench_suite.py --compare before.json
+"""
+
+
+import argparse
+import collections
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import golddust
+from golddust import bundle, signify
+from golddust.pipeline import verify_and_extract
+from golddust.resolver import Resolver
+
+import synthetic
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _Timings:
+    """Collects the time of each operation, keeping the fastest run."""
+    def __init__(self):
+        self.results = collections.OrderedDict()
+
+    def record(self, name, seconds, count):
+        best = self.results.get(name)
+        if best is None or seconds < best["seconds"]:
+            self.results[name] = {"name": name, "seconds": seconds,
+                                  "count": count,
+                                  "per_op_seconds": seconds / max(count, 1)}
+
+    def time(self, name, func, count=1):
+        """Time one call of `func`, which performs `count` operations.
+
+        Returns whatever `func` returns.
+        """
+        started = time.perf_counter()
+        result = func()
+        self.record(name, time.perf_counter() - started, count)
+        return result
+
+
+def _run_once(work, options, timings):
+    public_key, secret_key = signify.generate_keypair()
+    packages = options.packages
+    instances = options.instances
+
+    home = os.path.join(work, "home")
+    timings.time("install_home_dir",
+                 lambda: golddust.install_home_dir(home))
+    gdust = golddust.GoldDust(home)
+    gdust.config.add_repository("bench", [], public_key.to_string())
+
+    specs = synthetic.make_specs(os.path.join(work, "specs"), packages,
+                                 options.files, options.file_size,
+                                 seed=options.seed)
+    repo_dir = os.path.join(work, "repo")
+    index = timings.time(
+        "build_packages",
+        lambda: synthetic.make_repository(repo_dir, specs, secret_key,
+                                          jobs=options.jobs),
+        packages)
+
+    plan = timings.time(
+        "resolve",
+        lambda: Resolver(index).resolve(
+            {synthetic.package_name(number): ""
+             for number in range(packages)}),
+        packages)
+
+    def verify():
+        for package in plan:
+            signature = signify.Signature.load(
+                os.path.join(repo_dir, package.sig_file))
+            verifier = signature.verifier(public_key)
+            with open(os.path.join(repo_dir, package.tarball),
+                      mode="rb") as archive:
+                for chunk in iter(lambda: archive.read(1024 * 1024), b""):
+                    verifier.update(chunk)
+            if not verifier.verify():
+                raise signify.BadSignatureError(package.tarball)
+    timings.time("verify_signatures", verify, packages)
+
+    def verify_batch():
+        verifiers = []
+        for package in plan:
+            signature = signify.Signature.load(
+                os.path.join(repo_dir, package.sig_file))
+            verifier = signature.verifier(public_key)
+            with open(os.path.join(repo_dir, package.tarball),
+                      mode="rb") as archive:
+                for chunk in iter(lambda: archive.read(1024 * 1024), b""):
+                    verifier.update(chunk)
+            verifiers.append(verifier)
+        if not all(signify.verify_batch(verifiers)):
+            raise signify.BadSignatureError("Bad signature in batch.")
+    timings.time("verify_signatures_batch", verify_batch, packages)
+
+    def extract():
+        for package in plan:
+            signature = signify.Signature.load(
+                os.path.join(repo_dir, package.sig_file))
+            with open(os.path.join(repo_dir, package.tarball),
+                      mode="rb") as archive:
+                package.digest = verify_and_extract(
+                    io.BufferedReader(archive), signature, public_key,
+                    gdust.package_cache, tarball=package.tarball)
+    timings.time("verify_and_extract", extract, packages)
+
+    timings.time("write_bundle",
+                 lambda: bundle.write_bundle(repo_dir, "bench", plan,
+                                             secret_key),
+                 packages)
+
+    names = timings.time(
+        "create_instance",
+        lambda: synthetic.make_instances(gdust, os.path.join(work, "games"),
+                                         instances),
+        instances)
+
+    def load_save():
+        for name in names:
+            config = gdust.load_instance(name)
+            config.longname += "!"
+            config.save()
+    timings.time("config_load_save", load_save, instances)
+
+    timings.time("list_instances", lambda: [config.path for config
+                                            in gdust.instances], instances)
+
+    installs = min(instances, options.install_instances)
+
+    def install():
+        for name in names[:installs]:
+            for package in plan:
+                gdust.install_package(name, package)
+    timings.time("install_package", install, installs * packages)
+
+    def verify():
+        for name in names[:installs]:
+            gdust.verify_instance(name, full=True)
+    timings.time("verify_instance", verify, installs)
+
+    timings.time("find_by_package",
+                 lambda: gdust.instances.find_by_package(
+                     synthetic.package_name(0)))
+
+    def remove():
+        for name in names:
+            gdust.remove_instance(name, remove_game_files=True)
+    timings.time("remove_instance", remove, instances)
+
+    timings.time("collect_garbage",
+                 lambda: gdust.collect_garbage(0, min_age=0), packages)
+
+
+def run(options):
+    """Run the suite.
+
+    Takes:
+        options (argparse.Namespace): The scale options (see `main`).
+
+    Returns the result document as a dict.
+    """
+    timings = _Timings()
+    for _ in range(options.repeat):
+        work = tempfile.mkdtemp()
+        try:
+            _run_once(work, options, timings)
+        finally:
+            shutil.rmtree(work)
+
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.time(),
+        "scale": {"packages": options.packages,
+                  "instances": options.instances,
+                  "install_instances": options.install_instances,
+                  "files": options.files,
+                  "file_size": options.file_size,
+                  "seed": options.seed,
+                  "repeat": options.repeat},
+        "results": list(timings.results.values()),
+    }
+
+
+def _print_results(document, baseline=None):
+    previous = {}
+    if baseline is not None:
+        previous = {result["name"]: result
+                    for result in baseline["results"]}
+        sys.stdout.write("Compared with {} (now {})\n".format(
+            baseline.get("revision"), document.get("revision")))
+
+    sys.stdout.write("{:<24} {:>7} {:>11} {:>13}".format(
+        "operation", "count", "total (s)", "per op (ms)"))
+    sys.stdout.write(" {:>9}\n".format("change") if previous else "\n")
+    for result in document["results"]:
+        sys.stdout.write("{name:<24} {count:>7} {seconds:>11.3f} "
+                         "{per_op:>13.3f}".format(
+                             per_op=result["per_op_seconds"] * 1000,
+                             **result))
+        old = previous.get(result["name"])
+        if old and old["per_op_seconds"]:
+            sys.stdout.write(" {:>+8.1f}%".format(
+                100 * (result["per_op_seconds"] / old["per_op_seconds"]
+                       - 1)))
+        sys.stdout.write("\n")
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-p', '--packages', type=int, default=50,
+                           help="Number of synthetic packages.")
+    argparser.add_argument('-i', '--instances', type=int, default=200,
+                           help="Number of instances to create.")
+    argparser.add_argument('-I', '--install-instances', type=int, default=5,
+                           help="Number of instances to install every "
+                                "package into.")
+    argparser.add_argument('-f', '--files', type=int, default=8,
+                           help="Files per package.")
+    argparser.add_argument('-s', '--file-size', type=int, default=64 * 1024,
+                           help="Size of each package file in bytes.")
+    argparser.add_argument('-j', '--jobs', type=int,
+                           help="Build worker processes.")
+    argparser.add_argument('-r', '--repeat', type=int, default=3,
+                           help="Runs per operation; the fastest counts.")
+    argparser.add_argument('--seed', type=int, default=0,
+                           help="Random seed of the synthetic data.")
+    argparser.add_argument('-o', '--out', metavar="FILE",
+                           help="Save the results as JSON.")
+    argparser.add_argument('-c', '--compare', metavar="FILE",
+                           help="Compare with results saved by --out.")
+    argparser.add_argument('--json', action='store_true',
+                           help="Print machine-readable results.")
+    args = argparser.parse_args()
+
+    document = run(args)
+    if args.out:
+        with open(args.out, mode="w") as out:
+            json.dump(document, out, indent=4)
+            out.write("\n")
+
+    if args.json:
+        json.dump(document, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, mode="r") as compare:
+            baseline = json.load(compare)
+    _print_results(document, baseline)
+
+
+if __name__ == "__main__":
+    main()
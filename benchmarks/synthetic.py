@@ -0,0 +1,119 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic data for the benchmarks.
+
+Generates package specification trees (the layout in doc/Packages.md),
+built and indexed repositories, and GoldDust homes with instances, all
+from a seed so runs are comparable.
+"""
+
+
+import json
+import os
+import random
+
+from golddust import build, repoindex
+
+
+def package_name(number):
+    """The name of the n-th synthetic package."""
+    return "pkg{}".format(number)
+
+
+def make_package_tree(root, name, version, files=8, file_size=64 * 1024,
+                      dependencies=None, seed=0):
+    """Create a package specification tree.
+
+    Half of each file is random bytes and half is repetitive text, so
+    archives compress about as well as typical mods.
+
+    Takes:
+        root (str): The directory to create. Must not exist.
+        name (str): The package name.
+        version (str): The package version.
+        files (int): Number of files under game/.
+        file_size (int): Size of each file in bytes.
+        dependencies (dict): Version constraints by package name.
+        seed (int): Random seed.
+    """
+    rand = random.Random("{}-{}-{}".format(seed, name, version))
+    os.makedirs(os.path.join(root, "game", "mods"))
+    os.makedirs(os.path.join(root, "game", "config"))
+    metadata = {"name": name, "version": version}
+    if dependencies:
+        metadata["dependencies"] = dependencies
+    with open(os.path.join(root, build.SPEC_FILE_NAME), mode="w") as spec:
+        json.dump(metadata, spec)
+
+    text = "{}={}\n".format(name, version).encode("ascii")
+    for index in range(files):
+        sub = "mods" if index % 2 == 0 else "config"
+        path = os.path.join(root, "game", sub,
+                            "{}-{}.dat".format(name, index))
+        half = file_size // 2
+        with open(path, mode="wb") as data:
+            data.write(rand.getrandbits(8 * half).to_bytes(half, "little")
+                       if half else b"")
+            data.write((text * (file_size // len(text) + 1))
+                       [:file_size - half])
+
+
+def make_specs(root, packages, files=8, file_size=64 * 1024,
+               dependencies=3, seed=0):
+    """Create many package trees with a random dependency graph.
+
+    Package i only depends on packages below i, with unconstrained
+    versions, so every set of packages resolves.
+
+    Returns a list of spec directory paths.
+    """
+    rand = random.Random(seed)
+    specs = []
+    for number in range(packages):
+        deps = {}
+        for _ in range(min(number, rand.randint(0, dependencies))):
+            deps[package_name(rand.randrange(number))] = ">=1.0"
+        spec_dir = os.path.join(root, package_name(number))
+        make_package_tree(spec_dir, package_name(number), "1.0", files,
+                          file_size, deps, seed)
+        specs.append(spec_dir)
+    return specs
+
+
+def make_repository(repo_dir, specs, secret_key, codecs=("bz2",),
+                    jobs=None):
+    """Build package trees into a repository and publish its index.
+
+    Returns the published golddust.repoindex.RepositoryIndex.
+    """
+    os.makedirs(repo_dir, exist_ok=True)
+    build.build_all(specs, repo_dir, codecs, secret_key, jobs=jobs,
+                    force=True)
+    return repoindex.publish(repo_dir, secret_key)
+
+
+def make_instances(gdust, root, count):
+    """Create empty instances in a GoldDust home.
+
+    Returns a list of the instance names.
+    """
+    os.makedirs(root, exist_ok=True)
+    names = []
+    for number in range(count):
+        name = "inst{}".format(number)
+        gdust.create_instance(name, "Instance {}".format(number),
+                              os.path.join(root, name))
+        names.append(name)
+    return names
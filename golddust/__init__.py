@@ -22,12 +22,38 @@ Minecraft Forge and texture packs).
 
 import json
 import os
-import platform
-import shutil
+import sys
+
+# Other modules are imported where they're used: command line tools run
+# one operation per process, and most operations need only a few of them
+# (see benchmarks/bench_startup.py).
+
+
+def __getattr__(name):
+    # InstanceConfig and InstanceRegistry were once defined here.
+    if name in ("InstanceConfig", "InstanceRegistry"):
+        from golddust import registry
+        return getattr(registry, name)
+    raise AttributeError("module {!r} has no attribute {!r}"
+                         .format(__name__, name))
 
 
 _CONFIG_FILE_NAME = "config.json"
 
+# Packages downloaded at once by `GoldDust.fetch_packages`. Each download
+# is itself split over the mirrors, so a few are enough to keep them busy.
+_FETCH_THREADS = 4
+
+
+def _file_stamp(path):
+    """Get a value that changes whenever a file is rewritten, or None if it
+    doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
 
 def default_home_dir():
     """Get the default home directory path on this platform.
@@ -43,7 +69,7 @@ def default_home_dir():
     """
     path = "~/.golddust"
 
-    if platform.system() == "Windows" and "APPDATA" in os.environ:
+    if sys.platform == "win32" and "APPDATA" in os.environ:
         path = os.path.join(os.environ["APPDATA"], ".golddust")
 
     return os.path.abspath(os.path.expanduser(path))
@@ -79,10 +105,13 @@ class GlobalConfig:
     """GoldDust global configuration.
 
     This configuration holds information about repositories and their
-    mirrors.
+    mirrors, and the size cap of the package cache.
     """
     def __init__(self):
         self.repositories = []
+        self.cache_max_size = None
+        """The package cache is shrunk to this many bytes after fetching
+        packages (see GoldDust.collect_garbage). None for no cap."""
 
     def get_repository(self, repo):
         """Get the repository dict from a repository name.
@@ -104,13 +133,15 @@ class GlobalConfig:
 
         return target
 
-    def add_repository(self, name, mirrors):
+    def add_repository(self, name, mirrors, public_key=None):
         """Add a repository to the global configuration.
 
         Takes:
             name (str): The name for this repository. Traditionally
                         alphanumeric-only in lowercase.
             mirrors (list of str): HTTP(S) mirrors of this repository.
+            public_key (str): Contents of the signify public key file that
+                              the repository's packages are signed with.
 
         Raises:
             ValueError: The repository already exists in the configuration.
@@ -119,7 +150,8 @@ class GlobalConfig:
             if repo["name"] == name:
                 raise ValueError("Repository already exists in configuration.")
 
-        self.repositories.append({"name": name, "mirrors": mirrors})
+        self.repositories.append({"name": name, "mirrors": mirrors,
+                                  "public_key": public_key})
 
     def remove_repository(self, name):
         """Remove a repository from the GoldDust configuration.
@@ -148,51 +180,482 @@ class GlobalConfig:
         target["mirrors"].append(mirror)
 
 
-class InstanceConfig:
-    """A game instance configuration.
-    """
-    def __init__(self, file_path):
-        self._file_path = file_path
-        """The path to the instance config."""
-        self.path = ""
-        """The path to this instance's game files on disk."""
-        self.longname = ""
-        """The long-form user-friendly name for this instance."""
-
-    def load(self):
-        """Load the config for `instance_name` into this config object.
-        """
-        with open(self._file_path, mode="r") as config_file:
-            self.__dict__.update(json.load(config_file))
-
-    def save(self):
-        """Save this configuration to disk.
-        """
-        # FIXME: I don't want to save the _file_path property into this file
-        with open(self._file_path, mode="w") as config_file:
-            json.dump(self.__dict__, config_file, sort_keys=True, indent=4)
-
-
 class GoldDust:
     """An instance of the GoldDust package manager."""
     def __init__(self, root):
         self.config = GlobalConfig()
         self.root = os.path.abspath(os.path.expanduser(root))
+        from golddust.pkgcache import PackageCache
+        from golddust.registry import InstanceRegistry
+
+        self.package_cache = PackageCache(os.path.join(self.root, "pkgcache"))
+        self.instances = InstanceRegistry(os.path.join(self.root, "instances"))
+        self._config_stamp = None
+        self._indexes = {}
+        self._searches = {}
 
         if os.path.isfile(os.path.join(self.root, _CONFIG_FILE_NAME)):
             self.load_global_config()
 
+    def _lock(self, *parts, shared=False):
+        from golddust.locks import LOCKS_DIR_NAME, FileLock
+
+        return FileLock(os.path.join(self.root, LOCKS_DIR_NAME, *parts),
+                        shared)
+
+    def lock_instance(self, instance_name, shared=False):
+        """Get the lock of an instance; see golddust.locks.
+
+        Operations changing an instance's files or records hold it
+        exclusively, and ones only reading them hold it shared, so
+        operations on different instances run in parallel.
+
+        Returns a golddust.locks.FileLock.
+        """
+        return self._lock("instances", instance_name.lower(), shared=shared)
+
     def save_global_config(self):
-        """Save the global configuration."""
-        config = open(os.path.join(self.root, _CONFIG_FILE_NAME), "w")
-        json.dump(self.config.__dict__, config, sort_keys=True, indent=4)
-        config.close()
+        """Save the global configuration.
+
+        The file is replaced atomically, so other processes only ever see
+        the old or the new configuration. Use `edit_global_config` to
+        change it without losing other processes' changes.
+        """
+        import tempfile
+
+        with self._lock("config"):
+            fd, tmp_path = tempfile.mkstemp(dir=self.root)
+            try:
+                with os.fdopen(fd, mode="w") as config:
+                    json.dump(self.config.__dict__, config, sort_keys=True,
+                              indent=4)
+                    config.flush()
+                    os.fsync(config.fileno())
+                os.chmod(tmp_path, 0o644)
+                path = os.path.join(self.root, _CONFIG_FILE_NAME)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self._config_stamp = _file_stamp(path)
+
+    def edit_global_config(self):
+        """Change the global configuration and save it, holding its lock
+        so concurrent edits by other processes are not lost.
+
+        Returns a context manager yielding the GlobalConfig, freshly
+        loaded.
+        """
+        import contextlib
+
+        @contextlib.contextmanager
+        def edit():
+            with self._lock("config"):
+                if os.path.isfile(os.path.join(self.root,
+                                               _CONFIG_FILE_NAME)):
+                    self.load_global_config()
+                yield self.config
+                self.save_global_config()
+        return edit()
 
     def load_global_config(self):
         """Load the global configuration from a file."""
-        config = open(os.path.join(self.root, _CONFIG_FILE_NAME), "r")
-        self.config.__dict__ = json.load(config)
-        config.close()
+        from golddust import metrics
+
+        path = os.path.join(self.root, _CONFIG_FILE_NAME)
+        with metrics.span("config.load", kind="global"):
+            self._config_stamp = _file_stamp(path)
+            config = open(path, "r")
+            # Settings missing from older files keep their defaults.
+            self.config.__dict__ = dict(GlobalConfig().__dict__,
+                                        **json.load(config))
+            config.close()
+
+    def reload_if_changed(self):
+        """Reload the global configuration if it changed on disk.
+
+        Long-lived GoldDust objects (such as the one kept by the gdgame
+        daemon) call this before each operation to see changes made by
+        other processes. Instance state is in the registry database, which
+        is always current.
+        """
+        stamp = _file_stamp(os.path.join(self.root, _CONFIG_FILE_NAME))
+        if stamp is not None and stamp != self._config_stamp:
+            self.load_global_config()
+
+    def downloader(self, repo, **kwargs):
+        """Get a downloader for all mirrors of a repository.
+
+        Takes:
+            repo (str): The repository name.
+            Any other keyword arguments are passed on to `Downloader`.
+
+        Raises:
+            KeyError: The repository doesn't exist in the configuration.
+
+        Returns a golddust.download.Downloader.
+        """
+        from golddust.download import Downloader
+
+        return Downloader(self.config.get_repository(repo)["mirrors"],
+                          **kwargs)
+
+    def repository_index_path(self, repo):
+        """Get the path of the local copy of a repository's index."""
+        return os.path.join(self.root, "repos", repo, "index.json.gz")
+
+    def repository_index(self, repo):
+        """Load the local copy of a repository's index.
+
+        Takes:
+            repo (str): The repository name.
+
+        The index is kept in memory until the file changes.
+
+        Returns a golddust.repoindex.RepositoryIndex, empty if the
+        repository has never been refreshed.
+        """
+        from golddust import repoindex
+
+        path = self.repository_index_path(repo)
+        stamp = _file_stamp(path)
+        cached = self._indexes.get(repo)
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            return cached[1]
+        index = repoindex.RepositoryIndex.load(path)
+        self._indexes[repo] = (stamp, index)
+        return index
+
+    def search_index_path(self, repo):
+        """Get the path of a repository's search index."""
+        from golddust.search import SEARCH_FILE_NAME
+
+        return os.path.join(self.root, "repos", repo, SEARCH_FILE_NAME)
+
+    def search_index(self, repo):
+        """Get the search index of the local copy of a repository's index.
+
+        The search index is built the first time it is asked for, and kept
+        up to date by `refresh_repository` from then on.
+
+        Takes:
+            repo (str): The repository name.
+
+        Returns a golddust.search.SearchIndex.
+        """
+        from golddust.search import SearchIndex
+
+        search = self._searches.setdefault(
+            repo, SearchIndex(self.search_index_path(repo)))
+        index = self.repository_index(repo)
+        if search.generation != index.generation:
+            search.update(index)
+        return search
+
+    def refresh_repository(self, repo):
+        """Bring the local copy of a repository's index up to date.
+
+        Only a small delta is downloaded if the repository publishes one
+        from the local generation; otherwise the full index is fetched. If
+        the repository has a public key, the index head must be signed.
+        The repository's search index, if it has one, is updated with the
+        names the delta touches.
+
+        Takes:
+            repo (str): The repository name.
+
+        Raises:
+            KeyError: The repository doesn't exist in the configuration.
+            golddust.download.DownloadError: The index couldn't be fetched.
+            golddust.signify.BadSignatureError: The index head signature
+                                                doesn't match.
+            ValueError: The fetched index doesn't match the head digest.
+
+        Returns the up to date golddust.repoindex.RepositoryIndex.
+        """
+        from golddust import metrics, repoindex, signify
+
+        repository = self.config.get_repository(repo)
+        index = self.repository_index(repo)
+        # Deltas are applied in place; don't leave a half-updated index in
+        # the cache if this fails.
+        stamp, _ = self._indexes.pop(repo)
+
+        def fetch(downloader, name):
+            with downloader.open("{}/{}".format(repoindex.INDEX_DIR_NAME,
+                                                name)) as stream:
+                return stream.read()
+
+        with metrics.span("repository.refresh", repo=repo), \
+                self.downloader(repo) as downloader:
+            head_data = fetch(downloader, repoindex.HEAD_FILE_NAME)
+            if repository.get("public_key"):
+                public_key = signify.PublicKey.from_string(
+                    repository["public_key"])
+                signature = signify.Signature.from_string(
+                    fetch(downloader, repoindex.HEAD_FILE_NAME + ".sig")
+                    .decode("ascii"))
+                verifier = signature.verifier(public_key)
+                verifier.update(head_data)
+                if not verifier.verify():
+                    raise signify.BadSignatureError(
+                        "Bad signature for repository index.")
+            head = json.loads(head_data.decode("utf-8"))
+
+            if head["generation"] == index.generation \
+                    and head["digest"] == index.digest():
+                self._indexes[repo] = (stamp, index)
+                return index
+
+            updated = False
+            delta = None
+            if index.generation in head["deltas"]:
+                delta = repoindex.decode(fetch(
+                    downloader, repoindex.delta_file_name(
+                        index.generation, head["generation"])))
+                try:
+                    index.apply_delta(delta)
+                    updated = index.digest() == head["digest"]
+                except ValueError:
+                    pass
+
+            if not updated:
+                delta = None
+                index = repoindex.RepositoryIndex.from_dict(repoindex.decode(
+                    fetch(downloader,
+                          repoindex.index_file_name(head["generation"]))))
+                if index.digest() != head["digest"]:
+                    raise ValueError("Repository index doesn't match its "
+                                     "head digest.")
+
+        path = self.repository_index_path(repo)
+        index.save(path)
+        self._indexes[repo] = (_file_stamp(path), index)
+        if os.path.isfile(self.search_index_path(repo)):
+            from golddust.search import SearchIndex
+
+            self._searches.setdefault(repo, SearchIndex(
+                self.search_index_path(repo))).update(index, delta)
+        return index
+
+    def fetch_package(self, repo, package):
+        """Download, verify and extract a package into the package cache.
+
+        See `fetch_packages`.
+        """
+        self.fetch_packages(repo, [package], workers=1)
+
+    def fetch_packages(self, repo, packages, workers=None):
+        """Download, verify and extract packages into the package cache.
+
+        Several archives are downloaded at once, each streamed from the
+        repository's mirrors (in byte ranges spread over them, if large)
+        and staged in a single pass (see golddust.pipeline), then the signatures of all of them are checked
+        together with golddust.signify.verify_batch. Packages whose
+        `digest` is cached and already verified with the repository's key
+        are skipped, and cached archives that aren't are checked without
+        downloading them again. If that takes the package cache over the
+        configured `cache_max_size`, unused packages are evicted (see
+        `collect_garbage`).
+
+        Takes:
+            repo (str): The repository to fetch from.
+            packages (list of golddust.packages.Package): The packages to
+                fetch. Their `digest`s are set to the digests of the
+                fetched archives.
+            workers (int): Processes checking signatures; see
+                           golddust.signify.verify_batch.
+
+        Raises:
+            KeyError: The repository doesn't exist or has no public key.
+            golddust.download.DownloadError: A package couldn't be
+                downloaded from any mirror.
+            golddust.signify.BadSignatureError: Package signatures don't
+                match. The other packages are still committed.
+        """
+        from golddust import signify
+        from golddust.locks import MultiLock
+
+        repository = self.config.get_repository(repo)
+        if not repository.get("public_key"):
+            raise KeyError("Repository has no public key configured.")
+        public_key = signify.PublicKey.from_string(repository["public_key"])
+
+        cache = self.package_cache
+        pending = [package for package in packages
+                   if not (package.digest and cache.has_tree(package.digest)
+                           and cache.is_verified(package.digest,
+                                                 public_key.key))]
+        if not pending:
+            return
+
+        # Packages already in the cache mustn't be evicted while this
+        # reads them.
+        with MultiLock(cache.lock(digest) for digest
+                       in {package.digest for package in pending}
+                       if digest):
+            bad = self._fetch_pending(repo, pending, public_key, workers)
+        if self.config.cache_max_size is not None \
+                and cache.size() > self.config.cache_max_size:
+            self.collect_garbage()
+        if bad:
+            raise signify.BadSignatureError("Bad signature for {}."
+                                            .format(", ".join(bad)))
+
+    def _fetch_pending(self, repo, pending, public_key, workers):
+        """Do the work of `fetch_packages`.
+
+        A few packages are fetched at a time, each streamed straight into
+        golddust.pipeline.stage_archive. Archives of known size larger
+        than a download chunk are streamed as byte ranges spread over the
+        mirrors (see golddust.download.Downloader.open).
+
+        Returns a list of the tarballs whose signatures didn't match.
+        """
+        import concurrent.futures
+
+        from golddust import metrics, signify
+
+        staged = []
+        with self.downloader(repo) as downloader, \
+                concurrent.futures.ThreadPoolExecutor(
+                    _FETCH_THREADS) as pool:
+            tasks = [pool.submit(self._fetch_one, downloader, package,
+                                 public_key) for package in pending]
+            try:
+                for package, task in zip(pending, tasks):
+                    staged.append((package, task.result()))
+
+                with metrics.span("verify", signatures=len(staged)):
+                    results = signify.verify_batch(
+                        [archive.verifier for _, archive in staged],
+                        workers)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                concurrent.futures.wait(tasks)
+                for task in tasks:
+                    if not task.cancelled() and task.exception() is None:
+                        task.result().discard()
+                raise
+
+        bad = []
+        for (package, archive), valid in zip(staged, results):
+            if valid:
+                package.digest = archive.commit()
+            else:
+                archive.discard()
+                bad.append(package.tarball)
+        return bad
+
+    def _fetch_one(self, downloader, package, public_key):
+        """Fetch and stage one package for `_fetch_pending`.
+
+        Returns a golddust.pipeline.StagedArchive.
+        """
+        from golddust import metrics, signify
+        from golddust.pipeline import stage_archive, stage_cached
+
+        cache = self.package_cache
+        with metrics.span("fetch", package=package.name,
+                          version=package.version):
+            with downloader.open(package.sig_file) as sig_stream:
+                signature = signify.Signature.from_string(
+                    sig_stream.read().decode("ascii"))
+            if package.digest and cache.has_archive(package.digest):
+                return stage_cached(cache, package.digest, signature,
+                                    public_key, tarball=package.tarball)
+
+            size = package.archives.get(package.codec, {}).get("size")
+            with downloader.open(package.tarball, size) as stream:
+                return stage_archive(stream, signature, public_key, cache,
+                                     tarball=package.tarball,
+                                     expected_digest=package.digest or None)
+
+    def fetch_bundle(self, repo, bundle, packages):
+        """Fetch packages into the package cache from a repository bundle.
+
+        Only the bundle chunks holding the packages' files are downloaded,
+        with range requests (see golddust.bundle). The packages' trees are
+        built straight from those files and no archives are cached; the
+        bundle index's signature stands in for the archives'.
+
+        Takes:
+            repo (str): The repository to fetch from.
+            bundle (str): The bundle name.
+            packages (list of golddust.packages.Package): The packages to
+                fetch, such as a resolved install plan.
+
+        Raises:
+            KeyError: The repository doesn't exist or has no public key.
+            golddust.download.DownloadError: The bundle couldn't be
+                                             downloaded from any mirror.
+            golddust.signify.BadSignatureError: The bundle index signature
+                                                doesn't match.
+            ValueError: The bundle is corrupt.
+
+        Returns a list of the packages that still need fetching with
+        `fetch_packages`, because the bundle doesn't hold the same build of
+        them.
+        """
+        from golddust import metrics, signify
+        from golddust.bundle import BundleIndex
+        from golddust.locks import MultiLock
+
+        repository = self.config.get_repository(repo)
+        if not repository.get("public_key"):
+            raise KeyError("Repository has no public key configured.")
+        public_key = signify.PublicKey.from_string(repository["public_key"])
+
+        cache = self.package_cache
+        pending = [package for package in packages
+                   if not (package.digest and cache.has_tree(package.digest)
+                           and cache.is_verified(package.digest,
+                                                 public_key.key))]
+        if not pending:
+            return []
+
+        with self.downloader(repo) as downloader:
+            index = BundleIndex.fetch(downloader, bundle, public_key)
+            bundled = [package for package in pending
+                       if package.digest and index.has(package)]
+            if not bundled:
+                return pending
+            with MultiLock(cache.lock(digest) for digest
+                           in {package.digest for package in bundled}), \
+                    metrics.span("fetch_bundle", bundle=bundle,
+                                 packages=len(bundled)):
+                missing = [package for package in bundled
+                           if not cache.has_tree(package.digest)]
+                index.extract_packages(downloader, cache, missing)
+                for package in bundled:
+                    cache.mark_verified(package.digest, public_key.key)
+
+        if self.config.cache_max_size is not None \
+                and cache.size() > self.config.cache_max_size:
+            self.collect_garbage()
+        return [package for package in pending if package not in bundled]
+
+    def collect_garbage(self, max_size=None, min_age=600.0, dry_run=False):
+        """Evict packages no instance uses from the package cache, least
+        recently used first, until it fits a size.
+
+        Takes:
+            max_size (int): The size to shrink the cache to, in bytes.
+                Defaults to the configured `cache_max_size`, or to evicting
+                everything unused if there is none.
+            min_age (float): Seconds since its last use before a package
+                             may be evicted.
+            dry_run (bool): Only report what would be evicted.
+
+        Returns a list of (kind, key, size) tuples of the evicted entries;
+        see golddust.pkgcache.PackageCache.collect.
+        """
+        if max_size is None:
+            max_size = self.config.cache_max_size or 0
+        return self.package_cache.collect(max_size,
+                                          set(self.instances.references()),
+                                          min_age, dry_run)
 
     def create_instance(self, name, longname, path):
         """Create the files for a new game instance.
@@ -211,36 +674,591 @@ class GoldDust:
             raise ValueError("Instance name must be alphanumeric.")
         name = name.lower()
 
+        path = os.path.abspath(os.path.expanduser(path))
+        if os.path.exists(path):
+            raise FileExistsError("Instance path already exists.")
+
+        with self.lock_instance(name):
+            instance_config = self.instances.new(name)
+            instance_config.longname = longname or ""
+            instance_config.path = path
+            os.mkdir(path)
+            instance_config.save()
+
+    def clone_instance(self, source_name, name, longname, path):
+        """Create a new instance as a copy of an existing one.
+
+        Package files are hardlinked (or reflinked) rather than copied;
+        the instance's other files are reflinked where possible and copied
+        otherwise, so neither instance sees the other's writes.
+
+        Takes:
+            source_name (str): The instance to copy.
+            name (str): The new instance name. Must be alphanumeric and
+                        unique.
+            longname (str): The user-friendly name of the new instance.
+            path (str): The path to the new instance's files. Must not yet
+                        exist.
+
+        Raises:
+            KeyError: There is no instance named `source_name`.
+            ValueError: The instance name must be alphanumeric.
+            FileExistsError: The path or name is already in use.
+        """
+        import shutil
+        from golddust.locks import MultiLock
+        from golddust.pkgcache import clone_tree
+
+        if not name.isalnum():
+            raise ValueError("Instance name must be alphanumeric.")
+        name = name.lower()
+
+        path = os.path.abspath(os.path.expanduser(path))
         if os.path.exists(path):
             raise FileExistsError("Instance path already exists.")
-        os.mkdir(path)
 
-        instance_file = os.path.join(self.root, "instances",
-                                     "{}.json".format(name))
-        if os.path.exists(instance_file):
-            raise FileExistsError("Instance name is already in use.")
+        with MultiLock([self.lock_instance(source_name, shared=True),
+                        self.lock_instance(name)]):
+            source = self.load_instance(source_name)
+            instance_config = self.instances.new(name)
+            instance_config.longname = longname or source.longname
+            instance_config.path = path
+            records = self.instances.records(source_name)
+            try:
+                clone_tree(source.path, path, self.package_cache.link_mode,
+                           shared=set(records["files"]))
+            except BaseException:
+                shutil.rmtree(path, ignore_errors=True)
+                raise
+            instance_config.jar = source.jar
+            instance_config.save()
+            self.instances.restore_records(name, records)
+
+    def snapshots(self, instance_name):
+        """Get the snapshot store of an instance.
+
+        Raises:
+            KeyError: There is no such instance.
+
+        Returns a golddust.snapshots.SnapshotStore.
+        """
+        from golddust.snapshots import SnapshotStore
+
+        return SnapshotStore(self.load_instance(instance_name).path)
+
+    def snapshot_instance(self, instance_name, description=""):
+        """Save a snapshot generation of an instance.
+
+        Takes:
+            instance_name (str): The instance to snapshot.
+            description (str): A note to keep with the snapshot.
+
+        Raises:
+            KeyError: There is no such instance.
+
+        Returns int, the new generation number.
+        """
+        with self.lock_instance(instance_name):
+            info = self.snapshots(instance_name).create(
+                self.instances.records(instance_name), description,
+                self.package_cache.link_mode)
+        return info["generation"]
 
-        instance_config = InstanceConfig(file_path=instance_file)
-        instance_config.longname = longname
-        instance_config.path = path
-        instance_config.save()
+    def rollback_instance(self, instance_name, generation=None):
+        """Restore an instance from a snapshot.
+
+        The snapshot is swapped into place with renames, and the state
+        rolled back from is kept as a new snapshot generation.
+
+        Takes:
+            instance_name (str): The instance to roll back.
+            generation (int): The generation to restore; defaults to the
+                              newest one.
+
+        Raises:
+            KeyError: There is no such instance or snapshot.
+
+        Returns int, the generation holding the state rolled back from.
+        """
+        with self.lock_instance(instance_name):
+            store = self.snapshots(instance_name)
+            if generation is None:
+                generations = store.generations()
+                if not generations:
+                    raise KeyError("{} has no snapshots."
+                                   .format(instance_name))
+                generation = generations[-1]
+
+            restored, current = store.swap(
+                generation, self.instances.records(instance_name),
+                "Before rollback to generation {}".format(generation))
+            self.instances.restore_records(instance_name,
+                                           restored["records"])
+        return current["generation"]
+
+    def load_instance(self, instance_name):
+        """Load the configuration of an existing instance.
+
+        Takes:
+            instance_name (str): The instance name.
+
+        Raises:
+            KeyError: There is no such instance.
+
+        Returns the loaded InstanceConfig.
+        """
+        return self.instances.get(instance_name)
+
+    def install_package(self, instance_name, package):
+        """Install or upgrade a cached package in an instance.
+
+        The package is extracted into the package cache once per host, and
+        its files are linked from there into the instance. If another
+        version of the package is installed, only the files that differ
+        are replaced and the files the new version dropped are deleted;
+        see golddust.manifest.
+
+        Takes:
+            instance_name (str): The instance to install into.
+            package (golddust.packages.Package): The package to install. If
+                it has no `digest`, its `tarball` alias is looked up.
+
+        Raises:
+            KeyError: The package's archive isn't in the package cache.
+            FileExistsError: A file of the package is in the way.
+
+        Returns a tuple of (list of paths written, list of paths removed),
+        relative to the instance.
+        """
+        from golddust import manifest, metrics
+
+        digest = package.digest or self.package_cache.resolve(package.tarball)
+        if not digest:
+            raise KeyError("{} is not in the package cache."
+                           .format(package.tarball))
+
+        with self.lock_instance(instance_name), \
+                self.package_cache.lock(digest), \
+                metrics.span("install", package=package.name,
+                             instance=instance_name) as span:
+            instance_config = self.load_instance(instance_name)
+            files, written, removed = manifest.sync_package(
+                self.package_cache, digest, instance_config.path,
+                package.name, self.instances.files(instance_name))
+            self.instances.record_package(instance_name, package.name,
+                                          package.version, digest, files)
+            span.set(written=len(written), removed=len(removed))
+        return written, removed
+
+    def uninstall_package(self, instance_name, package_name):
+        """Remove a package's files from an instance.
+
+        Takes:
+            instance_name (str): The instance to remove the package from.
+            package_name (str): The name of the installed package.
+
+        Raises:
+            KeyError: The package isn't installed in the instance.
+
+        Returns a list of the removed paths, relative to the instance.
+        """
+        from golddust import manifest
+
+        with self.lock_instance(instance_name):
+            instance_config = self.load_instance(instance_name)
+            if package_name not in instance_config.packages:
+                raise KeyError("{} is not installed in {}."
+                               .format(package_name, instance_name))
+            removed = manifest.remove_package(
+                instance_config.path, package_name,
+                self.instances.files(instance_name))
+            self.instances.forget_package(instance_name, package_name)
+        return removed
+
+    def verify_instance(self, instance_name, repair=False, full=False,
+                        workers=None, repo=None, bundle=None):
+        """Check that an instance's installed files match what was
+        installed, and optionally repair them.
+
+        Files whose size and mtime are unchanged are skipped unless `full`;
+        see golddust.manifest.check_files. Intact files whose mtime changed
+        get their records updated, so the next check skips them.
+
+        Takes:
+            instance_name (str): The instance to check.
+            repair (bool): Put intact copies of damaged or missing files
+                           back from the package cache.
+            full (bool): Hash every file.
+            workers (int): Threads hashing files.
+            repo (str): The repository `bundle` is in.
+            bundle (str): A repository bundle (see golddust.bundle) to
+                fetch files that can't be repaired from the package cache
+                from, one at a time.
+
+        Returns a tuple of (dict of "missing" or "modified" by path of the
+        damaged files, list of the paths repaired). Files of packages no
+        longer in the package cache (or `bundle`) can't be repaired.
+        """
+        from golddust import manifest, metrics
+        from golddust.locks import MultiLock
+
+        with self.lock_instance(instance_name, shared=not repair), \
+                metrics.span("verify_instance",
+                             instance=instance_name) as span:
+            instance_config = self.load_instance(instance_name)
+            installed = self.instances.files(instance_name)
+            problems, stamps = manifest.check_files(
+                instance_config.path, installed, workers, full)
+            repaired = {}
+            if repair and problems:
+                digests = {package: info["digest"] for package, info
+                           in self.instances.packages(instance_name).items()}
+                used = {digests.get(installed[path]["package"])
+                        for path in problems}
+                with MultiLock(self.package_cache.lock(digest)
+                               for digest in used if digest):
+                    if bundle is None:
+                        repaired = manifest.repair_files(
+                            self.package_cache, instance_config.path,
+                            installed, digests, problems)
+                    else:
+                        repaired = self._repair_from_bundle(
+                            repo, bundle, instance_config.path, installed,
+                            digests, problems)
+                stamps.update(repaired)
+            if stamps:
+                self.instances.restamp(instance_name, stamps)
+            span.set(files=len(installed), problems=len(problems),
+                     repaired=len(repaired))
+        return problems, sorted(repaired)
+
+    def _repair_from_bundle(self, repo, bundle, dest, installed, digests,
+                            paths):
+        """Repair files like golddust.manifest.repair_files, fetching what
+        the package cache lacks from a bundle.
+
+        Packages with no tree or archive in the cache are fetched from the
+        bundle whole; damaged tree files with no cached archive are fetched
+        one at a time. The caller holds the packages' cache entry locks.
+
+        Returns what golddust.manifest.repair_files does.
+        """
+        from golddust import manifest, signify
+        from golddust.bundle import BundleIndex
+
+        repository = self.config.get_repository(repo)
+        if not repository.get("public_key"):
+            raise KeyError("Repository has no public key configured.")
+        public_key = signify.PublicKey.from_string(repository["public_key"])
+
+        cache = self.package_cache
+        with self.downloader(repo) as downloader:
+            index = BundleIndex.fetch(downloader, bundle, public_key)
+            missing = []
+            for rel_path in paths:
+                package_name = installed[rel_path]["package"]
+                digest = digests.get(package_name)
+                if not digest or cache.has_tree(digest) \
+                        or cache.has_archive(digest) \
+                        or index.owner(digest) != package_name:
+                    continue
+                package = index.package(package_name)
+                package.digest = digest
+                if package.name not in {other.name for other in missing}:
+                    missing.append(package)
+            index.extract_packages(downloader, cache, missing)
+            for package in missing:
+                cache.mark_verified(package.digest, public_key.key)
+
+            return manifest.repair_files(
+                cache, dest, installed, digests, paths,
+                fetch=lambda digest, names: index.restore(
+                    downloader, cache, digest, names))
+
+    def batch(self):
+        """Start a multi-instance transaction.
+
+        Returns a golddust.batch.Batch; add instance plans to it and call
+        its `apply`.
+        """
+        from golddust.batch import Batch
+
+        return Batch(self)
+
+    def compose_jar(self, instance_name, base_jar, jar_path, packages):
+        """Build an instance's game JAR with every package's JAR mods.
+
+        The `munge_jar` of each package's install script is applied, in
+        order, in a single pass over `base_jar`. Instances with the same
+        base JAR and JAR mods reuse the same cached result.
+
+        Takes:
+            instance_name (str): The instance to build the JAR for.
+            base_jar (str): The unmodified game JAR.
+            jar_path (str): Where the JAR goes, relative to the instance.
+            packages (list of golddust.packages.Package): The packages
+                installed in the instance, in install order (such as a
+                golddust.resolver plan). Packages without a script that
+                munges the JAR are skipped.
+
+        Raises:
+            KeyError: A package's archive isn't in the package cache.
+
+        Returns str, the path of the instance's JAR.
+        """
+        from golddust import jars
+        from golddust.locks import MultiLock
+        from golddust.packages import load_install_script
+
+        digests = []
+        for package in packages:
+            digest = (package.digest
+                      or self.package_cache.resolve(package.tarball))
+            if not digest:
+                raise KeyError("{} is not in the package cache."
+                               .format(package.tarball))
+            digests.append(digest)
+
+        with self.lock_instance(instance_name), \
+                MultiLock(self.package_cache.lock(digest)
+                          for digest in set(digests)):
+            contributions = []
+            for digest in digests:
+                script = load_install_script(
+                    self.package_cache.extract(digest))
+                if script is not None and script.munges_jar():
+                    contributions.append((digest, script))
+
+            instance_config = self.load_instance(instance_name)
+            dest = os.path.join(instance_config.path, jar_path)
+            key = jars.compose_jar(self.package_cache, base_jar, dest,
+                                   contributions)
+            instance_config.jar = {"path": jar_path, "key": key}
+            instance_config.save()
+        return dest
+
+    def export_instances(self, instance_names, repo, fileobj):
+        """Write instances and everything needed to recreate them to an
+        export stream (see golddust.export), for `import_instances` on
+        hosts that can't reach the repository.
+
+        Packages whose archive or signature isn't in the package cache
+        (such as ones fetched from a bundle) are fetched from the
+        repository first.
+
+        Takes:
+            instance_names (list of str): The instances to export.
+            repo (str): The repository their packages came from. Its local
+                        index copy (see `repository_index`) must list them.
+            fileobj (file-like): The binary file or stream to write to.
+
+        Raises:
+            KeyError: An instance doesn't exist, the repository has no
+                      public key, or a package isn't in its index.
+            golddust.download.DownloadError: A missing archive couldn't be
+                                             downloaded.
+            golddust.signify.BadSignatureError: A downloaded archive's
+                                                signature doesn't match.
+        """
+        from golddust import export, signify
+        from golddust.locks import MultiLock
+
+        repository = self.config.get_repository(repo)
+        if not repository.get("public_key"):
+            raise KeyError("Repository has no public key configured.")
+        public_key = signify.PublicKey.from_string(repository["public_key"])
+        index = self.repository_index(repo)
+        cache = self.package_cache
+
+        with MultiLock(self.lock_instance(name, shared=True)
+                       for name in set(instance_names)):
+            instances = []
+            packages = {}
+            for name in instance_names:
+                instance_config = self.load_instance(name)
+                installed = self.instances.packages(name)
+                for package_name, info in installed.items():
+                    if info["digest"] in packages:
+                        continue
+                    package = index.get(package_name, info["version"])
+                    for codec, archive in package.archives.items():
+                        if archive.get("digest") == info["digest"]:
+                            package.codec, package.digest = \
+                                codec, info["digest"]
+                            break
+                    else:
+                        raise KeyError("{} {} isn't in the index of {}."
+                                       .format(package_name,
+                                               info["version"], repo))
+                    packages[package.digest] = package
+                instances.append({
+                    "config": {key: value for key, value
+                               in instance_config.__dict__.items()
+                               if not key.startswith("_")},
+                    "packages": installed})
+            # Imported JARs live only in their instances.
+            jar_paths = {}
+            for instance in instances:
+                jar = instance["config"].get("jar")
+                if jar and jar["key"] not in jar_paths:
+                    path = cache.jar_path(jar["key"])
+                    if not os.path.isfile(path):
+                        path = os.path.join(instance["config"]["path"],
+                                            jar["path"])
+                    jar_paths[jar["key"]] = path
+            jar_keys = set(jar_paths)
+
+            # Entries already in the cache mustn't be evicted while this
+            # reads them.
+            with MultiLock(cache.lock(key)
+                           for key in set(packages) | jar_keys):
+                lacking = [package for digest, package in packages.items()
+                           if not cache.has_archive(digest)
+                           or cache.signature(digest, public_key.key)
+                           is None]
+                if lacking:
+                    bad = self._fetch_pending(repo, lacking, public_key,
+                                              None)
+                    if bad:
+                        raise signify.BadSignatureError(
+                            "Bad signature for {}.".format(", ".join(bad)))
+                manifest = {
+                    "format": export.FORMAT_VERSION,
+                    "repository": {"name": repo,
+                                   "public_key": repository["public_key"]},
+                    "packages": {digest: {
+                        "name": package.name, "version": package.version,
+                        "codec": package.codec,
+                        "signature": signify.Signature(
+                            public_key.keynum,
+                            cache.signature(digest, public_key.key))
+                        .to_string()} for digest, package in packages.items()},
+                    "jars": {key: export.jar_entry(path)
+                             for key, path in jar_paths.items()},
+                    "instances": instances}
+                export.write_export(fileobj, manifest, cache, jar_paths)
+
+    def import_instances(self, fileobj, public_key=None, dest_dir=None,
+                         workers=None):
+        """Recreate instances from an export stream (see
+        `export_instances`), without any repository access.
+
+        The archives are streamed into the package cache and checked
+        against the public key, then each instance is created and its
+        packages linked in. Its JAR is copied in; nothing but the unsigned
+        manifest vouches for it, so it isn't added to the package cache.
+
+        Takes:
+            fileobj (file-like): The binary file or stream to read.
+            public_key (golddust.signify.PublicKey): The key the archives
+                must be signed with. Defaults to that of the configured
+                repository the export was made from.
+            dest_dir (str): Create each instance's files in a directory of
+                            its name under this, rather than at the path it
+                            had when exported.
+            workers (int): Threads decompressing archives.
+
+        Raises:
+            KeyError: There is no public key to check the archives with.
+            ValueError: The stream isn't a valid export.
+            FileExistsError: An instance name or path is already in use.
+            golddust.signify.BadSignatureError: An archive's signature
+                doesn't match. No instances are created in that case.
+
+        Returns a list of the names of the imported instances.
+        """
+        from golddust import export, signify
+        from golddust.locks import MultiLock
+
+        cache = self.package_cache
+        with export.ExportReader(fileobj) as reader:
+            manifest = reader.manifest
+            if public_key is None:
+                repository = self.config.get_repository(
+                    manifest["repository"]["name"])
+                if not repository.get("public_key"):
+                    raise KeyError("Repository has no public key "
+                                   "configured.")
+                public_key = signify.PublicKey.from_string(
+                    repository["public_key"])
+
+            # Entries already in the cache mustn't be evicted while this
+            # reads them.
+            with MultiLock(cache.lock(key) for key in manifest["packages"]):
+                bad, jar_files = reader.read_into(cache, public_key, workers)
+        try:
+            if bad:
+                raise signify.BadSignatureError(
+                    "Bad signature for {}.".format(", ".join(bad)))
+            return self._create_imported(manifest, jar_files, dest_dir)
+        finally:
+            for jar_path in jar_files.values():
+                os.remove(jar_path)
+
+    def _create_imported(self, manifest, jar_files, dest_dir):
+        """Create the instances of an export manifest from the package
+        cache and staged JAR files; see `import_instances`."""
+        import shutil
+
+        from golddust.packages import Package
+        from golddust.pkgcache import check_inside
+
+        if dest_dir is not None:
+            os.makedirs(dest_dir, exist_ok=True)
+        names = []
+        for instance in manifest["instances"]:
+            config = instance["config"]
+            path = config["path"] if dest_dir is None \
+                else os.path.join(dest_dir, config["name"])
+            self.create_instance(config["name"], config["longname"], path)
+            with self.lock_instance(config["name"]):
+                for package_name, info in sorted(
+                        instance["packages"].items()):
+                    package = Package()
+                    package.name = package_name
+                    package.version = info["version"]
+                    package.digest = info["digest"]
+                    self.install_package(config["name"], package)
+                instance_config = self.load_instance(config["name"])
+                for key, value in config.items():
+                    if key not in ("name", "path", "longname"):
+                        setattr(instance_config, key, value)
+                instance_config.save()
+                if instance_config.jar:
+                    # The JAR is only as trustworthy as the unsigned
+                    # manifest, so every instance gets its own copy.
+                    dest = os.path.join(instance_config.path,
+                                        instance_config.jar["path"])
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    check_inside(instance_config.path, dest)
+                    tmp_path = dest + ".gdtmp"
+                    shutil.copyfile(jar_files[instance_config.jar["key"]],
+                                    tmp_path)
+                    os.replace(tmp_path, dest)
+            names.append(config["name"])
+        return names
 
     def remove_instance(self, instance_name, remove_game_files=False):
         """Removes an instance and (optionally) its game files.
 
         Takes:
-            instance_name (str): The instance name as defined
-                                 in <gdhome>/instances
+            instance_name (str): The instance name.
             remove_game_files (bool): `True` to also delete the game
-                                      installation directory.
+                                      installation directory. Snapshots
+                                      are always deleted.
+
+        Raises:
+            KeyError: There is no such instance.
         """
-        config_file_name = os.path.join(self.root, "instances",
-                                        "{}.json".format(instance_name))
+        import shutil
+        from golddust.snapshots import SnapshotStore
 
-        instance_config = InstanceConfig(config_file_name)
-        instance_config.load()
+        with self.lock_instance(instance_name) as lock:
+            instance_config = self.instances.get(instance_name)
 
-        if remove_game_files:
-            shutil.rmtree(instance_config.path)
+            SnapshotStore(instance_config.path).delete_all()
+            if remove_game_files:
+                shutil.rmtree(instance_config.path)
 
-        os.remove(config_file_name)
+            self.instances.remove(instance_name)
+            lock.remove()
@@ -0,0 +1,276 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust asyncio API
+
+`AsyncGoldDust` drives a GoldDust from an asyncio event loop:
+
+    async with await AsyncGoldDust.open(gdhome) as gdust:
+        plan = await gdust.resolve("main", {"forge": ">=10.13"})
+        await asyncio.gather(*(gdust.provision("main", name, plan)
+                               for name in ("alpha", "beta")))
+
+The blocking work (downloading, verifying, decompressing and extracting
+in golddust.pipeline's single streaming pass, linking files into
+instances, registry writes) runs on an executor, so the event loop is
+never blocked; hashing, decompression and file I/O release the GIL, so
+independent packages really do proceed in parallel on worker threads.
+
+Concurrency is bounded: at most `max_fetches` packages are fetched and
+`max_installs` installs run at once, however many coroutines ask. The
+same package requested by several coroutines is only fetched once, and
+installs into one instance are serialized while installs into different
+instances overlap. `fetch_packages` applies backpressure: it never gets
+more than `max_fetches` packages ahead of its consumer.
+"""
+
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+
+import golddust
+
+
+class AsyncGoldDust:
+    """asyncio interface to a GoldDust.
+
+    Takes:
+        gdust (golddust.GoldDust): The GoldDust to drive. Don't use it
+                                   directly while this is in use.
+        max_fetches (int): Packages fetched at once.
+        max_installs (int): Installs run at once.
+        executor (concurrent.futures.Executor): Where blocking work runs.
+            Defaults to a thread pool big enough for both limits, which
+            `close` shuts down.
+    """
+    def __init__(self, gdust, max_fetches=4, max_installs=4, executor=None):
+        self.gdust = gdust
+        self.max_fetches = max_fetches
+        self.max_installs = max_installs
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_fetches + max_installs + 1)
+        self._fetch_slots = asyncio.Semaphore(max_fetches)
+        self._install_slots = asyncio.Semaphore(max_installs)
+        self._fetching = {}
+        self._refreshing = {}
+        self._instance_locks = collections.defaultdict(asyncio.Lock)
+
+    @classmethod
+    async def open(cls, root, **kwargs):
+        """Load a GoldDust home without blocking the event loop.
+
+        Takes:
+            root (str): The GoldDust home directory.
+            Any other keyword arguments are passed on to `AsyncGoldDust`.
+
+        Returns the AsyncGoldDust.
+        """
+        executor = kwargs.get("executor")
+        loop = asyncio.get_running_loop()
+        gdust = await loop.run_in_executor(executor, golddust.GoldDust, root)
+        return cls(gdust, **kwargs)
+
+    async def close(self):
+        """Close the instance registry and the executor, if it's ours."""
+        await self._run(self.gdust.instances.close)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _run(self, func, *args, **kwargs):
+        """Run a blocking call on the executor.
+
+        Returns an awaitable of its result.
+        """
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    @staticmethod
+    async def _shared(tasks, key, start):
+        """Await the task running under `key`, starting it with `start()` if
+        there is none. Cancelling one waiter doesn't cancel the others'."""
+        task = tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(start())
+            tasks[key] = task
+            task.add_done_callback(lambda _: tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def reload_if_changed(self):
+        """See golddust.GoldDust.reload_if_changed."""
+        await self._run(self.gdust.reload_if_changed)
+
+    async def refresh_repository(self, repo):
+        """Bring the local copy of a repository's index up to date.
+
+        Concurrent calls for the same repository share one refresh.
+
+        Returns the golddust.repoindex.RepositoryIndex; see
+        golddust.GoldDust.refresh_repository.
+        """
+        return await self._shared(
+            self._refreshing, repo,
+            lambda: self._run(self.gdust.refresh_repository, repo))
+
+    async def resolve(self, repo, requirements):
+        """Refresh a repository and resolve requirements against it.
+
+        Takes:
+            repo (str): The repository name.
+            requirements (dict): Version constraints by package name.
+
+        Raises:
+            golddust.resolver.ResolutionError: The requirements can't be
+                                               satisfied.
+
+        Returns the install plan; see golddust.resolver.Resolver.resolve.
+        """
+        from golddust.resolver import Resolver
+
+        index = await self.refresh_repository(repo)
+        return await self._run(Resolver(index).resolve, requirements)
+
+    async def _fetch(self, repo, package):
+        async with self._fetch_slots:
+            await self._run(self.gdust.fetch_package, repo, package)
+        return package.digest
+
+    async def fetch_package(self, repo, package):
+        """Download, verify and extract a package into the package cache.
+
+        Concurrent calls for the same package share one fetch. Sets the
+        package's `digest`; see golddust.GoldDust.fetch_package.
+        """
+        package.digest = await self._shared(
+            self._fetching, (repo, package.tarball),
+            lambda: self._fetch(repo, package))
+
+    async def fetch_packages(self, repo, packages):
+        """Fetch packages concurrently.
+
+        An async iterator of the packages, in the order given, each
+        yielded once it's in the package cache. Fetching never runs more
+        than `max_fetches` packages ahead of the consumer.
+
+        Takes:
+            repo (str): The repository to fetch from.
+            packages (iterable of golddust.packages.Package): The packages.
+        """
+        packages = iter(packages)
+        pending = collections.deque()
+
+        def start_next():
+            package = next(packages, None)
+            if package is not None:
+                pending.append((package, asyncio.ensure_future(
+                    self.fetch_package(repo, package))))
+
+        try:
+            for _ in range(self.max_fetches):
+                start_next()
+            while pending:
+                package, task = pending.popleft()
+                await task
+                start_next()
+                yield package
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def install_package(self, instance_name, package):
+        """Install or upgrade a cached package in an instance.
+
+        Installs into the same instance run one at a time.
+
+        Returns a tuple of (list of paths written, list of paths removed);
+        see golddust.GoldDust.install_package.
+        """
+        async with self._instance_locks[instance_name], self._install_slots:
+            return await self._run(self.gdust.install_package, instance_name,
+                                   package)
+
+    async def uninstall_package(self, instance_name, package_name):
+        """See golddust.GoldDust.uninstall_package."""
+        async with self._instance_locks[instance_name]:
+            return await self._run(self.gdust.uninstall_package,
+                                   instance_name, package_name)
+
+    async def provision(self, repo, instance_name, packages):
+        """Fetch packages and install them into an instance, in order.
+
+        Each package is installed as soon as it has been fetched, while
+        the packages after it are still being fetched.
+
+        Takes:
+            repo (str): The repository to fetch from.
+            instance_name (str): The instance to install into.
+            packages (list of golddust.packages.Package): The packages, in
+                install order (such as a `resolve` plan).
+
+        Returns a list of (written, removed) tuples, one per package.
+        """
+        results = []
+        async for package in self.fetch_packages(repo, packages):
+            results.append(await self.install_package(instance_name,
+                                                      package))
+        return results
+
+    async def create_instance(self, name, longname, path):
+        """See golddust.GoldDust.create_instance."""
+        await self._run(self.gdust.create_instance, name, longname, path)
+
+    async def load_instance(self, instance_name):
+        """See golddust.GoldDust.load_instance."""
+        return await self._run(self.gdust.load_instance, instance_name)
+
+    async def instances(self):
+        """Get the InstanceConfig of every instance."""
+        return await self._run(list, self.gdust.instances)
+
+    async def remove_instance(self, instance_name, remove_game_files=False):
+        """See golddust.GoldDust.remove_instance."""
+        async with self._instance_locks[instance_name]:
+            await self._run(self.gdust.remove_instance, instance_name,
+                            remove_game_files)
+
+    async def apply_batch(self, plans, workers=None):
+        """Apply a multi-instance transaction.
+
+        Takes:
+            plans (dict): (install list, removal list) tuples by instance
+                          name; see golddust.batch.Batch.add.
+            workers (int): Instances staged at once.
+
+        Returns what golddust.batch.Batch.apply does.
+        """
+        locks = [self._instance_locks[name] for name in sorted(plans)]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            batch = self.gdust.batch()
+            for name, (installs, removals) in plans.items():
+                batch.add(name, installs, removals)
+            return await self._run(batch.apply, workers)
+        finally:
+            for lock in locks:
+                lock.release()
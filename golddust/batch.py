@@ -0,0 +1,247 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Batch Transactions
+
+Applies install/upgrade/remove plans to many instances as one
+transaction.
+
+Each instance is first staged in parallel: its directory is cloned next
+to it (see `golddust.pkgcache.clone_tree`), and the plan, including every
+install script's `pre_install` and `post_install`, is applied to the
+clone. Only package files are hardlinked, since GoldDust only ever
+replaces or unlinks them; saves, options and other files an install
+script might write in place are reflinked or copied, so the live instance
+is untouched.
+
+Only when every instance staged successfully are they committed: each
+instance directory is swapped with its staging directory by renames, and
+the registry is updated in a single transaction. If anything fails, the
+swapped directories are renamed back and every staging directory is
+deleted, leaving all instances as they were.
+"""
+
+
+import collections
+import concurrent.futures
+import os
+import shutil
+import tempfile
+
+from golddust import manifest, metrics
+from golddust.locks import MultiLock
+from golddust.packages import load_install_script
+from golddust.pkgcache import clone_tree
+
+
+class BatchError(Exception):
+    """A batch failed and no instance was changed.
+
+    The original exception is chained as `__cause__`.
+
+    Takes:
+        instance (str): The name of the instance that failed to stage, or
+                        None if the commit failed.
+        message (str): The error message.
+    """
+    def __init__(self, instance, message):
+        super().__init__(message)
+        self.instance = instance
+
+
+class _Staged:
+    """An instance staged for commit."""
+    __slots__ = ("name", "path", "staging", "installs", "removals")
+
+    def __init__(self, name, path, staging):
+        self.name = name
+        self.path = path
+        self.staging = staging
+        self.installs = []
+        """(package, version, digest, files) tuples to record."""
+        self.removals = []
+        """Names of packages to forget."""
+
+
+class Batch:
+    """A set of per-instance plans applied as one transaction.
+
+    Takes:
+        golddust (golddust.GoldDust): The GoldDust home to work on.
+    """
+    def __init__(self, golddust):
+        self._golddust = golddust
+        self._plans = collections.OrderedDict()
+
+    def add(self, instance_name, packages=(), remove=()):
+        """Add an instance to the batch.
+
+        Takes:
+            instance_name (str): The instance to change.
+            packages (list of golddust.packages.Package): Packages to
+                install or upgrade, in install order (such as a
+                golddust.resolver plan). They must be in the package cache.
+            remove (list of str): Names of packages to uninstall.
+        """
+        self._plans[instance_name] = (list(packages), list(remove))
+
+    def __len__(self):
+        return len(self._plans)
+
+    def _stage(self, instance_name, packages, remove):
+        gdust = self._golddust
+        cache = gdust.package_cache
+        config = gdust.load_instance(instance_name)
+        installed = gdust.instances.files(instance_name)
+        path = config.path.rstrip(os.sep)
+        staging = tempfile.mkdtemp(
+            prefix=".{}.gdstage-".format(os.path.basename(path)),
+            dir=os.path.dirname(path))
+        staged = _Staged(instance_name, path, staging)
+        try:
+            with metrics.span("batch.clone", instance=instance_name):
+                clone_tree(path, staging, cache.link_mode,
+                           shared=set(installed))
+
+            for package_name in remove:
+                if package_name not in config.packages:
+                    raise KeyError("{} is not installed in {}."
+                                   .format(package_name, instance_name))
+                manifest.remove_package(staging, package_name, installed)
+                installed = {rel_path: entry
+                             for rel_path, entry in installed.items()
+                             if entry["package"] != package_name}
+                staged.removals.append(package_name)
+
+            for package in packages:
+                digest = package.digest or cache.resolve(package.tarball)
+                if not digest:
+                    raise KeyError("{} is not in the package cache."
+                                   .format(package.tarball))
+                current = config.packages.get(package.name)
+                if current and current["digest"] == digest \
+                        and package.name not in remove:
+                    continue
+
+                script = load_install_script(cache.extract(digest))
+                if script is not None:
+                    script.instance_path = staging
+                    with metrics.span("install_script", hook="pre_install",
+                                      package=package.name,
+                                      instance=instance_name):
+                        script.pre_install()
+                with metrics.span("install", package=package.name,
+                                  instance=instance_name) as span:
+                    files, written, removed = manifest.sync_package(
+                        cache, digest, staging, package.name, installed)
+                    span.set(written=len(written), removed=len(removed))
+                if script is not None:
+                    with metrics.span("install_script", hook="post_install",
+                                      package=package.name,
+                                      instance=instance_name):
+                        script.post_install()
+                installed = {rel_path: entry
+                             for rel_path, entry in installed.items()
+                             if entry["package"] != package.name}
+                installed.update(files)
+                staged.installs.append((package.name, package.version,
+                                        digest, files))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return staged
+
+    def _commit(self, staged):
+        swapped = []
+        try:
+            for instance in staged:
+                old_path = instance.staging + "-old"
+                os.rename(instance.path, old_path)
+                try:
+                    os.rename(instance.staging, instance.path)
+                except BaseException:
+                    os.rename(old_path, instance.path)
+                    raise
+                swapped.append((instance, old_path))
+
+            self._golddust.instances.record_batch(
+                [(instance.name,) + install for instance in staged
+                 for install in instance.installs],
+                [(instance.name, package) for instance in staged
+                 for package in instance.removals])
+        except BaseException:
+            for instance, old_path in reversed(swapped):
+                os.rename(instance.path, instance.staging)
+                os.rename(old_path, instance.path)
+            raise
+
+        for _, old_path in swapped:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    def apply(self, workers=None):
+        """Stage every instance in parallel, then commit them all.
+
+        Every instance in the batch is locked exclusively, and the cache
+        entries of the packages shared, until it's done.
+
+        Takes:
+            workers (int): Number of instances staged at once; defaults to
+                           the executor's default.
+
+        Raises:
+            BatchError: An instance failed to stage, or committing failed.
+                        Every instance is left as it was.
+
+        Returns a list of the names of the changed instances.
+        """
+        gdust = self._golddust
+        cache = gdust.package_cache
+        digests = {package.digest or cache.resolve(package.tarball)
+                   for packages, _ in self._plans.values()
+                   for package in packages}
+        with MultiLock([gdust.lock_instance(name) for name in self._plans]
+                       + [cache.lock(digest) for digest in digests
+                          if digest]):
+            return self._apply(workers)
+
+    def _apply(self, workers):
+        staged = []
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(self._stage, name, packages, remove): name
+                       for name, (packages, remove) in self._plans.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    staged.append(future.result())
+                except Exception as err:
+                    if failure is None:
+                        failure = (futures[future], err)
+
+        try:
+            if failure is not None:
+                name, err = failure
+                raise BatchError(name, "Staging {} failed: {}"
+                                 .format(name, err)) from err
+            staged.sort(key=lambda instance: instance.name)
+            try:
+                with metrics.span("batch.commit", instances=len(staged)):
+                    self._commit(staged)
+            except Exception as err:
+                raise BatchError(None, "Commit failed: {}"
+                                 .format(err)) from err
+        finally:
+            for instance in staged:
+                shutil.rmtree(instance.staging, ignore_errors=True)
+        return [instance.name for instance in staged]
@@ -0,0 +1,320 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Package Building
+
+Turns package specification trees (see doc/Packages.md) into signed
+package archives. For each package, the output directory receives one
+archive per requested codec, a detached signature for each archive, and a
+metadata file (`Package.metadata_file`) recording the archives' codecs,
+digests and sizes.
+
+`build_all` builds many packages incrementally: each tree is fingerprinted
+and only packages whose fingerprint changed since the last build into the
+same output directory are rebuilt, across a process pool.
+"""
+
+
+import concurrent.futures
+import json
+import os
+import tarfile
+import tempfile
+
+from golddust.compression import DEFAULT_CODEC, get_codec
+from golddust.packages import Package
+from golddust.pkgcache import file_digest, new_digest
+
+
+SPEC_FILE_NAME = "package.json"
+
+_STATE_FILE_NAME = ".gdmake-state.json"
+
+
+def load_spec(spec_dir):
+    """Read the package.json of a package specification tree.
+
+    Takes:
+        spec_dir (str): The root of the package tree.
+
+    Raises:
+        ValueError: The spec has no name or version.
+
+    Returns the Package described by the spec.
+    """
+    with open(os.path.join(spec_dir, SPEC_FILE_NAME), mode="r") as spec:
+        metadata = json.load(spec)
+    if not metadata.get("name") or not metadata.get("version"):
+        raise ValueError("{} needs a name and version."
+                         .format(os.path.join(spec_dir, SPEC_FILE_NAME)))
+    return Package.from_dict(metadata)
+
+
+def spec_files(spec_dir):
+    """List the files of a package tree in archive order.
+
+    Returns a sorted list of paths relative to `spec_dir`, using "/"
+    separators.
+    """
+    files = []
+    for dir_path, dir_names, file_names in os.walk(spec_dir):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, spec_dir)
+        for file_name in file_names:
+            rel_path = os.path.normpath(os.path.join(rel_dir, file_name))
+            files.append(rel_path.replace(os.sep, "/"))
+    return sorted(files)
+
+
+def _normalize(tarinfo):
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+
+def write_tar(spec_dir, fileobj):
+    """Write a package tree as an uncompressed tar stream.
+
+    Members are written in a stable order with ownership stripped, so the
+    same tree always produces the same archive.
+
+    Takes:
+        spec_dir (str): The root of the package tree.
+        fileobj (file-like): The binary file to write to.
+    """
+    with tarfile.open(fileobj=fileobj, mode="w|",
+                      format=tarfile.PAX_FORMAT) as tar:
+        for rel_path in spec_files(spec_dir):
+            tar.add(os.path.join(spec_dir, rel_path), arcname=rel_path,
+                    recursive=False, filter=_normalize)
+
+
+def build_package(spec_dir, out_dir, codecs=(DEFAULT_CODEC,),
+                  secret_key=None, level=None):
+    """Build the archives of a package.
+
+    Takes:
+        spec_dir (str): The root of the package tree.
+        out_dir (str): The directory to write archives and metadata to.
+        codecs (list of str): The codecs to build archives with.
+        secret_key (golddust.signify.SecretKey): The key to sign archives
+                                                 with, or None to skip
+                                                 signing.
+        level (int): Codec compression level, or None for the default.
+
+    Raises:
+        ValueError: The spec is invalid, or two codecs share a file name.
+
+    Returns the built Package, with `archives` filled in.
+    """
+    package = load_spec(spec_dir)
+    package.archives = {}
+    tarballs = set()
+
+    for codec_name in codecs:
+        codec = get_codec(codec_name)
+        package.codec = codec_name
+        if package.tarball in tarballs:
+            raise ValueError("Codecs {} would overwrite each other."
+                             .format(", ".join(codecs)))
+        tarballs.add(package.tarball)
+
+        target = os.path.join(out_dir, package.tarball)
+        fd, tmp_path = tempfile.mkstemp(dir=out_dir)
+        try:
+            with os.fdopen(fd, mode="wb") as archive:
+                with codec.open_writer(archive, level) as compressed:
+                    write_tar(spec_dir, compressed)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        package.archives[codec_name] = {"digest": file_digest(target),
+                                        "size": os.path.getsize(target)}
+        if secret_key is not None:
+            signature = secret_key.sign_file(target)
+            with open(os.path.join(out_dir, package.sig_file),
+                      mode="w") as sig_file:
+                sig_file.write(signature.to_string())
+
+    package.codec = None
+    with open(os.path.join(out_dir, package.metadata_file),
+              mode="w") as metadata:
+        json.dump(package.to_dict(), metadata, sort_keys=True, indent=4)
+    return package
+
+
+def find_specs(paths):
+    """Find the package specification trees under some paths.
+
+    A path containing a package.json is a spec itself. Otherwise each of
+    its subdirectories containing a package.json is a spec.
+
+    Returns a list of spec directory paths.
+    """
+    specs = []
+    for path in paths:
+        if os.path.isfile(os.path.join(path, SPEC_FILE_NAME)):
+            specs.append(path)
+            continue
+        for entry in sorted(os.listdir(path)):
+            candidate = os.path.join(path, entry)
+            if os.path.isfile(os.path.join(candidate, SPEC_FILE_NAME)):
+                specs.append(candidate)
+    return specs
+
+
+def fingerprint(spec_dir, options, known_files=None):
+    """Fingerprint a package tree and the options it is built with.
+
+    File contents are only hashed when their size or mtime differ from
+    `known_files`, so fingerprinting an unchanged tree is mostly stat calls.
+
+    Takes:
+        spec_dir (str): The root of the package tree.
+        options (dict): Build options that affect the output.
+        known_files (dict): The file table of a previous fingerprint.
+
+    Returns a tuple of (fingerprint str, file table dict). The file table
+    maps each relative path to [size, mtime_ns, digest].
+    """
+    known_files = known_files or {}
+    digest = new_digest()
+    digest.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    files = {}
+    for rel_path in spec_files(spec_dir):
+        stat = os.stat(os.path.join(spec_dir, rel_path))
+        known = known_files.get(rel_path)
+        if known and known[0] == stat.st_size \
+                and known[1] == stat.st_mtime_ns:
+            content = known[2]
+        else:
+            content = file_digest(os.path.join(spec_dir, rel_path))
+        files[rel_path] = [stat.st_size, stat.st_mtime_ns, content]
+        digest.update("{}\0{:o}\0{}\0".format(rel_path, stat.st_mode & 0o777,
+                                              content).encode("utf-8"))
+    return digest.hexdigest(), files
+
+
+class BuildState:
+    """Fingerprints of the packages last built into an output directory.
+
+    Takes:
+        out_dir (str): The build output directory the state belongs to.
+    """
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, _STATE_FILE_NAME)
+        """The path of the state file."""
+        self.packages = {}
+        """Build records by absolute spec path. Each is a dict with the
+        "fingerprint", the "files" table and the "outputs" file names."""
+
+    def load(self):
+        """Load the state, if there is any."""
+        try:
+            with open(self.path, mode="r") as state_file:
+                self.packages = json.load(state_file)
+        except FileNotFoundError:
+            self.packages = {}
+
+    def save(self):
+        """Save the state."""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, mode="w") as state_file:
+            json.dump(self.packages, state_file, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, spec_dir, fingerprint_):
+        """Check whether a spec's last build matches a fingerprint and its
+        outputs are all still there."""
+        record = self.packages.get(os.path.abspath(spec_dir))
+        if not record or record["fingerprint"] != fingerprint_:
+            return False
+        out_dir = os.path.dirname(self.path)
+        return all(os.path.isfile(os.path.join(out_dir, output))
+                   for output in record["outputs"])
+
+
+def _outputs(package, signed):
+    outputs = [package.metadata_file]
+    for codec in sorted(package.archives):
+        package.codec = codec
+        outputs.append(package.tarball)
+        if signed:
+            outputs.append(package.sig_file)
+    package.codec = None
+    return outputs
+
+
+def build_all(spec_dirs, out_dir, codecs=(DEFAULT_CODEC,), secret_key=None,
+              level=None, jobs=None, force=False):
+    """Build the outdated packages out of many specs.
+
+    Packages whose tree and build options haven't changed since they were
+    last built into `out_dir` are skipped. The rest are built in parallel
+    worker processes.
+
+    Takes:
+        spec_dirs (list of str): The package trees to build.
+        out_dir (str): The directory to write archives and metadata to.
+        codecs (list of str): The codecs to build archives with.
+        secret_key (golddust.signify.SecretKey): The key to sign with, or
+                                                 None to skip signing.
+        level (int): Codec compression level, or None for the default.
+        jobs (int): Number of worker processes; defaults to the CPU count.
+        force (bool): Rebuild every package, even if it's current.
+
+    Returns a tuple of (list of built Packages, list of skipped spec
+    directories).
+    """
+    state = BuildState(out_dir)
+    state.load()
+    options = {"codecs": list(codecs), "level": level,
+               "key": secret_key.keynum.hex() if secret_key else None}
+
+    outdated = []
+    skipped = []
+    for spec_dir in spec_dirs:
+        key = os.path.abspath(spec_dir)
+        previous = state.packages.get(key, {})
+        spec_fingerprint, files = fingerprint(spec_dir, options,
+                                              previous.get("files"))
+        if not force and state.is_current(spec_dir, spec_fingerprint):
+            skipped.append(spec_dir)
+        else:
+            outdated.append((key, spec_fingerprint, files))
+
+    built = []
+    if not outdated:
+        return built, skipped
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            futures = {pool.submit(build_package, key, out_dir, codecs,
+                                   secret_key, level): (key, fp, files)
+                       for key, fp, files in outdated}
+            for future in concurrent.futures.as_completed(futures):
+                key, spec_fingerprint, files = futures[future]
+                package = future.result()
+                built.append(package)
+                state.packages[key] = {
+                    "fingerprint": spec_fingerprint,
+                    "files": files,
+                    "outputs": _outputs(package, secret_key is not None),
+                }
+    finally:
+        state.save()
+    return built, skipped
@@ -0,0 +1,610 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Seekable Bundles
+
+A package archive is a single compressed tar stream, so getting one file
+out of it means downloading and decompressing everything before that
+file. A bundle packs the files of many packages (such as a whole modpack)
+into independently compressed chunks, with a signed index of where every
+file is, so a client can fetch just the chunks it needs with range
+requests: one mod out of a pack, or one damaged file during a repair.
+
+Repository layout:
+    <repo>/bundles/
+      <name>.gdbundle           The compressed chunks, back to back.
+      <name>.gdbundle.idx       The index, as gzipped canonical JSON.
+      <name>.gdbundle.idx.sig   Signature of the index, if signed.
+
+The index records the bundle's codec, each chunk's (offset, compressed
+length, uncompressed size), and for each package its metadata (see
+`Package.to_dict`) and its files: (segments, size, digest) by path. The
+segments are (chunk, offset and size within the chunk's uncompressed
+data) in file order; a file larger than a chunk is split over several,
+so it is never held in memory whole and can be fetched a chunk at a
+time. Empty files have no segments. A chunk only holds files of one
+package, so a package never costs more than its own chunks. Symbolic
+links are listed by target.
+
+Every file read from a bundle is checked against the digest in the
+index, and the index against its signature, so the bundle itself needs
+no signature.
+"""
+
+
+import collections
+import concurrent.futures
+import io
+import os
+import posixpath
+import tempfile
+
+from golddust import metrics, repoindex
+from golddust.compression import DEFAULT_CODEC, get_codec
+from golddust.packages import Package
+from golddust.pkgcache import check_inside, check_member, new_digest
+
+
+BUNDLE_DIR_NAME = "bundles"
+
+FORMAT_VERSION = 2
+
+CHUNK_SIZE = 1024 * 1024
+"""Default uncompressed size a chunk is filled to."""
+
+_MAX_GAP = 64 * 1024
+"""Chunks closer than this are fetched with one range request."""
+
+
+def bundle_path(name):
+    """The path of a bundle relative to the repository root."""
+    return "{}/{}.gdbundle".format(BUNDLE_DIR_NAME, name)
+
+
+def index_path(name):
+    """The path of a bundle's index relative to the repository root."""
+    return bundle_path(name) + ".idx"
+
+
+def _normalize(name):
+    """Normalize an archive member path, rejecting unsafe ones."""
+    name = posixpath.normpath(name.replace("\\", "/"))
+    if name.startswith("/") or name == ".." or name.startswith("../"):
+        raise ValueError("Unsafe path in bundle: {}".format(name))
+    return name
+
+
+class BundleWriter:
+    """Writes the chunks of a bundle and builds its index.
+
+    Chunks are compressed on a pool of threads (the codecs release the
+    GIL) and written in order.
+
+    Takes:
+        fileobj (file-like): The binary file to write the chunks to.
+        codec (str): The codec to compress chunks with (see
+                     golddust.compression).
+        level (int): Codec compression level, or None for the default.
+        chunk_size (int): Uncompressed bytes a chunk is filled to. Files
+                          larger than this are split over several chunks.
+        workers (int): Threads compressing chunks. Defaults to the number
+                       of CPUs.
+    """
+    def __init__(self, fileobj, codec=DEFAULT_CODEC, level=None,
+                 chunk_size=CHUNK_SIZE, workers=None):
+        self.fileobj = fileobj
+        self.codec = get_codec(codec)
+        self.level = level
+        self.chunk_size = chunk_size
+        self.chunks = []
+        """(offset, length, size) of each written chunk."""
+        self.packages = {}
+        """Bundle index entries by package name."""
+        self._workers = workers or os.cpu_count() or 1
+        self._pool = concurrent.futures.ThreadPoolExecutor(self._workers)
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._offset = 0
+
+    def close(self):
+        """Stop the compression threads."""
+        for future, _ in self._pending:
+            future.cancel()
+        self._pool.shutdown()
+
+    def _compress(self, data):
+        compressed = io.BytesIO()
+        with self.codec.open_writer(compressed, self.level) as writer:
+            writer.write(data)
+        return compressed.getvalue()
+
+    def _write_next(self):
+        future, size = self._pending.popleft()
+        compressed = future.result()
+        self.fileobj.write(compressed)
+        self.chunks.append((self._offset, len(compressed), size))
+        self._offset += len(compressed)
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        data = b"".join(self._buffer)
+        self._pending.append((self._pool.submit(self._compress, data),
+                              len(data)))
+        self._buffer = []
+        self._buffered = 0
+        # Don't hold more than a few chunks per thread in memory.
+        while len(self._pending) > 2 * self._workers:
+            self._write_next()
+
+    def _add_data(self, data, segments):
+        """Buffer the next piece of a file's contents, starting new chunks
+        as they fill up.
+
+        Appends (chunk number, offset in the chunk, size) segments to
+        `segments`, extending the last one where the piece continues it.
+        """
+        while data:
+            if self._buffered >= self.chunk_size:
+                self._flush()
+            piece = data[:self.chunk_size - self._buffered]
+            data = data[len(piece):]
+            chunk = len(self.chunks) + len(self._pending)
+            if segments and segments[-1][0] == chunk \
+                    and sum(segments[-1][1:]) == self._buffered:
+                segments[-1][2] += len(piece)
+            else:
+                segments.append([chunk, self._buffered, len(piece)])
+            self._buffer.append(piece)
+            self._buffered += len(piece)
+
+    def add_package(self, package, tar_stream):
+        """Add the contents of a package archive.
+
+        Takes:
+            package (golddust.packages.Package): The package.
+            tar_stream (file-like): The archive's uncompressed tar stream.
+
+        Raises:
+            ValueError: The package is already in the bundle, or the
+                        archive has unsafe members or hard links.
+        """
+        # Only needed when building bundles.
+        import tarfile
+
+        if package.name in self.packages:
+            raise ValueError("{} is already in the bundle."
+                             .format(package.name))
+        files = {}
+        links = {}
+        with tarfile.open(fileobj=tar_stream, mode="r|") as tar:
+            for member in tar:
+                check_member(member)
+                name = _normalize(member.name)
+                if member.isdir():
+                    continue
+                if member.issym():
+                    links[name] = member.linkname
+                    continue
+                if not member.isfile():
+                    raise ValueError("{} has an unsupported member: {}"
+                                     .format(package.tarball, member.name))
+                # Files that fit in a chunk are kept in one, so fetching
+                # one costs a single chunk.
+                if self._buffered \
+                        and self._buffered + member.size > self.chunk_size:
+                    self._flush()
+                segments = []
+                digest = new_digest()
+                reader = tar.extractfile(member)
+                for data in iter(lambda: reader.read(self.chunk_size), b""):
+                    digest.update(data)
+                    self._add_data(data, segments)
+                files[name] = [segments, member.size, digest.hexdigest()]
+        self._flush()
+        entry = {"metadata": package.to_dict(), "files": files}
+        if links:
+            entry["links"] = links
+        self.packages[package.name] = entry
+
+    def index(self):
+        """Finish the chunks and get the index document."""
+        self._flush()
+        while self._pending:
+            self._write_next()
+        return {"format": FORMAT_VERSION, "codec": self.codec.name,
+                "chunks": self.chunks, "packages": self.packages}
+
+
+def _write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, mode="wb") as output:
+        output.write(data)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def write_bundle(repo_dir, name, packages, secret_key=None,
+                 codec=DEFAULT_CODEC, level=None, chunk_size=CHUNK_SIZE):
+    """Bundle some of a repository's packages.
+
+    Each package's contents are read from its archive in the repository
+    (whichever codec it was built with), so the files are exactly those
+    clients would install from the archive.
+
+    Takes:
+        repo_dir (str): The repository root, containing gdmake output.
+        name (str): The bundle name.
+        packages (list of golddust.packages.Package): The packages, with
+            `archives` filled in (as from golddust.repoindex).
+        secret_key (golddust.signify.SecretKey): Key to sign the index with,
+                                                 or None to leave it
+                                                 unsigned.
+        codec (str): The codec to compress chunks with.
+        level (int): Codec compression level, or None for the default.
+        chunk_size (int): Uncompressed bytes a chunk is filled to.
+
+    Returns BundleIndex, the written index.
+    """
+    from golddust.compression import open_archive_reader
+
+    target = os.path.join(repo_dir, *bundle_path(name).split("/"))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, mode="wb") as output:
+            writer = BundleWriter(output, codec, level, chunk_size)
+            try:
+                for package in packages:
+                    with metrics.span("bundle.add", package=package.name), \
+                            open(os.path.join(repo_dir, package.tarball),
+                                 mode="rb") as archive, \
+                            open_archive_reader(archive) as tar_stream:
+                        writer.add_package(package, tar_stream)
+                document = writer.index()
+            finally:
+                writer.close()
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, target)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    # The signature goes first, as with the repository index head, so a
+    # client reading mid-update gets a mismatch rather than a stale pair.
+    index_data = repoindex.encode(document)
+    index_target = os.path.join(repo_dir, *index_path(name).split("/"))
+    if secret_key is not None:
+        signature = secret_key.sign(lambda: (index_data,))
+        _write(index_target + ".sig", signature.to_string().encode("ascii"))
+    _write(index_target, index_data)
+    return BundleIndex(name, document)
+
+
+class BundleIndex:
+    """The index of a bundle.
+
+    Takes:
+        name (str): The bundle name.
+        document (dict): The index document.
+
+    Raises:
+        ValueError: The document is in an unsupported format.
+    """
+    def __init__(self, name, document):
+        if document.get("format") != FORMAT_VERSION:
+            raise ValueError("Unsupported bundle format.")
+        self.name = name
+        self.codec = get_codec(document["codec"])
+        self.chunks = document["chunks"]
+        self.packages = document["packages"]
+
+    @classmethod
+    def fetch(cls, downloader, name, public_key=None):
+        """Download a bundle's index and check its signature.
+
+        Takes:
+            downloader (golddust.download.Downloader): The repository's
+                                                       mirrors.
+            name (str): The bundle name.
+            public_key (golddust.signify.PublicKey): The key the index must
+                be signed with, or None to skip the check.
+
+        Raises:
+            golddust.download.DownloadError: The index couldn't be fetched.
+            golddust.signify.BadSignatureError: The signature doesn't
+                                                match.
+
+        Returns the BundleIndex.
+        """
+        from golddust import signify
+
+        with downloader.open(index_path(name)) as stream:
+            data = stream.read()
+        if public_key is not None:
+            with downloader.open(index_path(name) + ".sig") as stream:
+                signature = signify.Signature.from_string(
+                    stream.read().decode("ascii"))
+            verifier = signature.verifier(public_key)
+            verifier.update(data)
+            if not verifier.verify():
+                raise signify.BadSignatureError(
+                    "Bad signature for bundle {}.".format(name))
+        return cls(name, repoindex.decode(data))
+
+    def __contains__(self, package_name):
+        return package_name in self.packages
+
+    def package(self, package_name):
+        """Get a bundled package.
+
+        Raises:
+            KeyError: The package isn't in the bundle.
+
+        Returns a golddust.packages.Package.
+        """
+        return Package.from_dict(self.packages[package_name]["metadata"])
+
+    def has(self, package):
+        """Check whether the bundle holds the same build of a package.
+
+        Takes:
+            package (golddust.packages.Package): The package, such as from
+                the repository index.
+        """
+        entry = self.packages.get(package.name)
+        return entry is not None \
+            and entry["metadata"]["version"] == package.version \
+            and entry["metadata"]["archives"] == package.archives
+
+    def owner(self, digest):
+        """Find the bundled package one of whose archives has a digest.
+
+        Returns str, the package name, or None.
+        """
+        for package_name, entry in self.packages.items():
+            if any(archive.get("digest") == digest for archive
+                   in entry["metadata"]["archives"].values()):
+                return package_name
+        return None
+
+    def files(self, package_name):
+        """Get the file paths of a bundled package."""
+        return list(self.packages[package_name]["files"])
+
+    def links(self, package_name):
+        """Get the symbolic links of a bundled package: targets by path."""
+        return dict(self.packages[package_name].get("links", {}))
+
+    def ranges(self, chunk_numbers):
+        """Plan the range requests fetching some chunks.
+
+        Chunks that are adjacent, or nearly so, are fetched together.
+
+        Returns a list of (start, end) byte ranges, `end` exclusive.
+        """
+        ranges = []
+        for number in sorted(set(chunk_numbers)):
+            offset, length, _ = self.chunks[number]
+            if ranges and offset - ranges[-1][1] <= _MAX_GAP:
+                ranges[-1][1] = offset + length
+            else:
+                ranges.append([offset, offset + length])
+        return [tuple(byte_range) for byte_range in ranges]
+
+    def read_files(self, downloader, wanted, scratch_path):
+        """Download some bundled files.
+
+        Only the chunks holding them are fetched, and every file is checked
+        against its digest.
+
+        Takes:
+            downloader (golddust.download.Downloader): The repository's
+                                                       mirrors.
+            wanted (dict): Lists of the paths wanted, or None for every
+                           file, by package name.
+            scratch_path (str): An existing file to fetch chunks into. It
+                                is left sparse.
+
+        Raises:
+            KeyError: A package or path isn't in the bundle.
+            golddust.download.DownloadError: A chunk couldn't be fetched.
+            ValueError: A chunk or file is corrupt.
+
+        Yields (package name, path, bytes, last) for each piece of each
+        file, a chunk at a time. A file's pieces come in order, one after
+        the other; `last` is True for the final piece, which is only
+        yielded once the whole file has matched its digest.
+        """
+        by_chunk = {}
+        empty = []
+        for package_name, paths in wanted.items():
+            files = self.packages[package_name]["files"]
+            for path in (files if paths is None else paths):
+                segments, _, expected = files[path]
+                if not segments:
+                    empty.append((package_name, _normalize(path)))
+                    continue
+                # Files are laid out one after another, so sorting by
+                # chunk and offset keeps each file's pieces together.
+                for number, (chunk, start, size) in enumerate(segments):
+                    last = number == len(segments) - 1
+                    by_chunk.setdefault(chunk, []).append(
+                        (start, size, package_name, _normalize(path),
+                         expected if last else None))
+
+        for package_name, path in empty:
+            yield package_name, path, b"", True
+
+        ranges = self.ranges(by_chunk)
+        with metrics.span("bundle.fetch", bundle=self.name,
+                          chunks=len(by_chunk),
+                          bytes=sum(end - start for start, end in ranges)):
+            downloader.fetch_ranges(bundle_path(self.name), scratch_path,
+                                    ranges)
+
+        digest = None
+        with open(scratch_path, mode="rb") as scratch:
+            for number in sorted(by_chunk):
+                offset, length, size = self.chunks[number]
+                scratch.seek(offset)
+                try:
+                    with self.codec.open_reader(
+                            io.BytesIO(scratch.read(length))) as reader:
+                        # One byte more than expected reveals an oversized
+                        # chunk without decompressing all of it.
+                        data = reader.read(size + 1)
+                except Exception as err:
+                    # Each codec has its own errors for bad data.
+                    raise ValueError("Chunk {} of bundle {} is corrupt: {}"
+                                     .format(number, self.name, err)) from err
+                if len(data) != size:
+                    raise ValueError("Chunk {} of bundle {} is corrupt."
+                                     .format(number, self.name))
+                for start, piece_size, package_name, path, expected \
+                        in sorted(by_chunk[number]):
+                    contents = data[start:start + piece_size]
+                    if digest is None:
+                        digest = new_digest()
+                    digest.update(contents)
+                    if expected is None:
+                        yield package_name, path, contents, False
+                        continue
+                    if digest.hexdigest() != expected:
+                        raise ValueError("{} of {} in bundle {} is corrupt."
+                                         .format(path, package_name,
+                                                 self.name))
+                    digest = None
+                    yield package_name, path, contents, True
+
+    def _scratch(self, cache):
+        """Create an empty file in the cache's staging area to fetch chunks
+        into.
+
+        Returns str, its path.
+        """
+        scratch, path = cache.make_staging_file()
+        scratch.close()
+        return path
+
+    def extract_packages(self, downloader, cache, packages):
+        """Put bundled packages' trees into a package cache.
+
+        The trees are built from the bundled files, without archives.
+
+        Takes:
+            downloader (golddust.download.Downloader): The repository's
+                                                       mirrors.
+            cache (golddust.pkgcache.PackageCache): The package cache.
+            packages (list of golddust.packages.Package): The packages.
+                Their trees are stored under their `digest`s.
+
+        Raises:
+            KeyError: A package isn't in the bundle.
+            golddust.download.DownloadError: A chunk couldn't be fetched.
+            ValueError: A chunk or file is corrupt, or a link leads out of
+                        its package.
+        """
+        import shutil
+
+        staging = {}
+        scratch_path = self._scratch(cache)
+        try:
+            for package in packages:
+                staging[package.name] = cache.make_staging_dir()
+            output = None
+            try:
+                for package_name, path, contents, last in self.read_files(
+                        downloader, dict.fromkeys(staging), scratch_path):
+                    if output is None:
+                        target = os.path.join(staging[package_name],
+                                              *_normalize(path).split("/"))
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        output = open(target, mode="wb")
+                    output.write(contents)
+                    if last:
+                        output.close()
+                        output = None
+            finally:
+                if output is not None:
+                    output.close()
+            for package in packages:
+                links = []
+                for path, link_target in self.links(package.name).items():
+                    target = os.path.join(staging[package.name],
+                                          *_normalize(path).split("/"))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    check_inside(staging[package.name],
+                                 os.path.dirname(target))
+                    os.symlink(link_target, target)
+                    links.append(target)
+                # Only once every link is in place is it known where each
+                # one leads.
+                for target in links:
+                    check_inside(staging[package.name], target)
+                cache.commit_tree(staging.pop(package.name), package.digest)
+                cache.set_alias(package.tarball, package.digest)
+        finally:
+            os.remove(scratch_path)
+            for staging_dir in staging.values():
+                shutil.rmtree(staging_dir)
+
+    def restore(self, downloader, cache, digest, names):
+        """Fetch some files of a cached tree from the bundle again,
+        replacing whatever is there.
+
+        This is `golddust.pkgcache.PackageCache.restore` for trees whose
+        archive isn't cached, such as trees extracted from bundles.
+
+        Takes:
+            downloader (golddust.download.Downloader): The repository's
+                                                       mirrors.
+            cache (golddust.pkgcache.PackageCache): The package cache.
+            digest (str): The archive digest the tree is stored under.
+            names (iterable of str): Paths in the tree, using "/"
+                                     separators.
+
+        Returns a set of the names that were found in the bundle.
+        """
+        package_name = self.owner(digest)
+        if package_name is None:
+            return set()
+        files = self.packages[package_name]["files"]
+        wanted = [name for name in names if name in files]
+        tree = cache.tree_path(digest)
+        scratch_path = self._scratch(cache)
+        output = tmp_path = None
+        try:
+            for _, path, contents, last in self.read_files(
+                    downloader, {package_name: wanted}, scratch_path):
+                if output is None:
+                    output, tmp_path = cache.make_staging_file()
+                output.write(contents)
+                if not last:
+                    continue
+                output.close()
+                output = None
+                os.chmod(tmp_path, 0o644)
+                target = os.path.join(tree, *_normalize(path).split("/"))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                check_inside(tree, target)
+                os.replace(tmp_path, target)
+        finally:
+            os.remove(scratch_path)
+            if output is not None:
+                output.close()
+                os.remove(tmp_path)
+        return set(wanted)
@@ -18,13 +18,111 @@
 import argparse
 import os
 import sys
+import time
 
 import golddust
+from golddust import daemon
+
+# Everything else is imported where it's used, so that invocations
+# forwarded to the daemon start quickly.
+
+
+_REQUIREMENT = r"^([A-Za-z0-9_.\-]+?)\s*([=!<>].*)?$"
+
+_SIZE = r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$"
+
+_UNITS = "KMGT"
+
+# Subcommands run by the daemon when one is running (see `_forward`).
+_FORWARDED = ("listinstances", "search")
+
+
+def parse_requirement(text):
+    """Split a requirement such as "forge>=10.13" into a name and spec."""
+    import re
+
+    match = re.match(_REQUIREMENT, text.strip())
+    if not match:
+        raise ValueError("Bad requirement: {}".format(text))
+    return match.group(1), match.group(2) or ""
+
+
+def parse_size(text):
+    """Parse a size such as '512M' or '20G' (binary units) into bytes."""
+    import re
+
+    match = re.match(_SIZE, text, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError("Invalid size: {!r}".format(text))
+    number, unit = match.groups()
+    exponent = _UNITS.index(unit.upper()) + 1 if unit else 0
+    return int(float(number) * 1024 ** exponent)
+
+
+def parse_size_cap(text):
+    """Parse a size like `parse_size`, or 'none' into None."""
+    return None if text.strip().lower() == "none" else parse_size(text)
+
+
+def format_size(size):
+    """Format a size in bytes for people, such as '1.5 GiB'."""
+    if size < 1024:
+        return "{} B".format(size)
+    for unit in _UNITS:
+        size /= 1024
+        if size < 1024 or unit == _UNITS[-1]:
+            return "{:.1f} {}iB".format(size, unit)
+
+
+def add_search_arguments(parser):
+    """Add the arguments of a search subcommand to an argument parser."""
+    parser.add_argument('-g', '--game-version',
+                        help="Only packages for this game version, such "
+                             "as '1.7.10' (or '1.7' for any 1.7.x).")
+    parser.add_argument('-L', '--loader',
+                        help="Only packages for this mod loader, such as "
+                             "'forge'.")
+    parser.add_argument('-D', '--depends', dest='dependency',
+                        metavar="PACKAGE",
+                        help="Only packages depending on this package.")
+    parser.add_argument('-l', '--limit', type=int, default=50,
+                        help="The most packages to list.")
+    parser.add_argument('query', nargs='*',
+                        help="Words to find in package names and "
+                             "descriptions. Lists every package if "
+                             "omitted.")
+
+
+def write_search_results(search, args):
+    """Run a search with the arguments added by `add_search_arguments` and
+    write the results to stdout, one package per line.
+
+    Takes:
+        search (golddust.search.SearchIndex): The index to search.
+        args (argparse.Namespace): The parsed arguments.
+    """
+    results = search.search(" ".join(args.query), args.game_version,
+                            args.loader, args.dependency, args.limit)
+    for result in results:
+        fields = [result["name"], result["version"], result["description"]]
+        if args.verbose:
+            fields += [",".join(result["game_versions"]), result["loader"]]
+        sys.stdout.write("\t".join(fields) + "\n")
+    sys.stdout.flush()
 
 
 class GDGameTool:
     """Manage modded game installations with GoldDust."""
-    def __init__(self):
+    def __init__(self, argv=None, gdust=None):
+        """Run gdgame.
+
+        Takes:
+            argv (list of str): The command line arguments; defaults to
+                                sys.argv.
+            gdust (golddust.GoldDust): An already loaded GoldDust to use
+                                       rather than loading --gdhome, as in
+                                       the daemon.
+        """
         self._golddust = None
         argparser = argparse.ArgumentParser(description=(self.__doc__))
         argparser.add_argument('-H', '--gdhome',
@@ -40,6 +138,23 @@ class GDGameTool:
         argparser.add_argument('-v', '--verbose',
                                help="Output more detailed status messages.",
                                action='store_true')
+        argparser.add_argument('--profile',
+                               help="Print the time spent in each phase "
+                                    "when done.",
+                               action='store_true')
+        argparser.add_argument('--metrics-out',
+                               help="Write timed spans of every phase to "
+                                    "this file.",
+                               metavar="PATH")
+        argparser.add_argument('--metrics-format',
+                               help="Format of --metrics-out: 'json' "
+                                    "(default) or 'chrome' (chrome://tracing "
+                                    "trace events).",
+                               choices=("json", "chrome"), default="json")
+        argparser.add_argument('--no-daemon',
+                               help="Run in this process even if a gdgame "
+                                    "daemon is running.",
+                               action='store_true')
         subparser = argparser.add_subparsers(dest="subcommand")
 
         # 'newinstance' subcommand
@@ -68,25 +183,238 @@ class GDGameTool:
                                    help="Delete the game files as well.",
                                    action='store_true')
 
-        self.args = argparser.parse_args()
-        if not self.args.gdhome:
+        # 'cloneinstance' subcommand
+        clone_parse = subparser.add_parser('cloneinstance')
+        clone_parse.add_argument('-s', '--source', required=True,
+                                 help="The instance to copy.")
+        clone_parse.add_argument('-n', '--name', required=True,
+                                 help="The short name of the new instance.")
+        clone_parse.add_argument('-p', '--path', required=True,
+                                 help="The path to the root of the new "
+                                      "instance.")
+        clone_parse.add_argument('-N', '--longname',
+                                 help="The user-friendly name for the new "
+                                      "instance.")
+
+        # 'snapshot' subcommand
+        snapshot_parse = subparser.add_parser('snapshot')
+        snapshot_parse.add_argument('-n', '--name', required=True,
+                                    help="The instance to snapshot.")
+        snapshot_parse.add_argument('-m', '--message', default="",
+                                    help="A description of the snapshot.")
+        snapshot_parse.add_argument('-l', '--list', action='store_true',
+                                    help="List the snapshots instead.")
+
+        # 'rollback' subcommand
+        rollback_parse = subparser.add_parser('rollback')
+        rollback_parse.add_argument('-n', '--name', required=True,
+                                    help="The instance to roll back.")
+        rollback_parse.add_argument('-g', '--generation', type=int,
+                                    help="The snapshot generation to "
+                                         "restore. Defaults to the newest.")
+
+        # 'listinstances' subcommand
+        listinst_parse = subparser.add_parser('listinstances')
+        listinst_parse.add_argument('-P', '--package',
+                                    help="Only list instances with this "
+                                         "package installed.")
+        listinst_parse.add_argument('-V', '--version',
+                                    help="Only list instances with this "
+                                         "version of --package installed.")
+
+        # 'daemon' subcommand
+        daemon_parse = subparser.add_parser('daemon')
+        daemon_parse.add_argument('-S', '--stop', action='store_true',
+                                  help="Stop the running daemon.")
+
+        # 'verify' subcommand
+        verify_parse = subparser.add_parser('verify')
+        verify_parse.add_argument('-n', '--name', required=True,
+                                  help="The instance to check.")
+        verify_parse.add_argument('-r', '--repair', action='store_true',
+                                  help="Restore damaged or missing files "
+                                       "from the package cache.")
+        verify_parse.add_argument('-f', '--full', action='store_true',
+                                  help="Hash every file, even those whose "
+                                       "size and mtime are unchanged.")
+        verify_parse.add_argument('-j', '--jobs', type=int,
+                                  help="Number of threads hashing files.")
+        verify_parse.add_argument('-R', '--repo',
+                                  help="The repository --bundle is in.")
+        verify_parse.add_argument('-b', '--bundle',
+                                  help="Fetch files the package cache can't "
+                                       "repair from this bundle of --repo.")
+
+        # 'gc' subcommand
+        gc_parse = subparser.add_parser('gc')
+        gc_parse.add_argument('-s', '--max-size', type=parse_size,
+                              help="Shrink the package cache to this size, "
+                                   "such as '20G'. Defaults to the "
+                                   "configured cap, or to removing every "
+                                   "package no instance uses.")
+        gc_parse.add_argument('--set-max-size', metavar="SIZE",
+                              type=parse_size_cap, default=False,
+                              help="Save a size cap the package cache is "
+                                   "kept under after every fetch ('none' "
+                                   "for no cap), then collect.")
+        gc_parse.add_argument('-m', '--min-age', type=float, default=600.0,
+                              help="Keep packages used in the last this "
+                                   "many seconds.")
+        gc_parse.add_argument('-n', '--dry-run', action='store_true',
+                              help="Only list what would be removed.")
+        gc_parse.add_argument('--reindex', action='store_true',
+                              help="Rebuild the cache index from the files "
+                                   "in the cache first.")
+
+        # 'batchinstall' subcommand
+        batch_parse = subparser.add_parser('batchinstall')
+        batch_parse.add_argument('-r', '--repo', required=True,
+                                 help="The repository to install from.")
+        batch_parse.add_argument('-i', '--instance', action='append',
+                                 default=[], dest='instances',
+                                 help="An instance to change. May be given "
+                                      "multiple times.")
+        batch_parse.add_argument('-a', '--all', action='store_true',
+                                 help="Change every instance.")
+        batch_parse.add_argument('-x', '--remove', action='append',
+                                 default=[],
+                                 help="A package to uninstall. May be given "
+                                      "multiple times.")
+        batch_parse.add_argument('-j', '--jobs', type=int,
+                                 help="Number of instances staged at once.")
+        batch_parse.add_argument('-b', '--bundle',
+                                 help="Fetch the packages this bundle of "
+                                      "the repository holds from it.")
+        batch_parse.add_argument('requirements', nargs='*',
+                                 metavar="PACKAGE[SPEC]",
+                                 help="Packages to install or upgrade, "
+                                      "optionally with a version constraint "
+                                      "such as 'forge>=10.13'.")
+
+        # 'export' subcommand
+        export_parse = subparser.add_parser('export')
+        export_parse.add_argument('-n', '--name', action='append',
+                                  required=True, dest='names',
+                                  help="An instance to export. May be given "
+                                       "multiple times.")
+        export_parse.add_argument('-r', '--repo', required=True,
+                                  help="The repository the instances' "
+                                       "packages came from.")
+        export_parse.add_argument('-o', '--output', required=True,
+                                  help="The file to write, or '-' for "
+                                       "stdout.")
+
+        # 'import' subcommand
+        import_parse = subparser.add_parser('import')
+        import_parse.add_argument('file',
+                                  help="The export to read, or '-' for "
+                                       "stdin.")
+        import_parse.add_argument('-k', '--public-key',
+                                  help="A public key file to check the "
+                                       "packages with. Defaults to the key "
+                                       "of the configured repository the "
+                                       "export was made from.")
+        import_parse.add_argument('-d', '--dest',
+                                  help="Put each instance in a directory of "
+                                       "its name under this, instead of "
+                                       "where it was on the exporting host.")
+        import_parse.add_argument('-j', '--jobs', type=int,
+                                  help="Number of threads decompressing "
+                                       "packages.")
+
+        # 'search' subcommand
+        search_parse = subparser.add_parser('search')
+        search_parse.add_argument('-r', '--repo', required=True,
+                                  help="The repository to search.")
+        search_parse.add_argument('-u', '--update', action='store_true',
+                                  help="Refresh the repository index "
+                                       "first.")
+        add_search_arguments(search_parse)
+
+        self.args = argparser.parse_args(argv)
+        if gdust is not None:
+            self.gdhome = gdust.root
+        elif not self.args.gdhome:
             self.gdhome = golddust.default_home_dir()
         else:
             self.gdhome = self.args.gdhome
 
-        if not os.path.isdir(self.gdhome):
+        if gdust is None and not os.path.isdir(self.gdhome):
             if not self.gd_not_installed():
                 return
 
-        self._golddust = golddust.GoldDust(self.gdhome)
+        if self.args.subcommand == "daemon" and gdust is not None:
+            sys.stderr.write("The daemon is already running.\n")
+            sys.exit(1)
 
+        from golddust import metrics
+
+        recorder = None
+        if self.args.profile or self.args.metrics_out:
+            recorder = metrics.enable()
+        try:
+            self._golddust = gdust or golddust.GoldDust(self.gdhome)
+            self.run_subcommand(argparser)
+        finally:
+            if recorder is not None:
+                metrics.disable()
+                self.report_metrics(recorder)
+
+    def run_subcommand(self, argparser):
+        """Run the subcommand given on the command line."""
         if self.args.subcommand == "newinstance":
             self.new_instance()
         elif self.args.subcommand == "deleteinstance":
             self.delete_instance()
+        elif self.args.subcommand == "cloneinstance":
+            self.clone_instance()
+        elif self.args.subcommand == "snapshot":
+            self.snapshot()
+        elif self.args.subcommand == "rollback":
+            self.rollback()
+        elif self.args.subcommand == "listinstances":
+            self.list_instances()
+        elif self.args.subcommand == "batchinstall":
+            self.batch_install()
+        elif self.args.subcommand == "verify":
+            self.verify()
+        elif self.args.subcommand == "gc":
+            self.collect_garbage()
+        elif self.args.subcommand == "export":
+            self.export_instances()
+        elif self.args.subcommand == "import":
+            self.import_instances()
+        elif self.args.subcommand == "search":
+            self.search()
+        elif self.args.subcommand == "daemon":
+            self.run_daemon()
         else:
             argparser.print_usage()
 
+    def report_metrics(self, recorder):
+        """Write out and/or print what a golddust.metrics.Recorder recorded.
+        """
+        from golddust import metrics
+
+        if self.args.metrics_out:
+            recorder.write(self.args.metrics_out, self.args.metrics_format)
+
+        if self.args.profile:
+            sys.stderr.write("{:<22} {:>6} {:>10} {:>14}\n".format(
+                "phase", "count", "seconds", "bytes"))
+            for name, total in recorder.summary().items():
+                sys.stderr.write("{:<22} {:>6} {:>10.3f} {:>14}\n".format(
+                    name, total["count"], total["seconds"], total["bytes"]))
+            for name, value in sorted(recorder.counters.items()):
+                if name.endswith(".seconds"):
+                    sys.stderr.write("{:<22} {:>6} {:>10.3f}\n".format(
+                        name[:-len(".seconds")], "", value))
+            peak = metrics.peak_memory()
+            if peak is not None:
+                sys.stderr.write("peak memory: {:.1f} MiB\n"
+                                 .format(peak / (1024 * 1024)))
+            sys.stderr.flush()
+
     def gd_not_installed(self):
         """Prompt the user (unless --noprompt) to install GoldDust.
 
@@ -94,18 +422,18 @@ class GDGameTool:
             True for successful installation, False if the user
             refused installation.
         """
+        from golddust.clitools import gdcli
+
         if not self.args.noprompt:
             sys.stdout.write("GoldDust doesn't appear to be installed. ")
             sys.stdout.flush()
-            if not golddust.gdcli.ask_confirm("Install GoldDust?", False):
+            if not gdcli.ask_confirm("Install GoldDust?", False):
                 return False
             # If the user never specified --gdhome, ask them where they
             # might want GoldDust installed.
             if not self.args.gdhome:
-                self.gdhome = golddust.gdcli.ask_string("Where should "
-                                                        "GoldDust be "
-                                                        "installed?",
-                                                        self.gdhome)
+                self.gdhome = gdcli.ask_string("Where should GoldDust be "
+                                               "installed?", self.gdhome)
 
         self.gdhome = os.path.abspath(os.path.expanduser(self.gdhome))
 
@@ -153,11 +481,274 @@ class GDGameTool:
             sys.stdout.write("Instance '{}' removed.\n".format(self.args.name))
             sys.stdout.flush()
 
+    def clone_instance(self):
+        """Create an instance as a copy of another.
+        """
+        self._golddust.clone_instance(self.args.source, self.args.name,
+                                      self.args.longname, self.args.path)
+
+        if self.args.verbose:
+            sys.stdout.write("Instance '{}' cloned to '{}'.\n"
+                             .format(self.args.source, self.args.name))
+            sys.stdout.flush()
+
+    def snapshot(self):
+        """Snapshot an instance, or list its snapshots.
+        """
+        if self.args.list:
+            store = self._golddust.snapshots(self.args.name)
+            for generation in store.generations():
+                info = store.load(generation)
+                sys.stdout.write("{}\t{}\t{}\n".format(
+                    generation, time.strftime("%Y-%m-%d %H:%M:%S",
+                                              time.localtime(info["created"])),
+                    info["description"]))
+            sys.stdout.flush()
+            return
+
+        generation = self._golddust.snapshot_instance(self.args.name,
+                                                      self.args.message)
+        if self.args.verbose:
+            sys.stdout.write("Saved snapshot generation {}.\n"
+                             .format(generation))
+            sys.stdout.flush()
+
+    def rollback(self):
+        """Restore an instance from a snapshot.
+        """
+        previous = self._golddust.rollback_instance(self.args.name,
+                                                    self.args.generation)
+        if self.args.verbose:
+            sys.stdout.write("Rolled back. The previous state is snapshot "
+                             "generation {}.\n".format(previous))
+            sys.stdout.flush()
+
+    def list_instances(self):
+        """List game instances, optionally only those using a package.
+        """
+        registry = self._golddust.instances
+        if self.args.package:
+            instances = registry.find_by_package(self.args.package,
+                                                 self.args.version)
+        else:
+            instances = registry
+
+        for instance in instances:
+            if self.args.verbose:
+                sys.stdout.write("{}\t{}\t{}\n".format(
+                    instance.name, instance.path, instance.longname))
+            else:
+                sys.stdout.write("{}\n".format(instance.name))
+        sys.stdout.flush()
+
+    def run_daemon(self):
+        """Serve gdgame invocations from a Unix socket until stopped.
+        """
+        if self.args.stop:
+            if not daemon.stop(self._golddust.root):
+                sys.stderr.write("No daemon is running.\n")
+                sys.exit(1)
+            return
+
+        import signal
+
+        # Exit through the finally blocks so the socket is removed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        gdust = self._golddust
+        server = daemon.Daemon(gdust,
+                               lambda argv: GDGameTool(argv, gdust))
+        if self.args.verbose:
+            sys.stdout.write("Serving on '{}'\n".format(server.path))
+            sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    def batch_install(self):
+        """Install, upgrade or remove packages across many instances in one
+        transaction.
+        """
+        from golddust.resolver import Resolver
+
+        gdust = self._golddust
+        instances = gdust.instances.names() if self.args.all \
+            else self.args.instances
+        if not instances:
+            sys.stderr.write("No instances given (use -i or --all).\n")
+            sys.exit(1)
+
+        requirements = dict(parse_requirement(text)
+                            for text in self.args.requirements)
+        plan = []
+        if requirements:
+            index = gdust.refresh_repository(self.args.repo)
+            plan = Resolver(index).resolve(requirements)
+            if self.args.verbose:
+                sys.stdout.write("Fetching {}\n".format(", ".join(
+                    "{} {}".format(package.name, package.version)
+                    for package in plan)))
+                sys.stdout.flush()
+            pending = plan
+            if self.args.bundle:
+                pending = gdust.fetch_bundle(self.args.repo,
+                                             self.args.bundle, plan)
+            gdust.fetch_packages(self.args.repo, pending)
+
+        batch = gdust.batch()
+        for instance in instances:
+            batch.add(instance, plan, self.args.remove)
+        changed = batch.apply(self.args.jobs)
+
+        if self.args.verbose:
+            sys.stdout.write("Updated {} instances.\n".format(len(changed)))
+            sys.stdout.flush()
+
+    def verify(self):
+        """Check an instance's files, and optionally repair them.
+
+        Exits with status 1 if any damaged files are left.
+        """
+        if self.args.bundle and not self.args.repo:
+            sys.stderr.write("--bundle needs --repo.\n")
+            sys.exit(1)
+        problems, repaired = self._golddust.verify_instance(
+            self.args.name, self.args.repair, self.args.full,
+            self.args.jobs, self.args.repo, self.args.bundle)
+        repaired = set(repaired)
+        for rel_path, problem in sorted(problems.items()):
+            sys.stdout.write("{}\t{}\n".format(
+                "repaired" if rel_path in repaired else problem, rel_path))
+        if self.args.verbose:
+            sys.stdout.write("{} damaged files, {} repaired.\n".format(
+                len(problems), len(repaired)))
+        sys.stdout.flush()
+        if len(problems) > len(repaired):
+            sys.exit(1)
+
+    def collect_garbage(self):
+        """Shrink the package cache by removing packages no instance uses.
+        """
+        gdust = self._golddust
+        cache = gdust.package_cache
+        if self.args.set_max_size is not False:
+            with gdust.edit_global_config() as config:
+                config.cache_max_size = self.args.set_max_size
+        if self.args.reindex:
+            cache.reindex()
+
+        before = cache.size()
+        evicted = gdust.collect_garbage(self.args.max_size,
+                                        self.args.min_age,
+                                        self.args.dry_run)
+        freed = sum(size for _, _, size in evicted)
+        if self.args.verbose or self.args.dry_run:
+            for kind, key, size in evicted:
+                sys.stdout.write("{}\t{}\t{}\n".format(
+                    kind, key, format_size(size)))
+        sys.stdout.write("{} {} entries, {}; the cache is {}.\n".format(
+            "Would remove" if self.args.dry_run else "Removed",
+            len(evicted), format_size(freed),
+            format_size(before - freed)))
+        sys.stdout.flush()
+
+    def export_instances(self):
+        """Write instances and their packages to a file for hosts without
+        repository access.
+        """
+        gdust = self._golddust
+        if self.args.output == "-":
+            gdust.export_instances(self.args.names, self.args.repo,
+                                   sys.stdout.buffer)
+            sys.stdout.flush()
+            return
+
+        import tempfile
+
+        path = os.path.abspath(self.args.output)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, mode="wb") as output:
+                gdust.export_instances(self.args.names, self.args.repo,
+                                       output)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self.args.verbose:
+            sys.stdout.write("Exported {} to '{}'.\n".format(
+                ", ".join(self.args.names), path))
+            sys.stdout.flush()
+
+    def import_instances(self):
+        """Create instances from a file written by `gdgame export`.
+        """
+        public_key = None
+        if self.args.public_key:
+            from golddust import signify
+            public_key = signify.PublicKey.load(self.args.public_key)
+
+        if self.args.file == "-":
+            names = self._golddust.import_instances(
+                sys.stdin.buffer, public_key, self.args.dest, self.args.jobs)
+        else:
+            with open(self.args.file, mode="rb") as source:
+                names = self._golddust.import_instances(
+                    source, public_key, self.args.dest, self.args.jobs)
+
+        if self.args.verbose:
+            sys.stdout.write("Imported {}.\n".format(", ".join(names)))
+            sys.stdout.flush()
+
+    def search(self):
+        """Find packages in a repository by name, description and facets.
+        """
+        gdust = self._golddust
+        if self.args.update:
+            gdust.refresh_repository(self.args.repo)
+        write_search_results(gdust.search_index(self.args.repo), self.args)
+
+
+def _forward(argv):
+    """Run gdgame arguments in the daemon, if one is running.
+
+    Returns the exit status, or None if the arguments should be run in this
+    process.
+    """
+    preparser = argparse.ArgumentParser(add_help=False)
+    preparser.add_argument('-H', '--gdhome')
+    preparser.add_argument('--no-daemon', action='store_true')
+    preparser.add_argument('--metrics-out')
+    preparser.add_argument('--metrics-format')
+    preparser.add_argument('-u', '--update', action='store_true')
+    known, rest = preparser.parse_known_args(argv)
+    subcommand = next((arg for arg in rest if not arg.startswith("-")), None)
+    # The daemon runs one request at a time and only relays their output
+    # once they finish, so only quick read-only commands are worth sending
+    # it. Anything that writes runs here, taking its own locks.
+    if known.no_daemon or subcommand not in _FORWARDED \
+            or (subcommand == "search" and known.update):
+        return None
+
+    response = daemon.run(known.gdhome or golddust.default_home_dir(), argv)
+    if response is None:
+        return None
+    sys.stdout.write(response["stdout"])
+    sys.stdout.flush()
+    sys.stderr.write(response["stderr"])
+    sys.stderr.flush()
+    return response["status"]
+
 
 def main():
     # An independent function is needed here because console_scripts prints
     # the return value of the script entry point, which for GDGameTool() is
     # a class instance. (We want None so it doesn't print anything.)
+    status = _forward(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
     GDGameTool()
 
 
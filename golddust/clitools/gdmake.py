@@ -13,3 +13,119 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+
+import argparse
+import os
+import sys
+
+from golddust import build, signify
+from golddust.compression import CODECS, DEFAULT_CODEC
+
+
+class GDMakeTool:
+    """Build GoldDust packages from package specifications."""
+    def __init__(self):
+        argparser = argparse.ArgumentParser(description=(self.__doc__))
+        argparser.add_argument('-v', '--verbose',
+                               help="Output more detailed status messages.",
+                               action='store_true')
+        subparser = argparser.add_subparsers(dest="subcommand")
+
+        # 'build' subcommand
+        build_parse = subparser.add_parser('build')
+        build_parse.add_argument('specs',
+                                 help="Package specification directories, "
+                                      "or directories containing them.",
+                                 nargs='+', metavar="SPEC")
+        build_parse.add_argument('-o', '--output',
+                                 help="The directory to write packages to.",
+                                 required=True)
+        build_parse.add_argument('-k', '--key',
+                                 help="The signify secret key to sign "
+                                      "packages with.")
+        build_parse.add_argument('-c', '--codec',
+                                 help="Archive codec to build. May be given "
+                                      "more than once to offer several. "
+                                      "Defaults to '{}'."
+                                      .format(DEFAULT_CODEC),
+                                 choices=list(CODECS), action='append')
+        build_parse.add_argument('-l', '--level',
+                                 help="Compression level for the codecs.",
+                                 type=int)
+        build_parse.add_argument('-j', '--jobs',
+                                 help="Number of packages to build at once. "
+                                      "Defaults to the number of CPUs.",
+                                 type=int)
+        build_parse.add_argument('-f', '--force',
+                                 help="Rebuild packages even if they haven't "
+                                      "changed since the last build.",
+                                 action='store_true')
+
+        # 'genkey' subcommand
+        genkey_parse = subparser.add_parser('genkey')
+        genkey_parse.add_argument('-p', '--prefix',
+                                  help="Write the key pair to PREFIX.pub and "
+                                       "PREFIX.sec.",
+                                  required=True)
+
+        self.args = argparser.parse_args()
+
+        if self.args.subcommand == "build":
+            self.build()
+        elif self.args.subcommand == "genkey":
+            self.generate_key()
+        else:
+            argparser.print_usage()
+
+    def build(self):
+        """Build the outdated packages of the given specifications.
+        """
+        secret_key = None
+        if self.args.key:
+            secret_key = signify.SecretKey.load(self.args.key)
+        os.makedirs(self.args.output, exist_ok=True)
+
+        specs = build.find_specs(self.args.specs)
+        if self.args.verbose:
+            sys.stdout.write("Checking {} package(s)...\n".format(len(specs)))
+            sys.stdout.flush()
+
+        built, skipped = build.build_all(
+            specs, self.args.output,
+            codecs=self.args.codec or [DEFAULT_CODEC],
+            secret_key=secret_key, level=self.args.level,
+            jobs=self.args.jobs, force=self.args.force)
+
+        if self.args.verbose:
+            for package in built:
+                sys.stdout.write("Built {} {} ({}).\n".format(
+                    package.name, package.version,
+                    ", ".join(sorted(package.archives))))
+            sys.stdout.write("{} built, {} up to date.\n"
+                             .format(len(built), len(skipped)))
+            sys.stdout.flush()
+
+    def generate_key(self):
+        """Generate a signify key pair for signing packages.
+        """
+        public_key, secret_key = signify.generate_keypair()
+        for path, key in (("{}.sec".format(self.args.prefix), secret_key),
+                          ("{}.pub".format(self.args.prefix), public_key)):
+            if os.path.exists(path):
+                raise FileExistsError("'{}' already exists.".format(path))
+            with open(path, mode="w") as key_file:
+                key_file.write(key.to_string())
+
+        if self.args.verbose:
+            sys.stdout.write("Wrote key pair '{0}.pub'/'{0}.sec'.\n"
+                             .format(self.args.prefix))
+            sys.stdout.flush()
+
+
+def main():
+    GDMakeTool()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,3 +13,192 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+
+import argparse
+import sys
+
+from golddust import repoindex, signify
+from golddust.compression import CODECS, DEFAULT_CODEC
+
+
+class GDRepoTool:
+    """Maintain a GoldDust package repository."""
+    def __init__(self):
+        # gdgame is only needed for its search options and output.
+        from golddust.clitools.gdgame import add_search_arguments
+
+        argparser = argparse.ArgumentParser(description=(self.__doc__))
+        argparser.add_argument('-r', '--repo',
+                               help="The repository root directory, "
+                                    "containing gdmake output.",
+                               default=".", metavar="PATH")
+        argparser.add_argument('-v', '--verbose',
+                               help="Output more detailed status messages.",
+                               action='store_true')
+        subparser = argparser.add_subparsers(dest="subcommand")
+
+        # 'update' subcommand
+        update_parse = subparser.add_parser('update')
+        update_parse.add_argument('-k', '--key',
+                                  help="The signify secret key to sign the "
+                                       "index with.")
+        update_parse.add_argument('-d', '--deltas',
+                                  help="How many earlier index generations "
+                                       "to publish deltas from.",
+                                  type=int, default=10)
+
+        # 'serve' subcommand
+        serve_parse = subparser.add_parser('serve')
+        serve_parse.add_argument('-b', '--bind', default="",
+                                 help="The address to listen on. Defaults "
+                                      "to all interfaces.")
+        serve_parse.add_argument('-p', '--port', type=int, default=8080,
+                                 help="The port to listen on.")
+        serve_parse.add_argument('-u', '--upstream', action='append',
+                                 metavar="URL",
+                                 help="Proxy this upstream mirror, caching "
+                                      "files in --repo. May be given "
+                                      "multiple times for mirrors of the "
+                                      "same repository.")
+        serve_parse.add_argument('--head-ttl', type=float, default=60.0,
+                                 help="Seconds before the cached index head "
+                                      "is checked upstream again.")
+
+        # 'bundle' subcommand
+        bundle_parse = subparser.add_parser('bundle')
+        bundle_parse.add_argument('-n', '--name', required=True,
+                                  help="The bundle name. It is written to "
+                                       "bundles/NAME.gdbundle.")
+        bundle_parse.add_argument('-k', '--key',
+                                  help="The signify secret key to sign the "
+                                       "bundle index with.")
+        bundle_parse.add_argument('-c', '--codec', choices=list(CODECS),
+                                  default=DEFAULT_CODEC,
+                                  help="The codec to compress chunks with. "
+                                       "Defaults to '{}'."
+                                       .format(DEFAULT_CODEC))
+        bundle_parse.add_argument('-l', '--level', type=int,
+                                  help="Compression level for the codec.")
+        bundle_parse.add_argument('--chunk-size', type=int,
+                                  default=1024 * 1024, metavar="BYTES",
+                                  help="Uncompressed size of each chunk. "
+                                       "Smaller chunks make fetching single "
+                                       "files cheaper and compress worse.")
+        bundle_parse.add_argument('requirements', nargs='+',
+                                  metavar="PACKAGE[SPEC]",
+                                  help="Packages to bundle, with their "
+                                       "dependencies, optionally with a "
+                                       "version constraint such as "
+                                       "'forge>=10.13'.")
+
+        # 'search' subcommand
+        search_parse = subparser.add_parser('search')
+        add_search_arguments(search_parse)
+
+        self.args = argparser.parse_args()
+
+        if self.args.subcommand == "update":
+            self.update()
+        elif self.args.subcommand == "serve":
+            self.serve()
+        elif self.args.subcommand == "bundle":
+            self.bundle()
+        elif self.args.subcommand == "search":
+            self.search()
+        else:
+            argparser.print_usage()
+
+    def update(self):
+        """Publish a new index generation if the packages changed.
+        """
+        from golddust import search
+
+        secret_key = None
+        if self.args.key:
+            secret_key = signify.SecretKey.load(self.args.key)
+
+        index = repoindex.publish(self.args.repo, secret_key=secret_key,
+                                  keep=self.args.deltas)
+        # Keep the search index current once `gdrepo search` has built it.
+        search.repository_search(self.args.repo, create=False)
+
+        if self.args.verbose:
+            sys.stdout.write("Index generation {} has {} package(s).\n"
+                             .format(index.generation, len(index)))
+            sys.stdout.flush()
+
+    def serve(self):
+        """Serve the repository over HTTP, or proxy upstream mirrors.
+        """
+        from golddust.server import RepositoryServer
+
+        server = RepositoryServer((self.args.bind, self.args.port),
+                                  self.args.repo, self.args.upstream,
+                                  self.args.head_ttl, self.args.verbose)
+        if self.args.verbose:
+            sys.stdout.write("Serving '{}' on port {}{}\n".format(
+                server.root, server.server_address[1],
+                " (proxying {})".format(", ".join(self.args.upstream))
+                if self.args.upstream else ""))
+            sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if self.args.verbose:
+                sys.stdout.write("Served {} bytes; fetched {} file(s) "
+                                 "upstream.\n".format(server.bytes_served,
+                                                      server.upstream_fetches))
+                sys.stdout.flush()
+
+    def bundle(self):
+        """Pack resolved packages into a seekable bundle.
+        """
+        from golddust import bundle
+        from golddust.clitools.gdgame import parse_requirement
+        from golddust.resolver import Resolver
+
+        secret_key = None
+        if self.args.key:
+            secret_key = signify.SecretKey.load(self.args.key)
+
+        requirements = dict(parse_requirement(text)
+                            for text in self.args.requirements)
+        plan = Resolver(repoindex.scan_packages(self.args.repo)).resolve(
+            requirements)
+        index = bundle.write_bundle(self.args.repo, self.args.name, plan,
+                                    secret_key=secret_key,
+                                    codec=self.args.codec,
+                                    level=self.args.level,
+                                    chunk_size=self.args.chunk_size)
+
+        if self.args.verbose:
+            sys.stdout.write("Bundled {} package(s) in {} chunk(s) into "
+                             "'{}'.\n".format(len(index.packages),
+                                              len(index.chunks),
+                                              bundle.bundle_path(
+                                                  self.args.name)))
+            sys.stdout.flush()
+
+    def search(self):
+        """Find packages in the repository by name, description and facets.
+
+        The search index is built the first time, and brought up to date
+        with the published index after that.
+        """
+        from golddust import search
+        from golddust.clitools.gdgame import write_search_results
+
+        write_search_results(search.repository_search(self.args.repo),
+                             self.args)
+
+
+def main():
+    GDRepoTool()
+
+
+if __name__ == "__main__":
+    main()
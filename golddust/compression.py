@@ -0,0 +1,396 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Archive Compression Codecs
+
+Package archives are tarballs compressed with one of these codecs:
+
+    bz2     Plain bzip2 (`.tar.bz2`). The original package format.
+    pbzip2  Multi-stream bzip2 (`.tar.bz2`), compressed in parallel. Any
+            bzip2 tool can read it, and GoldDust decompresses its streams
+            in parallel too.
+    xz      LZMA2 (`.tar.xz`). Smallest archives, slow to build.
+    zstd    Zstandard (`.tar.zst`). Fastest to install. Needs the optional
+            `zstandard` module.
+
+Archives are recognised by their magic bytes, so readers never need to be
+told which codec was used.
+"""
+
+
+import bz2
+import collections
+import concurrent.futures
+import io
+import lzma
+import os
+import re
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+_READ_SIZE = 256 * 1024
+
+# Start of a bzip2 stream: "BZh", block size digit, first block magic.
+_BZ2_STREAM_START = re.compile(rb"BZh[1-9]1AY&SY")
+
+
+def _workers():
+    return os.cpu_count() or 1
+
+
+class Codec:
+    """An archive compression format.
+
+    Takes:
+        name (str): The codec name recorded in package metadata.
+        extension (str): The archive file name extension.
+        magic (bytes): The bytes every archive of this format starts with.
+        install_rank (int): Relative decompression cost; lower is faster.
+    """
+    def __init__(self, name, extension, magic, install_rank):
+        self.name = name
+        self.extension = extension
+        self.magic = magic
+        self.install_rank = install_rank
+
+    def available(self):
+        """Check whether this codec can be used here."""
+        return True
+
+    def open_writer(self, fileobj, level=None):
+        """Wrap a binary file to compress everything written to it.
+
+        Closing the returned writer finishes the archive but leaves
+        `fileobj` open.
+        """
+        raise NotImplementedError
+
+    def open_reader(self, fileobj):
+        """Wrap a binary file to decompress everything read from it."""
+        raise NotImplementedError
+
+
+class _BZ2Codec(Codec):
+    def open_writer(self, fileobj, level=None):
+        return bz2.BZ2File(fileobj, mode="wb", compresslevel=level or 9)
+
+    def open_reader(self, fileobj):
+        if _workers() == 1:
+            # Splitting streams only pays off with CPUs to spread them on.
+            return bz2.BZ2File(fileobj, mode="rb")
+        return io.BufferedReader(ParallelBZ2Reader(fileobj), _READ_SIZE)
+
+
+class _ParallelBZ2Codec(_BZ2Codec):
+    def open_writer(self, fileobj, level=None):
+        return ParallelBZ2Writer(fileobj, level or 9)
+
+
+class _XZCodec(Codec):
+    def open_writer(self, fileobj, level=None):
+        return lzma.LZMAFile(fileobj, mode="wb",
+                             preset=level if level is not None else 6)
+
+    def open_reader(self, fileobj):
+        return lzma.LZMAFile(fileobj, mode="rb")
+
+
+class _ZstdCodec(Codec):
+    def available(self):
+        return zstandard is not None
+
+    def _require(self):
+        if zstandard is None:
+            raise RuntimeError("The zstd codec needs the 'zstandard' module.")
+
+    def open_writer(self, fileobj, level=None):
+        self._require()
+        compressor = zstandard.ZstdCompressor(level=level or 19, threads=-1)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def open_reader(self, fileobj):
+        self._require()
+        decompressor = zstandard.ZstdDecompressor()
+        return io.BufferedReader(
+            decompressor.stream_reader(fileobj, read_across_frames=True,
+                                       closefd=False),
+            _READ_SIZE)
+
+
+CODECS = collections.OrderedDict((codec.name, codec) for codec in (
+    _BZ2Codec("bz2", ".tar.bz2", b"BZh", 3),
+    # Multi-stream bzip2 only installs faster than plain bzip2 when its
+    # streams can be decompressed in parallel.
+    _ParallelBZ2Codec("pbzip2", ".tar.bz2", b"BZh",
+                      2 if _workers() > 1 else 4),
+    _XZCodec("xz", ".tar.xz", b"\xfd7zXZ\x00", 1),
+    _ZstdCodec("zstd", ".tar.zst", b"\x28\xb5\x2f\xfd", 0),
+))
+"""All known codecs, by name."""
+
+DEFAULT_CODEC = "bz2"
+
+
+def get_codec(name):
+    """Get a codec by name.
+
+    Raises:
+        KeyError: No codec has that name.
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise KeyError("Unknown archive codec: {}".format(name))
+
+
+def detect_codec(header):
+    """Work out an archive's codec from its first bytes.
+
+    Takes:
+        header (bytes): At least the first 6 bytes of the archive.
+
+    Raises:
+        ValueError: The header doesn't match any codec.
+
+    Returns the Codec. Multi-stream bzip2 is reported as "bz2"; both are
+    read the same way.
+    """
+    for codec in CODECS.values():
+        if header.startswith(codec.magic):
+            return codec
+    raise ValueError("Unrecognised archive format.")
+
+
+def negotiate_codec(offered):
+    """Pick the fastest codec to install out of those a repository offers.
+
+    Takes:
+        offered (iterable of str): Codec names the repository has archives
+                                   for.
+
+    Raises:
+        ValueError: None of the offered codecs can be used here.
+
+    Returns str, the chosen codec name.
+    """
+    usable = [CODECS[name] for name in offered
+              if name in CODECS and CODECS[name].available()]
+    if not usable:
+        raise ValueError("No supported codec offered: {}"
+                         .format(", ".join(offered)))
+    return min(usable, key=lambda codec: codec.install_rank).name
+
+
+def open_archive_reader(fileobj):
+    """Wrap an archive stream to read the tar data inside it.
+
+    Takes:
+        fileobj (io.BufferedReader): The compressed archive. Must support
+                                     `peek`.
+
+    Returns a readable file-like of the uncompressed tar stream.
+    """
+    return detect_codec(fileobj.peek(6)).open_reader(fileobj)
+
+
+class ParallelBZ2Writer(io.RawIOBase):
+    """Writes multi-stream bzip2, compressing blocks in a thread pool.
+
+    Input is cut into blocks of the bzip2 block size, and each block is
+    compressed as a separate bzip2 stream. The result is readable by any
+    bzip2 decompressor.
+
+    Takes:
+        fileobj (file-like): The binary file to write streams to.
+        level (int): The bzip2 compression level, 1-9.
+        workers (int): Number of compression threads; defaults to the
+                       number of CPUs.
+    """
+    def __init__(self, fileobj, level=9, workers=None):
+        super().__init__()
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = level * 100 * 1000
+        self._workers = workers or _workers()
+        self._pool = concurrent.futures.ThreadPoolExecutor(self._workers)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def _submit(self, block):
+        # Keep a bounded number of blocks in flight.
+        while len(self._pending) >= 2 * self._workers:
+            self._fileobj.write(self._pending.popleft().result())
+        self._pending.append(self._pool.submit(bz2.compress, block,
+                                               self._level))
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._pending:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            super().close()
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """Reads bzip2 data, decompressing separate streams in parallel.
+
+    The input is split where a new bzip2 stream starts and the pieces are
+    decompressed in a thread pool. If a split turns out to be a false match
+    inside compressed data, that piece is merged with the next one. Data
+    without stream boundaries (plain single-stream bzip2) is decompressed
+    sequentially, so memory use stays bounded either way.
+
+    Takes:
+        fileobj (file-like): The binary bzip2 file to read.
+        workers (int): Number of decompression threads; defaults to the
+                       number of CPUs.
+    """
+    _MAX_PIECE = 4 * 1024 * 1024
+    """Largest stream that is buffered for parallel decompression."""
+
+    def __init__(self, fileobj, workers=None):
+        super().__init__()
+        self._fileobj = fileobj
+        self._workers = workers or _workers()
+        self._pool = None
+        self._pending = collections.deque()
+        self._input = bytearray()
+        self._input_done = False
+        self._sequential = False
+        self._decompressor = None
+        self._output = b""
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _submit(self, piece):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self._workers)
+        self._pending.append((piece, self._pool.submit(bz2.decompress,
+                                                       piece)))
+
+    def _fill(self):
+        """Read input and queue complete streams for decompression."""
+        while (len(self._pending) < 2 * self._workers
+               and not self._input_done and not self._sequential):
+            data = self._fileobj.read(_READ_SIZE)
+            if not data:
+                self._input_done = True
+                if self._input:
+                    self._submit(bytes(self._input))
+                    self._input = bytearray()
+                break
+            search_from = max(len(self._input) - 9, 1)
+            self._input += data
+            start = 0
+            for match in _BZ2_STREAM_START.finditer(self._input,
+                                                    search_from):
+                self._submit(bytes(self._input[start:match.start()]))
+                start = match.start()
+            del self._input[:start]
+            if len(self._input) > self._MAX_PIECE:
+                self._sequential = True
+
+    def _next_sequential(self):
+        """Decompress the rest of the input in this thread."""
+        while True:
+            if self._input:
+                data, self._input = bytes(self._input), bytearray()
+            elif self._input_done:
+                data = b""
+            else:
+                data = self._fileobj.read(_READ_SIZE)
+                self._input_done = not data
+
+            if not data:
+                if self._decompressor and not self._decompressor.eof:
+                    raise EOFError("Compressed file ended before the "
+                                   "end-of-stream marker was reached")
+                return b""
+
+            output = []
+            while data:
+                if self._decompressor is None or self._decompressor.eof:
+                    self._decompressor = bz2.BZ2Decompressor()
+                output.append(self._decompressor.decompress(data))
+                data = (self._decompressor.unused_data
+                        if self._decompressor.eof else b"")
+            output = b"".join(output)
+            if output:
+                return output
+
+    def _next_output(self):
+        """Get the decompressed bytes of the next piece, or b"" at EOF."""
+        while True:
+            self._fill()
+            if not self._pending:
+                if self._sequential:
+                    return self._next_sequential()
+                return b""
+            piece, future = self._pending.popleft()
+            try:
+                return future.result()
+            except (OSError, EOFError, ValueError):
+                self._fill()
+                if self._pending:
+                    next_piece, next_future = self._pending.popleft()
+                    next_future.cancel()
+                elif self._input:
+                    next_piece, self._input = bytes(self._input), bytearray()
+                else:
+                    raise
+                # Not really a stream boundary; merge with the next piece.
+                merged = piece + next_piece
+                self._pending.appendleft(
+                    (merged, self._pool.submit(bz2.decompress, merged)))
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._output):
+            self._output = self._next_output()
+            self._offset = 0
+            if not self._output:
+                return 0
+        count = min(len(buffer), len(self._output) - self._offset)
+        buffer[:count] = self._output[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+    def close(self):
+        if self._pool is not None:
+            for _, future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+        super().close()
@@ -0,0 +1,214 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Daemon
+
+Starting Python, loading the global configuration and opening the
+instance registry costs more than most gdgame operations themselves. A
+daemon keeps one GoldDust object loaded (with its configuration, registry
+connection and repository indexes) and runs gdgame invocations for it,
+received over a Unix socket in the GoldDust home:
+
+    <gdhome>/gdgame.sock
+
+A client sends one JSON request and then shuts down its side of the
+connection:
+
+    {"argv": [...], "cwd": "..."}      Run gdgame with these arguments.
+    {"stop": true}                     Stop the daemon.
+
+and gets back one JSON response:
+
+    {"status": 0, "stdout": "...", "stderr": "..."}
+
+Requests are run one at a time and their output is sent back only when
+they finish, so gdgame only forwards quick read-only commands.
+"""
+
+
+import contextlib
+import io
+import json
+import os
+import sys
+import traceback
+
+
+SOCKET_NAME = "gdgame.sock"
+
+
+def socket_path(gdhome):
+    """Get the path of the daemon socket of a GoldDust home."""
+    return os.path.join(gdhome, SOCKET_NAME)
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode("utf-8"))
+
+
+def _receive(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+def request(gdhome, message):
+    """Send a request to the daemon of a GoldDust home.
+
+    Takes:
+        gdhome (str): The GoldDust home directory.
+        message (dict): The request (see the module documentation).
+
+    Returns the response dict, or None if no daemon is listening.
+    """
+    path = socket_path(gdhome)
+    if not os.path.exists(path):
+        return None
+
+    # Only imported when a daemon may be running, to keep the startup of
+    # clients without one as short as possible.
+    import socket
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        _send(connection, message)
+        connection.shutdown(socket.SHUT_WR)
+        return _receive(connection)
+    finally:
+        connection.close()
+
+
+def run(gdhome, argv, cwd=None):
+    """Run gdgame arguments in the daemon of a GoldDust home.
+
+    Returns the response dict, or None if no daemon is listening.
+    """
+    return request(gdhome, {"argv": list(argv), "cwd": cwd or os.getcwd()})
+
+
+def stop(gdhome):
+    """Stop the daemon of a GoldDust home.
+
+    Returns True if a daemon was running.
+    """
+    return request(gdhome, {"stop": True}) is not None
+
+
+def _exit_status(exit):
+    if exit.code is None:
+        return 0
+    if isinstance(exit.code, int):
+        return exit.code
+    print(exit.code, file=sys.stderr)
+    return 1
+
+
+class Daemon:
+    """Serves gdgame invocations for one GoldDust home.
+
+    Takes:
+        gdust (golddust.GoldDust): The GoldDust object to keep loaded.
+        handler (callable): Called with the argument list of each request
+                            while its stdout and stderr are captured. May
+                            raise SystemExit.
+    """
+    def __init__(self, gdust, handler):
+        self.gdust = gdust
+        self.handler = handler
+        self.path = socket_path(gdust.root)
+        self._stopping = False
+
+    def _bind(self):
+        import socket
+
+        if request(self.gdust.root, {"argv": None}) is not None:
+            raise FileExistsError("A daemon is already running for {}."
+                                  .format(self.gdust.root))
+        if os.path.lexists(self.path):
+            # Left behind by a daemon that didn't exit cleanly.
+            os.remove(self.path)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        except BaseException:
+            listener.close()
+            raise
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        return listener
+
+    def serve_forever(self):
+        """Serve requests until a stop request is received.
+
+        Raises:
+            FileExistsError: Another daemon is serving the GoldDust home.
+        """
+        listener = self._bind()
+        try:
+            while not self._stopping:
+                connection, _ = listener.accept()
+                with connection:
+                    try:
+                        _send(connection, self.handle(_receive(connection)))
+                    except (OSError, ValueError):
+                        # The client went away or sent garbage; it's the
+                        # only one affected.
+                        pass
+        finally:
+            listener.close()
+            os.remove(self.path)
+
+    def handle(self, message):
+        """Run one request.
+
+        Returns the response dict.
+        """
+        if message.get("stop"):
+            self._stopping = True
+            return {"status": 0, "stdout": "", "stderr": ""}
+        if message.get("argv") is None:
+            # Just checking that the daemon is up.
+            return {"status": 0, "stdout": "", "stderr": ""}
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+        cwd = os.getcwd()
+        try:
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                try:
+                    os.chdir(message.get("cwd") or cwd)
+                    self.gdust.reload_if_changed()
+                    self.handler(message["argv"])
+                except SystemExit as exit:
+                    status = _exit_status(exit)
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+        finally:
+            os.chdir(cwd)
+        return {"status": status, "stdout": stdout.getvalue(),
+                "stderr": stderr.getvalue()}
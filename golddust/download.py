@@ -0,0 +1,700 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Multi-Mirror Downloader
+
+Fetches repository files from every configured mirror at once. Large files
+are split into byte ranges which are spread over the mirrors and fetched
+concurrently over pooled keep-alive connections. Each mirror's latency and
+throughput are tracked so faster mirrors get more of the work, and a range
+is retried on another mirror if its mirror fails, stalls, or sends data
+slower than a minimum rate.
+"""
+
+
+import collections
+import concurrent.futures
+import http.client
+import io
+import threading
+import time
+import urllib.parse
+
+from golddust import metrics
+
+
+_READ_SIZE = 64 * 1024
+
+# Optimistic guesses for mirrors that haven't been measured yet, so they are
+# tried early without looking infinitely fast.
+_DEFAULT_LATENCY = 0.05
+_DEFAULT_THROUGHPUT = 16 * 1024 * 1024
+
+_RATE_WINDOW = 5.0
+"""Seconds over which a response's throughput is checked against the
+downloader's minimum."""
+
+
+class DownloadError(Exception):
+    """A file couldn't be fetched from any mirror."""
+    pass
+
+
+class _Stalled(OSError):
+    """A mirror is sending a response too slowly to be worth waiting for."""
+    pass
+
+
+class _RateCheck:
+    """Watches a response body arrive, to catch a mirror that keeps
+    trickling bytes too slowly for the socket timeout to notice.
+
+    Takes:
+        minimum (float): Bytes per second the body must arrive at,
+                         averaged over each `_RATE_WINDOW`; 0 disables the
+                         check.
+    """
+    def __init__(self, minimum):
+        self.minimum = minimum
+        self._start = time.monotonic()
+        self._received = 0
+
+    def update(self, count):
+        """Count received bytes.
+
+        Raises:
+            _Stalled: The last window was slower than the minimum.
+        """
+        if not self.minimum:
+            return
+        self._received += count
+        now = time.monotonic()
+        elapsed = now - self._start
+        if elapsed >= _RATE_WINDOW:
+            if self._received < self.minimum * elapsed:
+                raise _Stalled("Received {} bytes in {:.1f} s."
+                               .format(self._received, elapsed))
+            self._start, self._received = now, 0
+
+
+class MirrorStats:
+    """Observed performance of a single mirror.
+
+    Latency and throughput are exponentially weighted moving averages, so
+    recent behaviour counts the most.
+    """
+    _WEIGHT = 0.3
+    """How much a new sample moves the averages."""
+
+    def __init__(self, url):
+        self.url = url
+        """The base URL of the mirror."""
+        self.latency = None
+        """Average seconds until response headers arrive, None if unknown."""
+        self.throughput = None
+        """Average bytes per second of response bodies, None if unknown."""
+        self.failures = 0
+        """Number of consecutive failed requests."""
+        self.retry_after = 0.0
+        """Don't use the mirror again before this `time.monotonic()`."""
+        self.active = 0
+        """Number of requests currently in flight."""
+
+    def _average(self, old, sample):
+        if old is None:
+            return sample
+        return old + self._WEIGHT * (sample - old)
+
+    def record_success(self, latency, size, transfer_time):
+        """Record a completed request.
+
+        Takes:
+            latency (float): Seconds until the response headers arrived.
+            size (int): Bytes in the response body.
+            transfer_time (float): Seconds spent reading the body.
+        """
+        self.latency = self._average(self.latency, latency)
+        if size and transfer_time > 0:
+            self.throughput = self._average(self.throughput,
+                                            size / transfer_time)
+        self.failures = 0
+        self.retry_after = 0.0
+
+    def record_failure(self):
+        """Record a failed or stalled request.
+
+        The mirror is backed off for an exponentially growing period.
+        """
+        self.failures += 1
+        self.retry_after = time.monotonic() + min(2 ** self.failures, 60)
+
+    def estimate(self, size):
+        """Estimate how many seconds fetching `size` bytes would take.
+
+        Mirrors without measurements get an optimistic estimate so they
+        are tried early.
+        """
+        latency = self.latency if self.latency is not None \
+            else _DEFAULT_LATENCY
+        return latency + size / (self.throughput or _DEFAULT_THROUGHPUT)
+
+
+class ConnectionPool:
+    """Thread-safe pool of idle keep-alive HTTP(S) connections."""
+    def __init__(self, timeout):
+        self.timeout = timeout
+        """Socket timeout in seconds; a read stalling this long fails."""
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        """Get a connection to a host, reusing an idle one if possible."""
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        if scheme == "http":
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise ValueError("Unsupported mirror scheme: {}".format(scheme))
+
+    def release(self, scheme, netloc, conn):
+        """Return a connection whose last response was fully read."""
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def _split_url(mirror, path):
+    """Get the split URL and request target of a path on a mirror."""
+    url = urllib.parse.urlsplit(
+        urllib.parse.urljoin(mirror.url.rstrip("/") + "/", path))
+    target = url.path or "/"
+    if url.query:
+        target += "?" + url.query
+    return url, target
+
+
+class MirrorStream(io.RawIOBase):
+    """A sequential read stream of one file that fails over between mirrors.
+
+    If a mirror errors or stalls partway through, the stream resumes from
+    the current offset on another mirror using a range request, so the
+    consumer sees every byte exactly once.
+
+    Use `Downloader.open` rather than creating this directly.
+    """
+    def __init__(self, downloader, path):
+        super().__init__()
+        self.path = path
+        """The file's path relative to the mirror root."""
+        self.position = 0
+        """Number of bytes read so far."""
+        self._downloader = downloader
+        self._conn = None
+        self._url = None
+        self._response = None
+        self._mirror = None
+        self._started = 0.0
+        self._span_start = 0.0
+        self._latency = 0.0
+        self._received = 0
+        self._tried = []
+        self._attempts = 0
+        self._eof = False
+        self._rate = None
+
+    def readable(self):
+        return True
+
+    def _connect(self):
+        downloader = self._downloader
+        mirror = downloader._choose_mirror(downloader.chunk_size,
+                                           exclude=self._tried)
+        self._tried.append(mirror)
+        if len(self._tried) >= len(downloader.mirrors):
+            self._tried = []
+
+        url, target = _split_url(mirror, self.path)
+        headers = {}
+        if self.position:
+            headers["Range"] = "bytes={}-".format(self.position)
+        self._started = time.monotonic()
+        self._span_start = metrics.now()
+        self._received = 0
+        try:
+            conn = downloader.pool.acquire(url.scheme, url.netloc)
+        except ValueError:
+            # The mirror's URL scheme isn't supported.
+            self._finish(mirror, False)
+            return False
+        try:
+            conn.request("GET", target, headers=headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._finish(mirror, False)
+            return False
+
+        if response.status != (206 if self.position else 200):
+            conn.close()
+            self._finish(mirror, False)
+            return False
+
+        self._latency = time.monotonic() - self._started
+        self._conn, self._url = conn, url
+        self._response, self._mirror = response, mirror
+        self._rate = _RateCheck(downloader.min_throughput)
+        return True
+
+    def _finish(self, mirror, ok):
+        downloader = self._downloader
+        with downloader._lock:
+            mirror.active -= 1
+            if ok:
+                mirror.record_success(
+                    self._latency, self._received,
+                    time.monotonic() - self._started - self._latency)
+            else:
+                mirror.record_failure()
+        metrics.record("download", self._span_start, mirror=mirror.url,
+                       path=self.path, bytes=self._received, ok=ok)
+        metrics.count("download.bytes", self._received)
+        if not ok:
+            self._attempts += 1
+            if self._attempts > downloader.retries:
+                raise DownloadError("Couldn't fetch {}.".format(self.path))
+
+    def readinto(self, buffer):
+        while not self._eof:
+            if self._response is None and not self._connect():
+                continue
+            try:
+                # read1 returns whatever has arrived, so a slow mirror is
+                # noticed without waiting for the whole buffer to fill.
+                data = self._response.read1(len(buffer))
+                count = len(data)
+                buffer[:count] = data
+                self._rate.update(count)
+            except (OSError, http.client.HTTPException):
+                self._conn.close()
+                self._response = None
+                self._finish(self._mirror, False)
+                continue
+
+            if count:
+                self.position += count
+                self._received += count
+                return count
+
+            # read1 doesn't mark a fully read response closed.
+            self._response.read()
+            if self._response.will_close:
+                self._conn.close()
+            else:
+                self._downloader.pool.release(self._url.scheme,
+                                              self._url.netloc, self._conn)
+            self._finish(self._mirror, True)
+            self._response = self._conn = None
+            self._eof = True
+        return 0
+
+    def close(self):
+        if self._response is not None:
+            self._conn.close()
+            with self._downloader._lock:
+                self._mirror.active -= 1
+            self._response = self._conn = None
+        super().close()
+
+
+class RangeStream(io.RawIOBase):
+    """A sequential read stream of one file fetched as byte ranges.
+
+    Up to `window` ranges ahead of the reader are fetched concurrently,
+    each from whichever mirror is expected to finish it soonest and
+    retried on another if it fails, and handed to the reader in order.
+    Memory use is bounded by `window` ranges.
+
+    Use `Downloader.open` rather than creating this directly.
+    """
+    def __init__(self, downloader, job, ranges, window):
+        super().__init__()
+        self.path = job.path
+        """The file's path relative to the mirror root."""
+        self.position = 0
+        """Number of bytes read so far."""
+        self._downloader = downloader
+        self._job = job
+        self._ranges = iter(ranges)
+        self._pool = concurrent.futures.ThreadPoolExecutor(window)
+        self._pending = collections.deque()
+        self._data = b""
+        self._offset = 0
+        for _ in range(window):
+            self._submit()
+
+    def readable(self):
+        return True
+
+    def _submit(self):
+        byte_range = next(self._ranges, None)
+        if byte_range is not None:
+            self._pending.append(self._pool.submit(
+                self._downloader._fetch_range, self._job, *byte_range))
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._data):
+            if not self._pending:
+                return 0
+            self._data = self._pending.popleft().result()
+            self._offset = 0
+            self._submit()
+        count = min(len(buffer), len(self._data) - self._offset)
+        buffer[:count] = self._data[self._offset:self._offset + count]
+        self._offset += count
+        self.position += count
+        return count
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._pool.shutdown()
+        super().close()
+
+
+class _Job:
+    """A single file being downloaded."""
+    def __init__(self, path, dest, size):
+        self.path = path
+        self.dest = dest
+        self.size = size
+        self.ranges = True
+
+
+class Downloader:
+    """Fetches files from a repository's mirrors.
+
+    Takes:
+        mirrors (list of str): HTTP(S) base URLs of the repository mirrors.
+        max_workers (int): Maximum number of concurrent requests.
+        chunk_size (int): Files larger than this are split into byte ranges
+                          of about this size.
+        stall_timeout (float): Seconds without data before a request is
+                               abandoned and retried on another mirror.
+        min_throughput (float): Bytes per second below which a request is
+                                abandoned and retried on another mirror,
+                                checked when there is more than one.
+        retries (int): How many times a range may fail before the whole
+                       download fails.
+    """
+    def __init__(self, mirrors, max_workers=8, chunk_size=4 * 1024 * 1024,
+                 stall_timeout=15.0, min_throughput=16 * 1024,
+                 retries=None):
+        if not mirrors:
+            raise ValueError("At least one mirror is required.")
+        self.mirrors = [MirrorStats(url) for url in mirrors]
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries if retries is not None else 2 * len(mirrors)
+        # A slow mirror is still better than none.
+        self.min_throughput = min_throughput if len(mirrors) > 1 else 0
+        self.pool = ConnectionPool(stall_timeout)
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Close all pooled connections."""
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _choose_mirror(self, size, exclude=()):
+        """Pick the mirror expected to finish `size` bytes soonest."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [m for m in self.mirrors if m not in exclude]
+            if not candidates:
+                candidates = list(self.mirrors)
+            ready = [m for m in candidates if m.retry_after <= now]
+            mirror = min(ready or candidates,
+                         key=lambda m: (m.estimate(size) * (1 + m.active),
+                                        m.failures, m.retry_after))
+            mirror.active += 1
+        return mirror
+
+    def _request(self, mirror, method, path, headers, sink=None,
+                 accept=(200,)):
+        """Make a request to a mirror.
+
+        If the response status is in `accept` and `sink` is given, `sink` is
+        called with each chunk of the body. Any other status counts as a
+        mirror failure and its body is not read.
+
+        Returns the response.
+        """
+        url, target = _split_url(mirror, path)
+        conn = self.pool.acquire(url.scheme, url.netloc)
+        span_start = metrics.now()
+        started = time.monotonic()
+        size = 0
+        try:
+            conn.request(method, target, headers=headers)
+            response = conn.getresponse()
+            latency = time.monotonic() - started
+            if response.status in accept:
+                if sink is not None:
+                    rate = _RateCheck(self.min_throughput)
+                    for chunk in iter(lambda: response.read1(_READ_SIZE),
+                                      b""):
+                        sink(chunk)
+                        size += len(chunk)
+                        rate.update(len(chunk))
+                    # read1 doesn't mark a fully read response closed.
+                    response.read()
+                else:
+                    response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            with self._lock:
+                mirror.record_failure()
+            metrics.record("download", span_start, mirror=mirror.url,
+                           path=path, method=method, bytes=size, ok=False)
+            raise
+        metrics.record("download", span_start, mirror=mirror.url, path=path,
+                       method=method, range=headers.get("Range"),
+                       status=response.status, bytes=size)
+        metrics.count("download.bytes", size)
+
+        if response.status not in accept:
+            conn.close()
+            with self._lock:
+                mirror.record_failure()
+            return response
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.release(url.scheme, url.netloc, conn)
+        with self._lock:
+            mirror.record_success(latency, size,
+                                  time.monotonic() - started - latency)
+        return response
+
+    def probe(self, path):
+        """Find a file's size and whether mirrors serve byte ranges.
+
+        Takes:
+            path (str): The file's path relative to the mirror root.
+
+        Raises:
+            DownloadError: No mirror has the file.
+
+        Returns a tuple of (size as int or None, ranges supported as bool).
+        """
+        tried = []
+        while len(tried) < len(self.mirrors):
+            mirror = self._choose_mirror(0, exclude=tried)
+            tried.append(mirror)
+            try:
+                response = self._request(mirror, "HEAD", path, {})
+            except (OSError, http.client.HTTPException):
+                continue
+            finally:
+                with self._lock:
+                    mirror.active -= 1
+            if response.status != 200:
+                continue
+            length = response.getheader("Content-Length")
+            ranges = response.getheader("Accept-Ranges", "") == "bytes"
+            return (int(length) if length is not None else None, ranges)
+        raise DownloadError("No mirror has {}.".format(path))
+
+    def _fetch_range(self, job, start, end):
+        """Fetch bytes [start, end) of a job, failing over between mirrors.
+
+        `end` of None fetches the whole file without a Range header.
+
+        Returns the bytes if the job has no `dest`, otherwise None.
+        """
+        tried = []
+        attempts = 0
+        while True:
+            expected = (end - start) if end is not None else job.size
+            mirror = self._choose_mirror(expected or self.chunk_size,
+                                         exclude=tried)
+            tried.append(mirror)
+            if len(tried) >= len(self.mirrors):
+                tried = []
+
+            headers = {}
+            if end is not None:
+                headers["Range"] = "bytes={}-{}".format(start, end - 1)
+
+            if job.dest is None:
+                dest, offset = io.BytesIO(), 0
+            else:
+                dest, offset = open(job.dest, mode="r+b"), start
+            with dest:
+                dest.seek(offset)
+                try:
+                    response = self._request(
+                        mirror, "GET", job.path, headers, sink=dest.write,
+                        accept=(200,) if end is None else (206,))
+                    written = dest.tell() - offset
+                    ok = response.status in (200, 206)
+                    if ok and expected is not None and written != expected:
+                        with self._lock:
+                            mirror.record_failure()
+                        ok = False
+                except (OSError, http.client.HTTPException):
+                    ok = False
+                finally:
+                    with self._lock:
+                        mirror.active -= 1
+                if ok and end is None:
+                    dest.truncate()
+                if ok and job.dest is None:
+                    return dest.getvalue()
+
+            if ok:
+                return None
+            attempts += 1
+            if attempts > self.retries:
+                if end is None:
+                    raise DownloadError("Couldn't fetch {}.".format(job.path))
+                raise DownloadError("Couldn't fetch {} bytes {}-{}."
+                                    .format(job.path, start, end - 1))
+
+    def _plan(self, job):
+        """Split a job into (start, end) byte ranges."""
+        if not job.ranges or job.size is None or job.size <= self.chunk_size:
+            return [(0, None)]
+        # Make sure every mirror gets a share even for mid-sized files.
+        count = max(-(-job.size // self.chunk_size),
+                    min(len(self.mirrors), self.max_workers))
+        step = -(-job.size // count)
+        return [(start, min(start + step, job.size))
+                for start in range(0, job.size, step)]
+
+    def fetch_many(self, files):
+        """Download several files concurrently.
+
+        Takes:
+            files (list of tuple): (path, dest, size) for each file, where
+                `path` is relative to the mirror root, `dest` is the local
+                file to write, and `size` is the expected size in bytes or
+                None if unknown (the mirrors will be asked).
+
+        Raises:
+            DownloadError: A file couldn't be fetched from any mirror.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            jobs = [_Job(path, dest, size) for path, dest, size in files]
+
+            probes = {pool.submit(self.probe, job.path): job
+                      for job in jobs if job.size is None}
+            for future, job in probes.items():
+                job.size, job.ranges = future.result()
+
+            tasks = []
+            for job in jobs:
+                with open(job.dest, mode="wb") as dest:
+                    if job.size is not None:
+                        dest.truncate(job.size)
+                for start, end in self._plan(job):
+                    tasks.append(pool.submit(self._fetch_range, job,
+                                             start, end))
+
+            try:
+                for task in concurrent.futures.as_completed(tasks):
+                    task.result()
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+
+    def fetch_ranges(self, path, dest, ranges):
+        """Download some byte ranges of a file, concurrently.
+
+        Each range is written at the same offset of `dest`, which is left
+        sparse in between.
+
+        Takes:
+            path (str): The file's path relative to the mirror root.
+            dest (str): The local file to write. It must exist.
+            ranges (list of tuple): (start, end) byte ranges, `end`
+                                    exclusive.
+
+        Raises:
+            DownloadError: A range couldn't be fetched from any mirror.
+        """
+        job = _Job(path, dest, None)
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            tasks = [pool.submit(self._fetch_range, job, start, end)
+                     for start, end in ranges]
+            try:
+                for task in concurrent.futures.as_completed(tasks):
+                    task.result()
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+
+    def open(self, path, size=None):
+        """Open a file for sequential streaming.
+
+        Files known to be larger than `chunk_size` are fetched as byte
+        ranges spread over the mirrors, a few ranges ahead of the reader.
+
+        Takes:
+            path (str): The file's path relative to the mirror root.
+            size (int): The file's size in bytes, if known.
+
+        Returns a readable RangeStream or MirrorStream. Reads raise
+        DownloadError if the file can't be fetched from any mirror.
+        """
+        job = _Job(path, None, size)
+        ranges = self._plan(job)
+        if len(ranges) > 1:
+            return RangeStream(self, job, ranges,
+                               min(self.max_workers, 2 * len(self.mirrors)))
+        return MirrorStream(self, path)
+
+    def fetch(self, path, dest, size=None):
+        """Download a single file, split over the mirrors if it is large.
+
+        Takes:
+            path (str): The file's path relative to the mirror root.
+            dest (str): The local file to write.
+            size (int): The expected size in bytes, if known.
+
+        Raises:
+            DownloadError: The file couldn't be fetched from any mirror.
+        """
+        self.fetch_many([(path, dest, size)])
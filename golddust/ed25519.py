@@ -0,0 +1,319 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Pure Python Ed25519 (RFC 8032)
+
+A small implementation of the Ed25519 signature scheme, enough to sign and
+verify GoldDust packages without native dependencies.
+
+Verification only needs the message for SHA-512(R || A || M), so
+`StreamVerifier` can check a signature while the message is streamed
+through it, without ever holding the message in memory.
+
+`verify_batch` checks many signatures with one combined equation, which
+costs little more than a single verification when they share a key.
+Single and batch verification both use the cofactored equation (RFC 8032
+allows either), so they agree on signatures crafted with small-order
+points.
+
+Signing is not constant-time. Only sign on machines you trust.
+"""
+
+
+import hashlib
+import os
+
+
+_P = 2 ** 255 - 19
+_L = 2 ** 252 + 27742317777372353535851937790883648493
+_D = -121665 * pow(121666, _P - 2, _P) % _P
+_SQRT_M1 = pow(2, (_P - 1) // 4, _P)
+
+_IDENTITY = (0, 1, 1, 0)
+
+
+def _add(p, q):
+    """Add two points in extended homogeneous coordinates."""
+    a = (p[1] - p[0]) * (q[1] - q[0]) % _P
+    b = (p[1] + p[0]) * (q[1] + q[0]) % _P
+    c = 2 * p[3] * q[3] * _D % _P
+    d = 2 * p[2] * q[2] % _P
+    e, f, g, h = b - a, d - c, d + c, b + a
+    return (e * f % _P, g * h % _P, f * g % _P, e * h % _P)
+
+
+def _double(p):
+    a = p[0] * p[0] % _P
+    b = p[1] * p[1] % _P
+    c = 2 * p[2] * p[2] % _P
+    h = a + b
+    e = h - (p[0] + p[1]) ** 2
+    g = a - b
+    f = c + g
+    return (e * f % _P, g * h % _P, f * g % _P, e * h % _P)
+
+
+def _multiply(scalar, point):
+    result = _IDENTITY
+    while scalar > 0:
+        if scalar & 1:
+            result = _add(result, point)
+        point = _double(point)
+        scalar >>= 1
+    return result
+
+
+def _multiply_sum(terms):
+    """Compute the sum of scalar * point over (scalar, point) terms.
+
+    All terms share one chain of doublings (Straus' method), so each
+    extra term only costs its additions.
+    """
+    terms = [(scalar, point) for scalar, point in terms if scalar]
+    result = _IDENTITY
+    for bit in reversed(range(max((scalar.bit_length()
+                                   for scalar, _ in terms), default=0))):
+        result = _double(result)
+        for scalar, point in terms:
+            if (scalar >> bit) & 1:
+                result = _add(result, point)
+    return result
+
+
+def _negate(point):
+    return (-point[0] % _P, point[1], point[2], -point[3] % _P)
+
+
+def _equal(p, q):
+    return ((p[0] * q[2] - q[0] * p[2]) % _P == 0
+            and (p[1] * q[2] - q[1] * p[2]) % _P == 0)
+
+
+def _recover_x(y, sign):
+    if y >= _P:
+        return None
+    x2 = (y * y - 1) * pow(_D * y * y + 1, _P - 2, _P) % _P
+    if x2 == 0:
+        return None if sign else 0
+    x = pow(x2, (_P + 3) // 8, _P)
+    if (x * x - x2) % _P != 0:
+        x = x * _SQRT_M1 % _P
+    if (x * x - x2) % _P != 0:
+        return None
+    if (x & 1) != sign:
+        x = _P - x
+    return x
+
+
+def _compress(point):
+    z_inv = pow(point[2], _P - 2, _P)
+    x = point[0] * z_inv % _P
+    y = point[1] * z_inv % _P
+    return (y | ((x & 1) << 255)).to_bytes(32, "little")
+
+
+def _decompress(data):
+    if len(data) != 32:
+        return None
+    y = int.from_bytes(data, "little")
+    sign = y >> 255
+    y &= (1 << 255) - 1
+    x = _recover_x(y, sign)
+    if x is None:
+        return None
+    return (x, y, 1, x * y % _P)
+
+
+_G_Y = 4 * pow(5, _P - 2, _P) % _P
+_G_X = _recover_x(_G_Y, 0)
+_G = (_G_X, _G_Y, 1, _G_X * _G_Y % _P)
+
+
+def _hash_int(prefix, chunks):
+    digest = hashlib.sha512(prefix)
+    for chunk in chunks:
+        digest.update(chunk)
+    return int.from_bytes(digest.digest(), "little")
+
+
+def _expand_secret(secret_key):
+    if len(secret_key) != 32:
+        raise ValueError("Ed25519 secret keys are 32 bytes.")
+    digest = hashlib.sha512(secret_key).digest()
+    scalar = int.from_bytes(digest[:32], "little")
+    scalar &= (1 << 254) - 8
+    scalar |= 1 << 254
+    return scalar, digest[32:]
+
+
+def generate_secret_key():
+    """Generate a random 32 byte secret key (seed)."""
+    return os.urandom(32)
+
+
+def public_key(secret_key):
+    """Derive the 32 byte public key for a 32 byte secret key."""
+    scalar, _ = _expand_secret(secret_key)
+    return _compress(_multiply(scalar, _G))
+
+
+def sign(secret_key, message):
+    """Sign a message.
+
+    Takes:
+        secret_key (bytes): The 32 byte secret key (seed).
+        message (bytes): The message to sign.
+
+    Returns bytes, the 64 byte signature.
+    """
+    return sign_chunks(secret_key, lambda: (message,))
+
+
+def sign_chunks(secret_key, chunks):
+    """Sign a message without holding all of it in memory.
+
+    Signing needs two passes over the message, so `chunks` is called once
+    for each pass.
+
+    Takes:
+        secret_key (bytes): The 32 byte secret key (seed).
+        chunks (callable): Returns an iterable of the message's bytes.
+
+    Returns bytes, the 64 byte signature.
+    """
+    scalar, prefix = _expand_secret(secret_key)
+    public = _compress(_multiply(scalar, _G))
+    r = _hash_int(prefix, chunks()) % _L
+    r_bytes = _compress(_multiply(r, _G))
+    h = _hash_int(r_bytes + public, chunks()) % _L
+    s = (r + h * scalar) % _L
+    return r_bytes + s.to_bytes(32, "little")
+
+
+class StreamVerifier:
+    """Incrementally verify a signature over a streamed message.
+
+    Feed the message to `update` in as many pieces as needed, then call
+    `verify`.
+
+    Takes:
+        public_key (bytes): The 32 byte public key.
+        signature (bytes): The 64 byte signature.
+    """
+    def __init__(self, public_key, signature):
+        if len(signature) != 64:
+            raise ValueError("Ed25519 signatures are 64 bytes.")
+        self.public_key = public_key
+        self.signature = signature
+        self._hash = hashlib.sha512(signature[:32] + public_key)
+
+    def update(self, data):
+        """Feed the next piece of the message."""
+        self._hash.update(data)
+
+    def challenge(self):
+        """Get the challenge scalar h = SHA-512(R || A || M) mod L.
+
+        Only valid once the whole message has been fed to `update`.
+        """
+        return int.from_bytes(self._hash.digest(), "little") % _L
+
+    def verify(self):
+        """Check the signature against everything fed so far.
+
+        Returns bool, True if the signature is valid.
+        """
+        return _check(self.public_key, self.signature, self.challenge())
+
+
+def _check(public_key, signature, challenge):
+    """Check one signature with the cofactored equation
+    [8] ([s] G - R - [h] A) == 0, the same one `verify_batch` uses, so a
+    signature is accepted or rejected however it's batched."""
+    a = _decompress(public_key)
+    r = _decompress(signature[:32])
+    s = int.from_bytes(signature[32:], "little")
+    if a is None or r is None or s >= _L:
+        return False
+    return _is_small_order(_multiply_sum(
+        [(s, _G), (1, _negate(r)), (challenge, _negate(a))]))
+
+
+def _is_small_order(point):
+    """Check whether [8] point is the identity."""
+    for _ in range(3):
+        point = _double(point)
+    return _equal(point, _IDENTITY)
+
+
+def verify_batch(checks):
+    """Check several signatures at once.
+
+    Uses the cofactored verification equation with random 128-bit
+    weights z_i:
+
+        [8] ([sum z_i s_i] G - sum [z_i] R_i - sum [z_i h_i] A_i) == 0
+
+    which holds (except with negligible probability) only if every
+    signature is valid. Terms for the same public key are merged.
+
+    Takes:
+        checks (list of tuple): (public key bytes, signature bytes,
+            challenge int) for each signature, the challenge being
+            `StreamVerifier.challenge()`.
+
+    Returns bool, True if all signatures are valid. False means at least
+    one is invalid; check them one by one to find out which.
+    """
+    if len(checks) == 1:
+        return _check(*checks[0])
+
+    g_scalar = 0
+    key_scalars = {}
+    terms = []
+    for public_key, signature, challenge in checks:
+        r = _decompress(signature[:32])
+        s = int.from_bytes(signature[32:], "little")
+        if r is None or s >= _L:
+            return False
+        z = int.from_bytes(os.urandom(16), "little") | 1
+        g_scalar = (g_scalar + z * s) % _L
+        key_scalars[public_key] = (key_scalars.get(public_key, 0)
+                                   + z * challenge) % _L
+        terms.append((z, _negate(r)))
+
+    for public_key, scalar in key_scalars.items():
+        a = _decompress(public_key)
+        if a is None:
+            return False
+        terms.append((scalar, _negate(a)))
+    terms.append((g_scalar, _G))
+
+    return _is_small_order(_multiply_sum(terms))
+
+
+def verify(public_key, message, signature):
+    """Verify a signature over a message.
+
+    Takes:
+        public_key (bytes): The 32 byte public key.
+        message (bytes): The signed message.
+        signature (bytes): The 64 byte signature.
+
+    Returns bool, True if the signature is valid.
+    """
+    verifier = StreamVerifier(public_key, signature)
+    verifier.update(message)
+    return verifier.verify()
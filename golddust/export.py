@@ -0,0 +1,347 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Instance Exports
+
+`gdgame export` writes instances, and everything needed to recreate
+them, into one file for hosts that can't reach the repository (see
+GoldDust.export_instances and GoldDust.import_instances). The file is an
+uncompressed tar stream, since the archives in it are compressed already:
+
+    gdexport.json       The manifest; always the first member.
+    archives/<digest>   Each package archive, once however many of the
+                        instances install it.
+    jars/<key>          Each munged game JAR (see golddust.jars), once.
+
+The manifest holds the repository's name and public key, the name,
+version, codec and signature of every package by archive digest, the
+digest and size of every JAR by key, and each instance's configuration
+(see golddust.registry.InstanceConfig) and installed packages.
+
+Importing reads the stream once, front to back, so an export can be
+piped straight from another host. Each archive is hashed and fed to its
+signature check as it is copied into the package cache's staging area,
+and decompressed on a pool of threads while the stream moves on to the
+next one. Archives are checked against the repository key of the
+importing host, not the key in the manifest, unless told otherwise.
+
+Nothing else in the manifest is signed, so its digests, keys, names and
+paths are checked before anything is written, and imported JARs are only
+ever copied into the instances they belong to; they never enter the
+package cache, where other instances could pick them up.
+"""
+
+
+import concurrent.futures
+import io
+import json
+import os
+import re
+import tarfile
+
+from golddust import metrics
+from golddust.pkgcache import extract_archive, file_digest, new_digest
+
+
+MANIFEST_NAME = "gdexport.json"
+
+FORMAT_VERSION = 1
+
+_COPY_SIZE = 1024 * 1024
+
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_file(tar, name, path):
+    info = tar.gettarinfo(path, arcname=name)
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    info.mode = 0o644
+    with open(path, mode="rb") as source:
+        tar.addfile(info, source)
+
+
+def write_export(fileobj, manifest, cache, jar_paths):
+    """Write an export stream.
+
+    Takes:
+        fileobj (file-like): The binary file or stream to write to.
+        manifest (dict): The export manifest. The archives of its
+                         "packages" must be in the cache.
+        cache (golddust.pkgcache.PackageCache): The package cache.
+        jar_paths (dict): The file of each JAR in the manifest's "jars",
+                          by key.
+    """
+    with metrics.span("export.write", packages=len(manifest["packages"]),
+                      jars=len(manifest["jars"])), \
+            tarfile.open(fileobj=fileobj, mode="w|",
+                         format=tarfile.PAX_FORMAT) as tar:
+        _add_bytes(tar, MANIFEST_NAME,
+                   json.dumps(manifest, sort_keys=True).encode("utf-8"))
+        for digest in sorted(manifest["packages"]):
+            _add_file(tar, "archives/" + digest, cache.archive_path(digest))
+        for key in sorted(manifest["jars"]):
+            _add_file(tar, "jars/" + key, jar_paths[key])
+
+
+def jar_entry(path):
+    """Get the manifest entry of a JAR file."""
+    return {"digest": file_digest(path), "size": os.path.getsize(path)}
+
+
+def _check_relative(path):
+    """Make sure a path from a manifest stays inside the directory it is
+    relative to.
+
+    Raises:
+        ValueError: The path is absolute or climbs out with "..".
+    """
+    parts = path.replace("\\", "/").split("/")
+    if not path or os.path.isabs(path) or path.startswith(("/", "\\")) \
+            or ".." in parts or os.path.splitdrive(path)[0]:
+        raise ValueError("Unsafe path in export: {}".format(path))
+
+
+def _check_manifest(manifest):
+    """Make sure the unsigned parts of a manifest can't point outside
+    where they belong.
+
+    Raises:
+        ValueError: A digest, key, name or path is malformed, or an
+                    instance configuration has keys that aren't
+                    InstanceConfig settings.
+    """
+    from golddust.registry import InstanceConfig
+
+    # The settings an instance configuration has; anything else (such as
+    # `packages` or the private attributes) mustn't be set from here.
+    settings = {key for key in vars(InstanceConfig(None, ""))
+                if not key.startswith("_")}
+
+    def check_digest(value):
+        if not isinstance(value, str) or not _DIGEST.match(value):
+            raise ValueError("Bad digest in export: {!r}".format(value))
+
+    for digest in manifest["packages"]:
+        check_digest(digest)
+    for key, info in manifest["jars"].items():
+        check_digest(key)
+        check_digest(info["digest"])
+    for instance in manifest["instances"]:
+        config = instance["config"]
+        unknown = set(config) - settings
+        if unknown:
+            raise ValueError("Unknown instance settings in export: {}"
+                             .format(", ".join(sorted(map(str, unknown)))))
+        name = config["name"]
+        if not isinstance(name, str) or not name or name in (".", "..") \
+                or "/" in name or "\\" in name:
+            raise ValueError("Bad instance name in export: {!r}"
+                             .format(name))
+        for info in instance["packages"].values():
+            check_digest(info["digest"])
+        if config.get("jar"):
+            if not isinstance(config["jar"], dict) \
+                    or not isinstance(config["jar"].get("path"), str):
+                raise ValueError("Bad JAR of {} in export.".format(name))
+            check_digest(config["jar"]["key"])
+            if config["jar"]["key"] not in manifest["jars"]:
+                raise ValueError("JAR of {} is missing from the export."
+                                 .format(name))
+            _check_relative(config["jar"]["path"])
+
+
+class ExportReader:
+    """Reads an export stream.
+
+    The manifest is read as soon as the reader is created; call
+    `read_into` to stream the rest into a package cache.
+
+    Takes:
+        fileobj (file-like): The binary file or stream to read.
+
+    Raises:
+        ValueError: The stream isn't an export this version can read, or
+                    its manifest has unsafe names or paths.
+    """
+    def __init__(self, fileobj):
+        self._tar = tarfile.open(fileobj=fileobj, mode="r|")
+        member = self._tar.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise ValueError("Not a GoldDust export.")
+        self.manifest = json.loads(
+            self._tar.extractfile(member).read().decode("utf-8"))
+        """The export manifest."""
+        if self.manifest.get("format") != FORMAT_VERSION:
+            raise ValueError("Unsupported export format.")
+        _check_manifest(self.manifest)
+
+    def close(self):
+        """Stop reading the stream."""
+        self._tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _stage(self, cache, member, public_key, info):
+        """Copy an archive into the staging area, hashing it and feeding it
+        to its signature check on the way.
+
+        Returns a tuple of (staging file path, digest, verifier).
+        """
+        from golddust import signify
+
+        verifier = signify.Signature.from_string(
+            info["signature"]).verifier(public_key)
+        digest = new_digest()
+        archive, archive_path = cache.make_staging_file()
+        try:
+            with archive:
+                source = self._tar.extractfile(member)
+                for chunk in iter(lambda: source.read(_COPY_SIZE), b""):
+                    digest.update(chunk)
+                    verifier.update(chunk)
+                    archive.write(chunk)
+        except BaseException:
+            os.remove(archive_path)
+            raise
+        return archive_path, digest.hexdigest(), verifier
+
+    def _copy_jar(self, cache, member, key, info):
+        """Copy a JAR into the staging area after checking its digest.
+
+        Returns str, the staged file's path.
+        """
+        digest = new_digest()
+        jar, jar_path = cache.make_staging_file()
+        try:
+            with jar:
+                source = self._tar.extractfile(member)
+                for chunk in iter(lambda: source.read(_COPY_SIZE), b""):
+                    digest.update(chunk)
+                    jar.write(chunk)
+            if digest.hexdigest() != info["digest"]:
+                raise ValueError("JAR {} doesn't match its digest."
+                                 .format(key))
+        except BaseException:
+            os.remove(jar_path)
+            raise
+        return jar_path
+
+    def read_into(self, cache, public_key, workers=None):
+        """Stream the archives into a package cache, and the JARs into its
+        staging area.
+
+        Archives the cache already has verified with `public_key` are
+        skipped over. The JARs are only checked against the manifest's
+        digests, which aren't signed, so they are left for the caller to
+        copy into the instances that use them rather than committed to the
+        cache.
+
+        Takes:
+            cache (golddust.pkgcache.PackageCache): The package cache.
+            public_key (golddust.signify.PublicKey): The key the archives
+                                                     must be signed with.
+            workers (int): Threads decompressing archives, and processes
+                           checking signatures (see
+                           golddust.signify.verify_batch).
+
+        Raises:
+            golddust.signify.BadSignatureError: A signature was made with
+                                                another key.
+            ValueError: The export is truncated, or an archive or JAR
+                        doesn't match its digest.
+
+        Returns a tuple of a list of the tarballs whose signatures didn't
+        match (the others are committed), and a dict of the staged JAR
+        files by key, which the caller must remove.
+        """
+        from golddust import signify
+        from golddust.packages import Package
+        from golddust.pipeline import StagedArchive
+
+        packages = self.manifest["packages"]
+        jars = self.manifest["jars"]
+        needed = {digest for digest in packages
+                  if not (cache.has_tree(digest)
+                          and cache.is_verified(digest, public_key.key))}
+        staged = []
+        jar_files = {}
+        copied = 0
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool, \
+                metrics.span("export.read", packages=len(needed)) as span:
+            try:
+                for member in self._tar:
+                    kind, _, key = member.name.partition("/")
+                    if kind == "archives" and key in needed:
+                        info = packages[key]
+                        package = Package()
+                        package.name = info["name"]
+                        package.version = info["version"]
+                        package.codec = info["codec"]
+                        archive_path, digest, verifier = self._stage(
+                            cache, member, public_key, info)
+                        copied += member.size
+                        if digest != key:
+                            os.remove(archive_path)
+                            raise ValueError("Archive {} doesn't match its "
+                                             "digest.".format(key))
+                        staging_dir = cache.make_staging_dir()
+                        staged.append((package, StagedArchive(
+                            cache, digest, verifier, archive_path,
+                            staging_dir, package.tarball), pool.submit(
+                                extract_archive, archive_path, staging_dir)))
+                        needed.discard(key)
+                    elif kind == "jars" and key in jars \
+                            and key not in jar_files:
+                        jar_files[key] = self._copy_jar(cache, member, key,
+                                                        jars[key])
+                missing = needed | (set(jars) - set(jar_files))
+                if missing:
+                    raise ValueError("The export is missing {}."
+                                     .format(", ".join(sorted(missing))))
+
+                for _, _, extraction in staged:
+                    extraction.result()
+                results = signify.verify_batch(
+                    [archive.verifier for _, archive, _ in staged], workers)
+            except BaseException:
+                for _, archive, extraction in staged:
+                    extraction.cancel()
+                    concurrent.futures.wait([extraction])
+                    archive.discard()
+                for jar_path in jar_files.values():
+                    os.remove(jar_path)
+                raise
+            span.set(bytes=copied)
+
+        bad = []
+        for (package, archive, _), valid in zip(staged, results):
+            if valid:
+                archive.commit()
+            else:
+                archive.discard()
+                bad.append(package.tarball)
+        return bad, jar_files
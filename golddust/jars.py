@@ -0,0 +1,183 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust JAR Munging
+
+Packages that modify the Minecraft JAR do so in `InstallScript.munge_jar`.
+Rather than rewriting the zip once per package, the JAR is read into
+memory once, every package's `munge_jar` is applied to the same `Jar` in
+install order, and the result is written once.
+
+Munged JARs are kept in the package cache (`<pkgcache>/jars/`), keyed by
+the digest of the base JAR and the ordered list of munging packages, so
+instances with the same JAR mods share one build.
+"""
+
+
+import os
+import zipfile
+
+from golddust import metrics
+from golddust.pkgcache import JAR, file_digest, link_file, new_digest
+
+
+_SIGNATURE_SUFFIXES = (".SF", ".RSA", ".DSA", ".EC")
+
+
+class Jar:
+    """The entries of a JAR file, held in memory.
+
+    Entries keep their original order and timestamps; new entries are
+    added at the end.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    @classmethod
+    def load(cls, path):
+        """Read a JAR file."""
+        jar = cls()
+        with zipfile.ZipFile(path, mode="r") as archive:
+            for info in archive.infolist():
+                jar._entries[info.filename] = (info, archive.read(info))
+        return jar
+
+    def save(self, fileobj):
+        """Write the JAR to a binary file."""
+        with zipfile.ZipFile(fileobj, mode="w",
+                             compression=zipfile.ZIP_DEFLATED) as archive:
+            for info, data in self._entries.values():
+                archive.writestr(info, data)
+
+    def names(self):
+        """Get the names of all entries, in order."""
+        return list(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def read(self, name):
+        """Get an entry's contents.
+
+        Raises:
+            KeyError: The JAR has no such entry.
+        """
+        return self._entries[name][1]
+
+    def write(self, name, data):
+        """Add or replace an entry.
+
+        Takes:
+            name (str): The entry name, using "/" separators.
+            data (bytes): The new contents.
+        """
+        if name in self._entries:
+            info = self._entries[name][0]
+        else:
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self._entries[name] = (info, data)
+
+    def remove(self, name):
+        """Remove an entry, if it exists."""
+        self._entries.pop(name, None)
+
+    def strip_signatures(self):
+        """Remove the JAR signature files, which any modification breaks."""
+        for name in self.names():
+            if name.startswith("META-INF/") \
+                    and name.upper().endswith(_SIGNATURE_SUFFIXES):
+                del self._entries[name]
+
+
+def munge_key(base_digest, mungers):
+    """Compute the cache key of a munged JAR.
+
+    Takes:
+        base_digest (str): The digest of the unmodified JAR.
+        mungers (list of str): Identifiers of the munging packages (their
+                               archive digests), in the order applied.
+
+    Returns str, the hex key.
+    """
+    digest = new_digest()
+    digest.update(base_digest.encode("ascii"))
+    for munger in mungers:
+        digest.update(b"\0" + munger.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def compose_jar(cache, base_jar, dest, contributions):
+    """Build a modded JAR, reusing a cached build if there is one.
+
+    Takes:
+        cache (golddust.pkgcache.PackageCache): The package cache.
+        base_jar (str): The unmodified JAR.
+        dest (str): Where to put the modded JAR. Replaced if it exists.
+        contributions (list): (identifier str, InstallScript) tuples of the
+                              packages that munge the JAR, in install
+                              order.
+
+    Returns str, the cache key of the modded JAR.
+    """
+    key = munge_key(file_digest(base_jar),
+                    [identifier for identifier, _ in contributions])
+    with cache.lock(key):
+        _build(cache, key, base_jar, contributions)
+        place_jar(cache, key, dest)
+    return key
+
+
+def _build(cache, key, base_jar, contributions):
+    """Build a modded JAR into the cache, unless it's already there."""
+    with metrics.span("munge_jar", mungers=len(contributions),
+                      key=key) as span:
+        cached = cache.jar_path(key)
+        span.set(cached=os.path.isfile(cached))
+        if os.path.isfile(cached):
+            cache.touch(key, JAR)
+        else:
+            jar = Jar.load(base_jar)
+            for identifier, script in contributions:
+                with metrics.span("munge_jar.script", package=identifier):
+                    script.munge_jar(jar)
+            staged, staged_path = cache.make_staging_file()
+            try:
+                with staged:
+                    jar.save(staged)
+                cache.commit_jar(staged_path, key)
+            except BaseException:
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+                raise
+        span.set(bytes=os.path.getsize(cached))
+
+
+def place_jar(cache, key, dest):
+    """Link a cached JAR into place, replacing what is there.
+
+    Takes:
+        cache (golddust.pkgcache.PackageCache): The package cache.
+        key (str): The cache key of the JAR.
+        dest (str): Where to put it.
+    """
+    directory, file_name = os.path.split(os.path.abspath(dest))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, ".{}.gdtmp".format(file_name))
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    link_file(cache.jar_path(key), tmp_path, cache.link_mode)
+    os.replace(tmp_path, dest)
@@ -0,0 +1,196 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Locks
+
+Several gdgame processes (and threads) may work on one GoldDust home at
+once. Each piece of state that can be changed has its own reader/writer
+lock, so only operations on the same thing wait for each other:
+
+    <gdhome>/locks/config              The global configuration.
+    <gdhome>/locks/instances/<name>    An instance's files and records.
+    <pkgcache>/locks/<aa>/<key>        A package cache entry (readers are
+                                       operations linking from it, the
+                                       writer is eviction).
+
+The locks are `flock(2)` locks on those files, taken shared by readers
+and exclusive by writers. They are held by open file descriptions, so
+they work between threads as well as processes, and the kernel drops
+them if a process dies. Lock files may be removed while locked (such as
+when an instance is removed); a process that was waiting on a removed
+file notices and locks the new one instead.
+
+A thread may take a lock it already holds again (as when rolling back an
+instance takes a snapshot of it), but it can't upgrade a shared lock to
+an exclusive one.
+
+Where `fcntl` isn't available, locks only count nesting and don't
+exclude anything.
+"""
+
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCKS_DIR_NAME = "locks"
+
+_local = threading.local()
+
+
+def _holdings():
+    """Get the locks held by this thread: [shared, count] by path."""
+    try:
+        return _local.holdings
+    except AttributeError:
+        _local.holdings = {}
+        return _local.holdings
+
+
+class LockBusy(Exception):
+    """A lock was asked for without waiting and is held elsewhere."""
+
+
+class FileLock:
+    """A reader/writer lock on a lock file.
+
+    Use it as a context manager, or call `acquire` and `release`.
+
+    Takes:
+        path (str): The lock file. It and its directory are created as
+                    needed.
+        shared (bool): Take a shared (reader) lock rather than an exclusive
+                       (writer) one.
+    """
+    def __init__(self, path, shared=False):
+        self.path = os.path.abspath(path)
+        self.shared = shared
+        self._fd = None
+        self._nested = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self, blocking=True):
+        """Take the lock.
+
+        Takes:
+            blocking (bool): Wait for the lock if another thread or process
+                             holds it; otherwise raise LockBusy.
+
+        Raises:
+            LockBusy: `blocking` is False and the lock is held elsewhere.
+            RuntimeError: This thread holds the lock shared and asked for
+                          it exclusive, waiting.
+        """
+        holdings = _holdings()
+        held = holdings.get(self.path)
+        if held is not None:
+            if held[0] and not self.shared:
+                if not blocking:
+                    raise LockBusy("{} is locked.".format(self.path))
+                raise RuntimeError("Can't upgrade the shared lock on {}."
+                                   .format(self.path))
+            held[1] += 1
+            self._nested = True
+            return
+
+        while True:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    operation = fcntl.LOCK_SH if self.shared \
+                        else fcntl.LOCK_EX
+                    if not blocking:
+                        operation |= fcntl.LOCK_NB
+                    try:
+                        fcntl.flock(fd, operation)
+                    except BlockingIOError:
+                        raise LockBusy("{} is locked.".format(self.path))
+                # The file may have been removed by its holder (see
+                # `remove`) while this waited; that lock guards nothing.
+                try:
+                    current = os.stat(self.path)
+                except FileNotFoundError:
+                    current = None
+                if current is not None \
+                        and os.path.samestat(os.fstat(fd), current):
+                    break
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+        self._fd = fd
+        holdings[self.path] = [self.shared, 1]
+
+    def release(self):
+        """Release the lock."""
+        holdings = _holdings()
+        holdings[self.path][1] -= 1
+        if self._nested:
+            self._nested = False
+            return
+        del holdings[self.path]
+        fd, self._fd = self._fd, None
+        os.close(fd)
+
+    def remove(self):
+        """Delete the lock file while holding the lock exclusively, when
+        what it guards is gone."""
+        held = _holdings().get(self.path)
+        if held is None or held[0]:
+            raise RuntimeError("Only a holder of the exclusive lock may "
+                               "remove its file.")
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MultiLock:
+    """Several locks taken together, in a fixed order so that two holders
+    of overlapping sets can't deadlock.
+
+    Takes:
+        locks (iterable of FileLock): The locks.
+    """
+    def __init__(self, locks):
+        self.locks = sorted(locks, key=lambda lock: lock.path)
+
+    def __enter__(self):
+        taken = []
+        try:
+            for lock in self.locks:
+                lock.acquire()
+                taken.append(lock)
+        except BaseException:
+            for lock in reversed(taken):
+                lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
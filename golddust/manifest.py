@@ -0,0 +1,318 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Instance File Manifests
+
+Every file GoldDust puts into an instance is recorded in the instance
+registry with its path, size, mtime, digest and owning package. Installing
+a package compares the package's cached manifest (see
+`PackageCache.manifest`) against those records, so upgrading a package
+only rewrites the files whose digest changed, or that were modified since
+they were installed, and only deletes the files the new version dropped.
+
+The same records let `check_files` find damaged or missing files quickly:
+a file whose size and mtime match its record is taken to be intact
+without reading it, and only the rest are hashed. `repair_files` puts
+intact copies back from the package cache.
+"""
+
+
+import os
+import stat
+
+from golddust import metrics
+from golddust.pkgcache import link_file, mapped_digest
+
+_CHECK_CHUNK = 256
+"""Files checked per task by `check_files`."""
+
+
+def _local_path(dest, rel_path):
+    return os.path.join(dest, *rel_path.split("/"))
+
+
+def _unchanged(path, entry):
+    """Check whether an installed file still looks like its record."""
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return info.st_size == entry["size"] \
+        and info.st_mtime_ns == entry["mtime_ns"]
+
+
+def _put(source, path, link_mode):
+    """Link a cached file into an instance, replacing what is there."""
+    directory, file_name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, ".{}.gdtmp".format(file_name))
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    link_file(source, tmp_path, link_mode)
+    os.replace(tmp_path, path)
+
+
+def _remove(dest, rel_paths):
+    """Delete installed files and any directories they leave empty."""
+    for rel_path in rel_paths:
+        try:
+            os.remove(_local_path(dest, rel_path))
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(rel_path)
+        while directory:
+            try:
+                os.rmdir(_local_path(dest, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+def sync_package(cache, digest, dest, package_name, installed,
+                 subdir="game"):
+    """Bring a package's files in an instance in line with a cached tree.
+
+    This is both a fresh install and an upgrade (or downgrade) from
+    whatever version of the package the instance had.
+
+    Takes:
+        cache (golddust.pkgcache.PackageCache): The package cache.
+        digest (str): The archive digest of the version to install.
+        dest (str): The instance directory.
+        package_name (str): The name of the package being installed.
+        installed (dict): The instance's current manifest; entries of
+                          every package by relative path (see
+                          `InstanceRegistry.files`).
+        subdir (str): The directory in the package tree to install.
+
+    Raises:
+        FileExistsError: A file of the package is already in the instance
+                         and doesn't belong to this package. Nothing is
+                         changed in that case.
+
+    Returns a tuple of (the package's new manifest entries by path, list of
+    paths written, list of paths removed).
+    """
+    target = cache.manifest(digest, subdir)
+    source_root = os.path.join(cache.tree_path(digest), subdir)
+    owned = {rel_path: entry for rel_path, entry in installed.items()
+             if entry["package"] == package_name}
+
+    for rel_path in target:
+        entry = installed.get(rel_path)
+        if entry is not None and entry["package"] != package_name:
+            raise FileExistsError("{} belongs to package {}."
+                                  .format(rel_path, entry["package"]))
+        if entry is None and os.path.lexists(_local_path(dest, rel_path)):
+            raise FileExistsError("{} already exists in the instance."
+                                  .format(rel_path))
+
+    files = {}
+    written = []
+    for rel_path, entry in sorted(target.items()):
+        path = _local_path(dest, rel_path)
+        old = owned.get(rel_path)
+        if old is None or old["digest"] != entry["digest"] \
+                or not _unchanged(path, old):
+            _put(os.path.join(source_root, *rel_path.split("/")), path,
+                 cache.link_mode)
+            written.append(rel_path)
+        info = os.lstat(path)
+        files[rel_path] = {"package": package_name, "size": info.st_size,
+                           "mtime_ns": info.st_mtime_ns,
+                           "digest": entry["digest"]}
+
+    removed = sorted(set(owned) - set(target))
+    _remove(dest, removed)
+    return files, written, removed
+
+
+def remove_package(dest, package_name, installed):
+    """Delete a package's files from an instance.
+
+    Takes:
+        dest (str): The instance directory.
+        package_name (str): The package to remove.
+        installed (dict): The instance's current manifest.
+
+    Returns a list of the removed paths.
+    """
+    removed = sorted(rel_path for rel_path, entry in installed.items()
+                     if entry["package"] == package_name)
+    _remove(dest, removed)
+    return removed
+
+
+def _check(path, entry, full):
+    """Check one installed file against its record.
+
+    Returns a tuple of (the problem: None, "missing" or "modified"; the
+    new {"size", "mtime_ns"} if the file is intact but its mtime changed,
+    else None; the number of bytes hashed).
+    """
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return "missing", None, 0
+    if not stat.S_ISREG(info.st_mode) or info.st_size != entry["size"]:
+        return "modified", None, 0
+    if info.st_mtime_ns == entry["mtime_ns"] and not full:
+        return None, None, 0
+    try:
+        digest = mapped_digest(path)
+    except OSError:
+        return "modified", None, 0
+    if digest != entry["digest"]:
+        return "modified", None, info.st_size
+    if info.st_mtime_ns == entry["mtime_ns"]:
+        return None, None, info.st_size
+    return None, {"size": info.st_size,
+                  "mtime_ns": info.st_mtime_ns}, info.st_size
+
+
+def check_files(dest, installed, workers=None, full=False):
+    """Find the installed files of an instance that are damaged or missing.
+
+    Files whose size and mtime match their records are taken to be intact
+    without reading them, unless `full`. The others are hashed through
+    memory maps (see `golddust.pkgcache.mapped_digest`) on a pool of
+    threads, which run in parallel since hashing releases the GIL.
+
+    Takes:
+        dest (str): The instance directory.
+        installed (dict): The instance's manifest (see
+                          `InstanceRegistry.files`).
+        workers (int): Threads checking files. Defaults to the number of
+                       CPUs.
+        full (bool): Hash every file.
+
+    Returns a tuple of (dict of "missing" or "modified" by path, dict of
+    new {"size", "mtime_ns"} by path of intact files whose mtime changed,
+    for `InstanceRegistry.restamp`).
+    """
+    paths = sorted(installed)
+
+    def check_chunk(chunk):
+        results = []
+        for rel_path in chunk:
+            results.append((rel_path,) + _check(
+                _local_path(dest, rel_path), installed[rel_path], full))
+        return results
+
+    chunks = [paths[start:start + _CHECK_CHUNK]
+              for start in range(0, len(paths), _CHECK_CHUNK)]
+    workers = workers or os.cpu_count() or 1
+    problems = {}
+    stamps = {}
+    with metrics.span("verify.scan", files=len(paths)) as span:
+        if workers == 1 or len(chunks) < 2:
+            hashed = _collect(map(check_chunk, chunks), problems, stamps)
+        else:
+            # Only needed for big instances.
+            import concurrent.futures
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers) as pool:
+                hashed = _collect(pool.map(check_chunk, chunks), problems,
+                                  stamps)
+        span.set(bytes=hashed, problems=len(problems))
+    return problems, stamps
+
+
+def _collect(results, problems, stamps):
+    """Gather the results of `check_files`' chunks.
+
+    Returns the number of bytes hashed.
+    """
+    hashed = 0
+    for chunk in results:
+        for rel_path, problem, stamp, size in chunk:
+            if problem is not None:
+                problems[rel_path] = problem
+            elif stamp is not None:
+                stamps[rel_path] = stamp
+            hashed += size
+    return hashed
+
+
+def repair_files(cache, dest, installed, digests, paths, subdir="game",
+                 fetch=None):
+    """Put intact copies of damaged or missing files back into an instance.
+
+    Each file is linked again from its package's tree in the package
+    cache. Tree files that are damaged too (modifying a file hardlinked
+    into an instance in place changes the cache's copy) or missing are
+    extracted from the cached archive again first, and only those (or
+    fetched with `fetch`, if the archive isn't cached).
+
+    Takes:
+        cache (golddust.pkgcache.PackageCache): The package cache.
+        dest (str): The instance directory.
+        installed (dict): The instance's manifest.
+        digests (dict): The archive digest of each installed package, by
+                        package name.
+        paths (iterable of str): The files to repair.
+        subdir (str): The directory in the package trees that is
+                      installed.
+        fetch (callable): Puts intact copies of tree files back whose
+            archive isn't cached, such as `BundleIndex.restore` bound to a
+            bundle; takes the digest and paths in the tree like
+            `PackageCache.restore` and returns the set of paths it found.
+
+    Returns a dict of new {"size", "mtime_ns"} by path of the repaired
+    files, for `InstanceRegistry.restamp`. Files of packages whose archive
+    isn't cached any more can't be repaired and are left out.
+    """
+    by_package = {}
+    for rel_path in paths:
+        by_package.setdefault(installed[rel_path]["package"],
+                              []).append(rel_path)
+
+    prefix = subdir.strip("/") + "/" if subdir else ""
+    stamps = {}
+    for package, rel_paths in sorted(by_package.items()):
+        digest = digests.get(package)
+        if not digest or not (cache.has_tree(digest)
+                              or cache.has_archive(digest)):
+            continue
+        with metrics.span("repair", package=package, files=len(rel_paths)):
+            source_root = os.path.join(cache.tree_path(digest), subdir)
+
+            def source(rel_path):
+                return os.path.join(source_root, *rel_path.split("/"))
+
+            def intact(rel_path):
+                try:
+                    return mapped_digest(source(rel_path)) \
+                        == installed[rel_path]["digest"]
+                except FileNotFoundError:
+                    return False
+
+            damaged = {rel_path for rel_path in rel_paths
+                       if not intact(rel_path)}
+            restore = cache.restore if cache.has_archive(digest) else fetch
+            if damaged and restore is not None:
+                restore(digest, [prefix + rel_path for rel_path in damaged])
+                damaged = {rel_path for rel_path in damaged
+                           if not intact(rel_path)}
+            for rel_path in rel_paths:
+                if rel_path in damaged:
+                    continue
+                path = _local_path(dest, rel_path)
+                _put(source(rel_path), path, cache.link_mode)
+                info = os.lstat(path)
+                stamps[rel_path] = {"size": info.st_size,
+                                    "mtime_ns": info.st_mtime_ns}
+    return stamps
@@ -0,0 +1,299 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Profiling Metrics
+
+GoldDust operations record timed spans for each phase of their work
+(config loads, resolution, downloads per mirror, verification,
+decompression, extraction, JAR munging, install scripts, installs) along
+with byte counts. Nothing is recorded unless a recorder is enabled:
+
+    recorder = metrics.enable()
+    ...
+    metrics.disable()
+    recorder.write("metrics.json")                  # summary + spans
+    recorder.write("trace.json", format="chrome")   # chrome://tracing
+
+Phases that are interleaved in a single streaming pass (such as
+decompression and extraction in golddust.pipeline) can't be separate
+spans; their time is added to counters named "<phase>.seconds" instead.
+"""
+
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_recorder = None
+
+
+def now():
+    """Get the clock value spans are measured with."""
+    return time.perf_counter()
+
+
+def peak_memory():
+    """Get the peak resident memory of this process in bytes, or None if
+    the platform can't tell."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Span:
+    """A timed phase of work.
+
+    Takes:
+        name (str): The phase name, such as "download".
+        attrs (dict): Details of this span, such as the mirror or byte
+                      count.
+    """
+    __slots__ = ("name", "start", "duration", "thread", "attrs",
+                 "peak_memory")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.start = now()
+        self.duration = 0.0
+        self.thread = threading.get_ident()
+        self.attrs = attrs
+        self.peak_memory = None
+
+    def set(self, **attrs):
+        """Set details of the span."""
+        self.attrs.update(attrs)
+
+    def add(self, key, amount):
+        """Add to a numeric detail of the span, such as "bytes"."""
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+
+class _NullSpan:
+    """Stands in for a Span while nothing is being recorded."""
+    def set(self, **attrs):
+        pass
+
+    def add(self, key, amount):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Recorder:
+    """Collects spans and counters."""
+    def __init__(self):
+        self.origin = now()
+        """Clock value at which recording started."""
+        self.spans = []
+        """Finished spans, in the order they ended."""
+        self.counters = collections.Counter()
+        """Totals by counter name."""
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        """Store a finished span."""
+        span.peak_memory = peak_memory()
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name, amount):
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] += amount
+
+    def summary(self):
+        """Aggregate the spans by name.
+
+        Returns a dict of {"count", "seconds", "bytes"} dicts by span name.
+        """
+        totals = collections.OrderedDict()
+        for span in sorted(self.spans, key=lambda span: span.start):
+            total = totals.setdefault(span.name, {"count": 0,
+                                                  "seconds": 0.0,
+                                                  "bytes": 0})
+            total["count"] += 1
+            total["seconds"] += span.duration
+            total["bytes"] += span.attrs.get("bytes", 0)
+        return totals
+
+    def to_dict(self):
+        """Get the recording as a JSON-compatible dict."""
+        return {
+            "wall_seconds": now() - self.origin,
+            "peak_memory_bytes": peak_memory(),
+            "summary": self.summary(),
+            "counters": dict(self.counters),
+            "spans": [{"name": span.name,
+                       "start": span.start - self.origin,
+                       "seconds": span.duration,
+                       "thread": span.thread,
+                       "peak_memory_bytes": span.peak_memory,
+                       "attrs": span.attrs} for span in self.spans],
+        }
+
+    def to_chrome_trace(self):
+        """Get the recording in the Chrome trace event format."""
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            events.append({"name": span.name, "cat": "golddust", "ph": "X",
+                           "ts": (span.start - self.origin) * 1e6,
+                           "dur": span.duration * 1e6, "pid": pid,
+                           "tid": span.thread, "args": span.attrs})
+            if span.peak_memory is not None:
+                events.append({"name": "peak memory", "ph": "C",
+                               "ts": (span.start + span.duration
+                                      - self.origin) * 1e6,
+                               "pid": pid,
+                               "args": {"bytes": span.peak_memory}})
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"counters": dict(self.counters)}}
+
+    def write(self, path, format="json"):
+        """Write the recording to a file.
+
+        Takes:
+            path (str): The file to write.
+            format (str): "json" for `to_dict`, "chrome" for
+                          `to_chrome_trace`.
+        """
+        if format == "chrome":
+            data = self.to_chrome_trace()
+        elif format == "json":
+            data = self.to_dict()
+        else:
+            raise ValueError("Unknown metrics format: {}".format(format))
+        with open(path, mode="w") as out:
+            json.dump(data, out, indent=1, default=str)
+
+
+def enable():
+    """Start recording.
+
+    Returns the new Recorder.
+    """
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable():
+    """Stop recording.
+
+    Returns the Recorder that was active, or None.
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def enabled():
+    """Check whether anything is being recorded."""
+    return _recorder is not None
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Time a phase of work.
+
+    Yields the Span, so details found along the way can be added to it.
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield _NULL_SPAN
+        return
+    current = Span(name, attrs)
+    try:
+        yield current
+    except BaseException as err:
+        current.attrs["error"] = type(err).__name__
+        raise
+    finally:
+        current.duration = now() - current.start
+        recorder.add_span(current)
+
+
+def record(name, start, **attrs):
+    """Record a span that started at `start` (see `now`) and ends now."""
+    recorder = _recorder
+    if recorder is not None:
+        current = Span(name, attrs)
+        current.start = start
+        current.duration = now() - start
+        recorder.add_span(current)
+
+
+def count(name, amount=1):
+    """Add to a counter, if recording."""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, amount)
+
+
+def timed(func, counter, totals=None):
+    """Wrap a callable to add the time spent in it to a counter.
+
+    Takes:
+        func (callable): The callable to time.
+        counter (str): The counter name.
+        totals (collections.Counter): Where to add the time; defaults to
+                                      the recorder's counters.
+
+    Returns `func` itself while nothing is being recorded.
+    """
+    if _recorder is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        started = now()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if totals is None:
+                count(counter, now() - started)
+            else:
+                totals[counter] += now() - started
+    return wrapper
+
+
+class TimedReader:
+    """Wraps a readable file to add the time spent reading to a counter.
+
+    Takes:
+        fileobj (file-like): The file to read.
+        counter (str): The counter name.
+        totals (collections.Counter): See `timed`.
+    """
+    def __init__(self, fileobj, counter, totals=None):
+        self._fileobj = fileobj
+        self.read = timed(fileobj.read, counter, totals)
+        if hasattr(fileobj, "readinto"):
+            self.readinto = timed(fileobj.readinto, counter, totals)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
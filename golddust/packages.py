@@ -17,16 +17,131 @@
 """
 
 
+import importlib.util
+import os
+
+from golddust.compression import (CODECS, DEFAULT_CODEC, get_codec,
+                                  negotiate_codec)
+
+
+INSTALL_SCRIPT_NAME = "package.py"
+
+
 class Package:
     """A package managed by GoldDust"""
     def __init__(self):
         self.name = ""
         self.version = ""
+        self._digest = None
+        self._codec = None
+        self.archives = {}
+        """Archives offered for this package, by codec name. Each is a dict
+        with the archive's "digest" and "size"."""
+        self.dependencies = {}
+        """Version constraints (see golddust.versions) of the packages this
+        one needs, by package name."""
+        self.conflicts = {}
+        """Version constraints of packages that can't be installed along
+        with this one, by package name."""
+        self.description = ""
+        """A short description of the package, for searching."""
+        self.game_versions = []
+        """The game versions (such as "1.7.10") the package works with."""
+        self.loader = ""
+        """The mod loader the package needs (such as "forge"), if any."""
+
+    @classmethod
+    def from_dict(cls, metadata):
+        """Create a package from its metadata dict."""
+        package = cls()
+        package.name = metadata["name"]
+        package.version = metadata["version"]
+        package.archives = dict(metadata.get("archives", {}))
+        package.dependencies = dict(metadata.get("dependencies", {}))
+        package.conflicts = dict(metadata.get("conflicts", {}))
+        package.description = metadata.get("description", "")
+        package.game_versions = list(metadata.get("game_versions", []))
+        package.loader = metadata.get("loader", "")
+        return package
+
+    def to_dict(self):
+        """Get the metadata dict of this package."""
+        metadata = {"name": self.name, "version": self.version,
+                    "archives": self.archives}
+        if self.dependencies:
+            metadata["dependencies"] = self.dependencies
+        if self.conflicts:
+            metadata["conflicts"] = self.conflicts
+        if self.description:
+            metadata["description"] = self.description
+        if self.game_versions:
+            metadata["game_versions"] = self.game_versions
+        if self.loader:
+            metadata["loader"] = self.loader
+        return metadata
+
+    @property
+    def codec(self):
+        """The compression codec of the archive (see golddust.compression).
+
+        Unless set, the fastest of the offered `archives` that can be
+        read here is chosen when it's first needed (see `select_codec`),
+        which raises ValueError if there is none. Set it to None to choose
+        again.
+        """
+        if self._codec is None:
+            if not self.archives:
+                return DEFAULT_CODEC
+            self.select_codec()
+        return self._codec
+
+    @codec.setter
+    def codec(self, name):
+        self._codec = name
+
+    @property
+    def digest(self):
+        """The hex digest of the archive, which keys it in the pkgcache.
+
+        Unless set, this is the digest of the `codec` archive.
+        """
+        if self._digest is None:
+            if not self.archives:
+                return ""
+            return self.archives.get(self.codec, {}).get("digest", "")
+        return self._digest
+
+    @digest.setter
+    def digest(self, digest):
+        self._digest = digest
+
+    def installable(self):
+        """Check whether any of the offered archives can be read here."""
+        return not self.archives or any(
+            name in CODECS and CODECS[name].available()
+            for name in self.archives)
+
+    def select_codec(self):
+        """Choose the fastest of the offered archives to install.
+
+        Sets `codec` and `digest` to those of the chosen archive.
+
+        Raises:
+            ValueError: None of the offered codecs can be used here.
+        """
+        self._codec = negotiate_codec(sorted(self.archives))
+        self._digest = self.archives[self._codec].get("digest", "")
 
     @property
     def tarball(self):
         """The tarball file name for this package."""
-        return "{}-{}.tar.bz2".format(self.name, self.version)
+        return "{}-{}{}".format(self.name, self.version,
+                                get_codec(self.codec).extension)
+
+    @property
+    def metadata_file(self):
+        """The metadata file name for this package."""
+        return "{}-{}.json".format(self.name, self.version)
 
     @property
     def sig_file(self):
@@ -42,8 +157,15 @@ class InstallScript:
 
     Note that JAR modification should only be done using the `munge_jar`
     function. This lets GoldDust know that you're modifying the JAR so it
-    can properly handle other JAR mod packages as well.
+    can properly handle other JAR mod packages as well: the JAR is read
+    once, every package's `munge_jar` is applied to it in install order,
+    and it is written once (see golddust.jars).
     """
+    instance_path = None
+    """The directory the package is being installed into. Set by GoldDust
+    before `pre_install` is called; during a batch install this is a
+    staging copy of the instance, not its final path."""
+
     def pre_install(self):
         """Called before any files are installed.
         """
@@ -51,10 +173,44 @@ class InstallScript:
 
     def munge_jar(self, jar):
         """Modify the Minecraft JAR file.
+
+        Takes:
+            jar (golddust.jars.Jar): The JAR's entries, already modified by
+                                     the packages installed before this one.
         """
         pass
 
+    def munges_jar(self):
+        """Check whether this script overrides `munge_jar`."""
+        return type(self).munge_jar is not InstallScript.munge_jar
+
     def post_install(self):
         """Called after files are installed.
         """
         pass
+
+
+def load_install_script(package_root):
+    """Load a package's install script, if it has one.
+
+    Takes:
+        package_root (str): The root of the package tree.
+
+    Raises:
+        ValueError: `package.py` has no InstallScript subclass.
+
+    Returns an instance of the script's InstallScript subclass, or None if
+    the package has no `package.py`.
+    """
+    path = os.path.join(package_root, INSTALL_SCRIPT_NAME)
+    if not os.path.isfile(path):
+        return None
+    spec = importlib.util.spec_from_file_location(
+        "golddust_install_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for value in vars(module).values():
+        if isinstance(value, type) and issubclass(value, InstallScript) \
+                and value is not InstallScript:
+            return value()
+    raise ValueError("{} has no InstallScript.".format(path))
@@ -0,0 +1,251 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Streaming Install Pipeline
+
+Package archives are read exactly once. As the bytes arrive they are fed
+at the same time to the cache digest, the Ed25519 signature check, a copy
+of the archive in the package cache, and the decompressor (picked by
+golddust.compression from the archive's magic bytes) feeding tar
+extraction into a staging directory. The staged archive and tree are only
+committed to the package cache once the signature checks out.
+
+`stage_archive` leaves out that final check, so the signatures of many
+staged archives can be checked together with
+golddust.signify.verify_batch. Committed archives are marked as verified
+with the repository key in the cache, and never need checking again.
+
+Memory use is bounded by the read buffers, whatever the archive size.
+"""
+
+
+import collections
+import io
+import os
+import shutil
+import tarfile
+
+from golddust import metrics
+from golddust.compression import open_archive_reader
+from golddust.pkgcache import extract_members, new_digest
+from golddust.signify import BadSignatureError
+
+
+_BUFFER_SIZE = 256 * 1024
+
+
+class _TeeReader(io.RawIOBase):
+    """Passes every byte read from `source` on to each of `sinks`."""
+    def __init__(self, source, sinks):
+        super().__init__()
+        self._source = source
+        self._sinks = sinks
+        self.position = 0
+        """Number of bytes passed through."""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if hasattr(self._source, "readinto"):
+            count = self._source.readinto(buffer)
+        else:
+            data = self._source.read(len(buffer))
+            count = len(data)
+            buffer[:count] = data
+        if count:
+            self.position += count
+            view = memoryview(buffer)[:count]
+            for sink in self._sinks:
+                sink(view)
+        return count
+
+
+class StagedArchive:
+    """A package archive in the package cache's staging area, waiting for
+    its signature to be checked.
+
+    Call `commit` if `verifier` checks out and `discard` otherwise.
+    """
+    def __init__(self, cache, digest, verifier, archive_path=None,
+                 staging_dir=None, tarball=None):
+        self.cache = cache
+        self.digest = digest
+        """The hex digest of the archive."""
+        self.verifier = verifier
+        """The golddust.ed25519.StreamVerifier, fed the whole archive."""
+        self.tarball = tarball
+        self._archive_path = archive_path
+        self._staging_dir = staging_dir
+
+    def commit(self):
+        """Move the archive and its tree into the cache and record that its
+        signature checked out.
+
+        Returns str, the digest of the archive.
+        """
+        if self._archive_path is not None:
+            self.cache.commit_archive(self._archive_path, self.digest)
+            self.cache.commit_tree(self._staging_dir, self.digest)
+            self._archive_path = self._staging_dir = None
+        else:
+            self.cache.extract(self.digest)
+        if self.tarball:
+            self.cache.set_alias(self.tarball, self.digest)
+        self.cache.mark_verified(self.digest, self.verifier.public_key,
+                                 self.verifier.signature)
+        return self.digest
+
+    def discard(self):
+        """Delete the staged archive and tree."""
+        if self._archive_path is not None:
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            os.remove(self._archive_path)
+            self._archive_path = self._staging_dir = None
+
+
+def stage_archive(source, signature, public_key, cache, tarball=None,
+                  expected_digest=None):
+    """Stream a package archive into the package cache's staging area in
+    a single pass, leaving only the final signature check.
+
+    Takes:
+        source (file-like): Readable binary stream of the archive, such
+                            as a golddust.download.MirrorStream.
+        signature (golddust.signify.Signature): The archive's detached
+                                                signature.
+        public_key (golddust.signify.PublicKey): The repository key.
+        cache (golddust.pkgcache.PackageCache): The cache to stage in.
+        tarball (str): Optionally, the tarball name to alias the archive as.
+        expected_digest (str): Optionally, the digest the archive must have.
+
+    Raises:
+        golddust.signify.BadSignatureError: The signature was made with
+                                            another key.
+        ValueError: The archive is unsafe or doesn't match
+                    `expected_digest`.
+
+    Returns a StagedArchive.
+    """
+    verifier = signature.verifier(public_key)
+    digest = new_digest()
+    staging_dir = cache.make_staging_dir()
+    archive, archive_path = cache.make_staging_file()
+    # Time spent in each interleaved phase, when profiling.
+    times = collections.Counter()
+
+    with metrics.span("stage_archive", tarball=tarball) as span:
+        try:
+            with archive:
+                tee = _TeeReader(
+                    metrics.TimedReader(source, "read", times),
+                    [metrics.timed(digest.update, "digest", times),
+                     metrics.timed(verifier.update, "verify", times),
+                     metrics.timed(archive.write, "cache_write", times)])
+                reader = io.BufferedReader(tee, _BUFFER_SIZE)
+                with open_archive_reader(reader) as tar_stream:
+                    tar_input = metrics.TimedReader(tar_stream, "tar_input",
+                                                    times)
+                    with tarfile.open(fileobj=tar_input, mode="r|") as tar:
+                        extract_members(tar, staging_dir)
+                    # Let the decompressor consume the rest of the archive.
+                    while tar_input.read(_BUFFER_SIZE):
+                        pass
+                # Whatever follows the tar end marker is still signed data.
+                while reader.read(_BUFFER_SIZE):
+                    pass
+
+            hex_digest = digest.hexdigest()
+            if expected_digest and hex_digest != expected_digest:
+                raise ValueError("Archive digest {} doesn't match expected {}."
+                                 .format(hex_digest, expected_digest))
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            os.remove(archive_path)
+            raise
+
+        if metrics.enabled():
+            # Reads of the tar stream include decompressing and everything
+            # the tee does underneath; the rest of the span is extraction.
+            tee_time = (times["read"] + times["digest"] + times["verify"]
+                        + times["cache_write"])
+            phases = {"read": times["read"], "digest": times["digest"],
+                      "verify": times["verify"],
+                      "cache_write": times["cache_write"],
+                      "decompress": max(0.0, times["tar_input"] - tee_time),
+                      "extract": max(0.0, metrics.now() - span.start
+                                     - times["tar_input"])}
+            span.set(bytes=tee.position, digest=hex_digest,
+                     **{"{}_seconds".format(phase): seconds
+                        for phase, seconds in phases.items()})
+            for phase, seconds in phases.items():
+                metrics.count("{}.seconds".format(phase), seconds)
+            metrics.count("stage_archive.bytes", tee.position)
+    return StagedArchive(cache, hex_digest, verifier, archive_path,
+                         staging_dir, tarball)
+
+
+def stage_cached(cache, digest, signature, public_key, tarball=None):
+    """Prepare to check a cached archive against a signature it hasn't been
+    verified with yet (see `PackageCache.is_verified`).
+
+    Takes:
+        cache (golddust.pkgcache.PackageCache): The package cache.
+        digest (str): The digest of the cached archive.
+        signature (golddust.signify.Signature): The archive's detached
+                                                signature.
+        public_key (golddust.signify.PublicKey): The repository key.
+        tarball (str): Optionally, the tarball name to alias the archive as.
+
+    Raises:
+        golddust.signify.BadSignatureError: The signature was made with
+                                            another key.
+        KeyError: The archive isn't in the cache.
+
+    Returns a StagedArchive whose `commit` records the verification.
+    """
+    if not cache.has_archive(digest):
+        raise KeyError("Archive {} is not in the cache.".format(digest))
+    verifier = signature.verifier(public_key)
+    with metrics.span("stage_cached", digest=digest), \
+            open(cache.archive_path(digest), mode="rb") as archive:
+        for chunk in iter(lambda: archive.read(_BUFFER_SIZE), b""):
+            verifier.update(chunk)
+    return StagedArchive(cache, digest, verifier, tarball=tarball)
+
+
+def verify_and_extract(source, signature, public_key, cache, tarball=None,
+                       expected_digest=None):
+    """Stream a package archive into the package cache in a single pass.
+
+    Takes the same arguments as `stage_archive`.
+
+    Raises:
+        golddust.signify.BadSignatureError: The signature doesn't match.
+        ValueError: The archive is unsafe or doesn't match
+                    `expected_digest`.
+
+    Returns str, the digest the archive is cached under.
+    """
+    with metrics.span("verify_and_extract", tarball=tarball):
+        staged = stage_archive(source, signature, public_key, cache,
+                               tarball, expected_digest)
+        with metrics.span("verify"):
+            valid = staged.verifier.verify()
+        if not valid:
+            staged.discard()
+            raise BadSignatureError("Bad signature for {}."
+                                    .format(tarball or "package archive"))
+        return staged.commit()
@@ -0,0 +1,1048 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Package Cache
+
+The package cache (`<gdhome>/pkgcache`) is shared by every instance of a
+GoldDust home. It is content-addressed: archives and their extracted
+trees are stored under the hex digest of the archive bytes, and a
+`Package.tarball` file name is only an alias for a digest.
+
+Layout:
+    <pkgcache>
+      archives/<aa>/<digest>    Package archives as downloaded.
+      trees/<aa>/<digest>/      Each archive, extracted once per host.
+      aliases/<tarball>         Text file holding the digest of a tarball.
+      manifests/<aa>/<digest>   Size and digest of every file of a tree.
+      jars/<aa>/<key>           Munged game JARs (see golddust.jars).
+      verified/<aa>/<digest>/<key>
+                                Marker: the archive's signature was
+                                checked against this public key (hex).
+                                Holds the raw signature, if known.
+      tmp/                      Staging area on the same filesystem.
+      locks/<aa>/<key>          Entry locks (see golddust.locks).
+      index.db                  Size and last use of every entry.
+
+Instances get their files linked out of the extracted tree (see
+`link_file`), so a package costs disk space and extraction time once per
+host rather than once per instance.
+
+The cache is kept under a size cap by `PackageCache.collect`, which
+evicts the least recently used entries that no instance references. The
+SQLite index keeps the size and last use time of every package (its
+archive, tree and manifest together) and munged JAR, ordered by last use,
+so neither the cap check nor picking what to evict walks the cache.
+"""
+
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from golddust import metrics
+from golddust.locks import LOCKS_DIR_NAME, FileLock, LockBusy
+
+DIGEST_ALGORITHM = "sha256"
+"""The hash used to address cache entries."""
+
+INDEX_FILE_NAME = "index.db"
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS aliases (
+    tarball TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_digest ON aliases (digest);
+"""
+
+_INDEX_VERSION = 1
+
+_BUSY_TIMEOUT = 60.0
+"""Seconds to wait for another process's index write transaction."""
+
+PACKAGE = "package"
+"""Index entry kind of a package: its archive, tree and manifest."""
+
+JAR = "jar"
+"""Index entry kind of a munged JAR."""
+
+_TOUCH_INTERVAL = 60.0
+"""Seconds within which repeated uses of an entry aren't written down."""
+
+_CHUNK_SIZE = 1024 * 1024
+
+# ioctl(2) request number of FICLONE on Linux (see ioctl_ficlone(2)).
+_FICLONE = 0x40049409
+
+
+def new_digest():
+    """Get a new hash object for computing cache digests."""
+    return hashlib.new(DIGEST_ALGORITHM)
+
+
+def file_digest(path):
+    """Compute the cache digest of a file.
+
+    Takes:
+        path (str): The file to hash.
+
+    Returns str, the hex digest of the file contents.
+    """
+    digest = new_digest()
+    with open(path, mode="rb") as source:
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def mapped_digest(path):
+    """Compute the cache digest of a file through a memory map of it.
+
+    The whole file is hashed in one call, without copying it into Python
+    objects, and the GIL is released for all of it, so threads hashing
+    different files run in parallel.
+
+    Takes:
+        path (str): The file to hash.
+
+    Returns str, the hex digest of the file contents.
+    """
+    digest = new_digest()
+    with open(path, mode="rb") as source:
+        if os.fstat(source.fileno()).st_size:
+            with mmap.mmap(source.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+
+def check_member(member):
+    """Make sure a tar member is safe to extract.
+
+    Takes:
+        member (tarfile.TarInfo): The archive member to check.
+
+    Raises:
+        ValueError: The member escapes the extraction directory or is a
+                    device/FIFO.
+    """
+    name = member.name.replace("\\", "/")
+    if name.startswith("/") or ".." in name.split("/"):
+        raise ValueError("Unsafe path in archive: {}".format(member.name))
+    if member.isdev():
+        raise ValueError("Device file in archive: {}".format(member.name))
+    if member.issym() or member.islnk():
+        target = member.linkname.replace("\\", "/")
+        if member.issym():
+            target = os.path.join(os.path.dirname(name), target)
+        target = os.path.normpath(target).replace("\\", "/")
+        if target.startswith("/") or target.split("/")[0] == "..":
+            raise ValueError("Link escapes archive: {}".format(member.name))
+
+
+def check_inside(root, path):
+    """Make sure a path stays inside a directory once every symlink in it
+    is resolved, as the ones archives put on disk can lead anywhere.
+
+    Raises:
+        ValueError: The path escapes `root`.
+    """
+    real_root = os.path.realpath(root)
+    real_path = os.path.realpath(path)
+    if real_path != real_root \
+            and not real_path.startswith(real_root.rstrip(os.sep) + os.sep):
+        raise ValueError("Path escapes {}: {}".format(root, path))
+
+
+def _member_path(dest, member):
+    return os.path.join(dest, *member.name.replace("\\", "/").split("/"))
+
+
+def extract_member(tar, member, dest):
+    """Extract a tar member, making sure it (and anything it links to)
+    lands inside the destination directory.
+
+    `check_member` only looks at the member's own names, so this also
+    resolves the links earlier members put on disk, such as a chain of
+    links that each climb one directory.
+
+    Takes:
+        tar (tarfile.TarFile): The archive being read.
+        member (tarfile.TarInfo): The member to extract.
+        dest (str): The directory to extract into.
+
+    Raises:
+        ValueError: The member is unsafe.
+    """
+    import tarfile
+
+    check_member(member)
+    path = _member_path(dest, member)
+    check_inside(dest, os.path.dirname(path))
+    check_inside(dest, path)
+    if member.issym():
+        check_inside(dest, os.path.join(
+            os.path.realpath(os.path.dirname(path)), member.linkname))
+    elif member.islnk():
+        check_inside(dest, os.path.join(dest, member.linkname))
+    # Python's own checks as well, where it has them.
+    options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    try:
+        tar.extract(member, dest, set_attrs=False, **options)
+    except getattr(tarfile, "FilterError", ()) as err:
+        raise ValueError("Unsafe member in archive: {}".format(
+            member.name)) from err
+
+
+def extract_members(tar, dest):
+    """Extract every member of a tar stream with `extract_member`.
+
+    A later link can change where an earlier one leads, so every link is
+    checked again once all of them are in place.
+
+    Raises:
+        ValueError: A member is unsafe.
+    """
+    links = []
+    for member in tar:
+        extract_member(tar, member, dest)
+        if member.issym():
+            links.append(_member_path(dest, member))
+    for path in links:
+        check_inside(dest, path)
+
+
+def extract_archive(path, dest):
+    """Extract a package archive of any codec.
+
+    Takes:
+        path (str): The archive.
+        dest (str): The directory to extract into.
+
+    Raises:
+        ValueError: The archive is unsafe (see `extract_member`).
+    """
+    # Only needed on a cache miss; importing them up front slows down
+    # every gdgame invocation.
+    import tarfile
+    from golddust.compression import open_archive_reader
+
+    with open(path, mode="rb") as archive, \
+            open_archive_reader(archive) as tar_stream, \
+            tarfile.open(fileobj=tar_stream, mode="r|") as tar:
+        extract_members(tar, dest)
+
+
+def _reflink(src, dst):
+    """Clone `src` into a new file `dst` sharing its data blocks.
+
+    Raises OSError if the filesystem doesn't support reflinks."""
+    import fcntl
+
+    with open(src, mode="rb") as source:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, _FICLONE, source.fileno())
+        except OSError:
+            os.close(fd)
+            os.remove(dst)
+            raise
+        os.close(fd)
+    shutil.copystat(src, dst)
+
+
+def link_file(src, dst, mode="auto"):
+    """Materialize a cached file at `dst` without copying it if possible.
+
+    Reflinks give the destination its own copy-on-write file, so it is
+    always safe to modify. Hardlinks share the inode with the cache, so
+    anything GoldDust itself writes must go through `break_link` first.
+
+    Takes:
+        src (str): The file in the cache.
+        dst (str): The destination path. Must not exist.
+        mode (str): "reflink", "hardlink", "copy", or "auto" to try each
+                    of those in order.
+
+    Raises:
+        OSError: The requested mode is not supported for these paths.
+
+    Returns str, the mode that was actually used.
+    """
+    if mode in ("auto", "reflink") and sys.platform.startswith("linux"):
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except OSError:
+            if mode == "reflink":
+                raise
+
+    if mode in ("auto", "hardlink"):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as err:
+            if mode == "hardlink" or err.errno == errno.EEXIST:
+                raise
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def break_link(path):
+    """Give a hardlinked file its own private copy.
+
+    Call this before modifying a file that may have been linked out of
+    the package cache.
+
+    Takes:
+        path (str): The file to unshare.
+    """
+    if os.stat(path).st_nlink < 2:
+        return
+    fd, private = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    os.close(fd)
+    try:
+        shutil.copy2(path, private)
+        os.chmod(private, os.stat(path).st_mode | 0o200)
+        os.replace(private, path)
+    except BaseException:
+        os.remove(private)
+        raise
+
+
+def clone_tree(src, dst, link_mode="auto", shared=None):
+    """Recreate a directory tree with its files linked from the original.
+
+    Hardlinked files are the same file in both trees, so they are only
+    safe for files that are never written in place (GoldDust itself always
+    replaces files). Other files are reflinked if possible and copied if
+    not, so either tree can modify them freely.
+
+    Takes:
+        src (str): The directory to clone.
+        dst (str): The new directory. Must be empty or not exist.
+        link_mode (str): How to link files; see `link_file`.
+        shared (set of str): Paths relative to `src`, using "/"
+                             separators, that may be hardlinked. None
+                             allows every file.
+    """
+    os.makedirs(dst, exist_ok=True)
+    for dir_path, dir_names, file_names in os.walk(src):
+        rel_dir = os.path.relpath(dir_path, src)
+        target_dir = os.path.join(dst, rel_dir)
+        for dir_name in list(dir_names):
+            source = os.path.join(dir_path, dir_name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source),
+                           os.path.join(target_dir, dir_name))
+                dir_names.remove(dir_name)
+            else:
+                os.mkdir(os.path.join(target_dir, dir_name))
+                shutil.copystat(source, os.path.join(target_dir, dir_name))
+        for file_name in file_names:
+            source = os.path.join(dir_path, file_name)
+            target = os.path.join(target_dir, file_name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_dir, file_name))
+            if shared is None or rel_path.replace(os.sep, "/") in shared:
+                link_file(source, target, link_mode)
+                continue
+            if link_mode in ("auto", "reflink"):
+                try:
+                    link_file(source, target, "reflink")
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
+
+
+def _disk_usage(path):
+    """Get the total size of a file, or of the files in a directory tree.
+
+    Returns int, 0 if the path doesn't exist.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.lstat(path).st_size
+    except FileNotFoundError:
+        return 0
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.lstat(os.path.join(dir_path, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _remove(path):
+    """Remove a file or directory tree if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class PackageCache:
+    """A content-addressed package store shared between instances."""
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        """The path to the cache (normally <gdhome>/pkgcache)."""
+        self.link_mode = "auto"
+        """How files are linked into instances. See `link_file`."""
+        self.index_path = os.path.join(self.root, INDEX_FILE_NAME)
+        self._index = None
+        self._indexed = False
+        self._index_lock = threading.RLock()
+        self._touched = {}
+
+    def _connect(self):
+        if self._index is None:
+            os.makedirs(self.root, exist_ok=True)
+            connection = sqlite3.connect(self.index_path,
+                                         timeout=_BUSY_TIMEOUT,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < _INDEX_VERSION:
+                with connection:
+                    connection.executescript(_INDEX_SCHEMA)
+            # A cache filled before it had an index is indexed by the first
+            # `size` or `collect`.
+            self._indexed = version >= _INDEX_VERSION
+            self._index = connection
+        return self._index
+
+    def close(self):
+        """Close the index database connection."""
+        with self._index_lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+    def _grow(self, kind, key, size):
+        """Add to the size of an index entry, creating it if needed, and
+        mark it used now."""
+        now = time.time()
+        with self._index_lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO entries (kind, key, size, last_used) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT (kind, key) DO UPDATE "
+                    "SET size = size + excluded.size, "
+                    "last_used = excluded.last_used",
+                    (kind, key, size, now))
+            self._touched[kind, key] = now
+
+    def touch(self, key, kind=PACKAGE):
+        """Mark a cache entry as used now, for least recently used
+        eviction.
+
+        Takes:
+            key (str): The digest of a package, or the key of a munged JAR.
+            kind (str): `PACKAGE` or `JAR`.
+        """
+        now = time.time()
+        if now - self._touched.get((kind, key), 0.0) < _TOUCH_INTERVAL:
+            return
+        with self._index_lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "UPDATE entries SET last_used = ? "
+                    "WHERE kind = ? AND key = ? AND last_used < ?",
+                    (now, kind, key, now - _TOUCH_INTERVAL))
+            self._touched[kind, key] = now
+
+    def _sharded(self, kind, digest):
+        return os.path.join(self.root, kind, digest[:2], digest)
+
+    def _tmp_dir(self):
+        path = os.path.join(self.root, "tmp")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def archive_path(self, digest):
+        """Get the path a cached archive is (or would be) stored at."""
+        return self._sharded("archives", digest)
+
+    def tree_path(self, digest):
+        """Get the path an archive is (or would be) extracted to."""
+        return self._sharded("trees", digest)
+
+    def manifest_path(self, digest):
+        """Get the path a tree's file manifest is (or would be) stored at."""
+        return self._sharded("manifests", digest)
+
+    def jar_path(self, key):
+        """Get the path a munged JAR is (or would be) stored at."""
+        return self._sharded("jars", key)
+
+    def lock(self, key, shared=True):
+        """Get the lock of a cache entry; see golddust.locks.
+
+        Operations linking files out of an entry hold it shared for as
+        long as they use it; `collect` only evicts entries it can lock
+        exclusively.
+
+        Takes:
+            key (str): The digest of a package, or the key of a munged JAR.
+            shared (bool): Lock it for reading.
+
+        Returns a golddust.locks.FileLock.
+        """
+        return FileLock(self._sharded(LOCKS_DIR_NAME, key), shared)
+
+    def _verified_path(self, digest, public_key):
+        return os.path.join(self._sharded("verified", digest),
+                            public_key.hex())
+
+    def is_verified(self, digest, public_key):
+        """Check whether an archive's signature was checked with a key.
+
+        Takes:
+            digest (str): The digest of the archive.
+            public_key (bytes): The raw Ed25519 public key.
+        """
+        return os.path.isfile(self._verified_path(digest, public_key))
+
+    def mark_verified(self, digest, public_key, signature=b""):
+        """Record that an archive's signature checked out with a key, so it
+        needn't be checked again; see `is_verified`.
+
+        Takes:
+            digest (str): The digest of the archive.
+            public_key (bytes): The raw Ed25519 public key.
+            signature (bytes): The raw Ed25519 signature, kept so the
+                               archive can be passed on signed (see
+                               golddust.export). Empty if there was none,
+                               as for trees fetched from a bundle.
+        """
+        path = self._verified_path(digest, public_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if signature and self.signature(digest, public_key) != signature:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, mode="wb") as marker:
+                marker.write(signature)
+            os.replace(tmp_path, path)
+        else:
+            open(path, mode="a").close()
+
+    def signature(self, digest, public_key):
+        """Get the signature an archive was verified with.
+
+        Takes:
+            digest (str): The digest of the archive.
+            public_key (bytes): The raw Ed25519 public key.
+
+        Returns bytes, the raw Ed25519 signature, or None if the archive
+        wasn't verified with the key or its signature wasn't kept.
+        """
+        try:
+            with open(self._verified_path(digest, public_key),
+                      mode="rb") as marker:
+                return marker.read() or None
+        except FileNotFoundError:
+            return None
+
+    def has_archive(self, digest):
+        """Check whether the archive for `digest` is in the cache."""
+        return os.path.isfile(self.archive_path(digest))
+
+    def has_tree(self, digest):
+        """Check whether the archive for `digest` has been extracted."""
+        return os.path.isdir(self.tree_path(digest))
+
+    def resolve(self, tarball):
+        """Look up the digest a tarball name is an alias for.
+
+        Takes:
+            tarball (str): A `Package.tarball` file name.
+
+        Returns the hex digest as a str, or None if the alias is unknown
+        or its archive has been evicted.
+        """
+        try:
+            with open(os.path.join(self.root, "aliases", tarball),
+                      mode="r") as alias:
+                digest = alias.read().strip() or None
+        except FileNotFoundError:
+            return None
+        if digest and not (self.has_archive(digest)
+                           or self.has_tree(digest)):
+            return None
+        return digest
+
+    def set_alias(self, tarball, digest):
+        """Point a tarball file name at a digest.
+
+        Takes:
+            tarball (str): A `Package.tarball` file name.
+            digest (str): The hex digest of the archive.
+        """
+        if os.path.basename(tarball) != tarball:
+            raise ValueError("Tarball alias must be a plain file name.")
+        alias_dir = os.path.join(self.root, "aliases")
+        os.makedirs(alias_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=alias_dir)
+        with os.fdopen(fd, mode="w") as alias:
+            alias.write(digest + "\n")
+        os.replace(tmp_path, os.path.join(alias_dir, tarball))
+        with self._index_lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO aliases (tarball, digest) "
+                    "VALUES (?, ?)", (tarball, digest))
+
+    def add_archive(self, path, tarball=None):
+        """Copy an archive into the cache.
+
+        Takes:
+            path (str): The archive to add.
+            tarball (str): Optionally, the tarball name to alias it as.
+
+        Returns str, the digest the archive is stored under.
+        """
+        digest = file_digest(path)
+        if not self.has_archive(digest):
+            fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir())
+            os.close(fd)
+            shutil.copyfile(path, tmp_path)
+            self.commit_archive(tmp_path, digest)
+        if tarball:
+            self.set_alias(tarball, digest)
+        return digest
+
+    def commit_archive(self, tmp_path, digest):
+        """Move a fully written archive from the staging area into place.
+
+        If another process committed the same digest first, `tmp_path` is
+        discarded instead.
+
+        Takes:
+            tmp_path (str): The staged archive, under the cache's tmp dir.
+            digest (str): The verified digest of the archive.
+        """
+        target = self.archive_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        existed = os.path.isfile(target)
+        os.replace(tmp_path, target)
+        if not existed:
+            self._grow(PACKAGE, digest, os.path.getsize(target))
+
+    def commit_tree(self, staging_dir, digest):
+        """Move a fully extracted tree from the staging area into place.
+
+        If another process committed the same digest first, `staging_dir`
+        is discarded instead.
+
+        Takes:
+            staging_dir (str): The staged tree, under the cache's tmp dir.
+            digest (str): The digest of the archive it was extracted from.
+
+        Returns str, the path of the committed tree.
+        """
+        target = self.tree_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        size = _disk_usage(staging_dir)
+        try:
+            os.rename(staging_dir, target)
+        except OSError:
+            if not self.has_tree(digest):
+                raise
+            shutil.rmtree(staging_dir)
+        else:
+            self._grow(PACKAGE, digest, size)
+        return target
+
+    def commit_jar(self, tmp_path, key):
+        """Move a fully written munged JAR from the staging area into
+        place.
+
+        Takes:
+            tmp_path (str): The staged JAR, under the cache's tmp dir.
+            key (str): The JAR's key; see golddust.jars.munge_key.
+
+        Returns str, the path of the committed JAR.
+        """
+        target = self.jar_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        existed = os.path.isfile(target)
+        os.replace(tmp_path, target)
+        if not existed:
+            self._grow(JAR, key, os.path.getsize(target))
+        return target
+
+    def make_staging_dir(self):
+        """Create an empty directory in the cache's staging area."""
+        return tempfile.mkdtemp(dir=self._tmp_dir())
+
+    def make_staging_file(self):
+        """Create an empty file in the cache's staging area.
+
+        Returns a tuple of (file object opened for binary writing, path).
+        """
+        fd, path = tempfile.mkstemp(dir=self._tmp_dir())
+        return os.fdopen(fd, mode="wb"), path
+
+    def extract(self, digest):
+        """Extract a cached archive, unless that was already done.
+
+        Takes:
+            digest (str): The digest of a cached archive.
+
+        Raises:
+            KeyError: The archive isn't in the cache.
+
+        Returns str, the path of the extracted tree.
+        """
+        if self.has_tree(digest):
+            self.touch(digest)
+            return self.tree_path(digest)
+        if not self.has_archive(digest):
+            raise KeyError("Archive {} is not in the cache.".format(digest))
+
+        staging_dir = self.make_staging_dir()
+        with metrics.span("extract", digest=digest,
+                          bytes=os.path.getsize(self.archive_path(digest))):
+            try:
+                extract_archive(self.archive_path(digest), staging_dir)
+            except BaseException:
+                shutil.rmtree(staging_dir)
+                raise
+            return self.commit_tree(staging_dir, digest)
+
+    def restore(self, digest, names):
+        """Extract some files of a cached archive into its tree again,
+        replacing whatever is there.
+
+        This repairs tree files that were damaged, such as through a
+        hardlink into an instance. The archive is read only as far as the
+        last file wanted.
+
+        Takes:
+            digest (str): The digest of a cached archive.
+            names (iterable of str): Paths in the archive, using "/"
+                                     separators.
+
+        Raises:
+            KeyError: The archive isn't in the cache.
+
+        Returns a set of the names that were found in the archive.
+        """
+        wanted = set(names)
+        if not self.has_archive(digest):
+            raise KeyError("Archive {} is not in the cache.".format(digest))
+        if not self.has_tree(digest):
+            tree = self.extract(digest)
+            return {name for name in wanted
+                    if os.path.isfile(os.path.join(tree, *name.split("/")))}
+
+        import tarfile
+        from golddust.compression import open_archive_reader
+
+        tree = self.tree_path(digest)
+        found = set()
+        staging_dir = self.make_staging_dir()
+        with metrics.span("restore", digest=digest, files=len(wanted)):
+            try:
+                with open(self.archive_path(digest), mode="rb") as archive, \
+                        open_archive_reader(archive) as tar_stream, \
+                        tarfile.open(fileobj=tar_stream, mode="r|") as tar:
+                    for member in tar:
+                        name = os.path.normpath(member.name).replace(
+                            os.sep, "/")
+                        if name not in wanted or not member.isfile():
+                            continue
+                        extract_member(tar, member, staging_dir)
+                        target = os.path.join(tree, *name.split("/"))
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        check_inside(tree, target)
+                        os.replace(os.path.join(staging_dir, member.name),
+                                   target)
+                        found.add(name)
+                        if found == wanted:
+                            break
+            finally:
+                shutil.rmtree(staging_dir)
+        return found
+
+    def manifest(self, digest, subdir="game"):
+        """Get the size and digest of every file in an extracted package.
+
+        Files are only hashed the first time a tree's manifest is needed;
+        the result is kept next to the tree.
+
+        Takes:
+            digest (str): The digest of a cached archive.
+            subdir (str): The directory in the package tree to list.
+
+        Raises:
+            KeyError: The archive isn't in the cache.
+
+        Returns a dict of {"size", "digest"} dicts by path relative to
+        `subdir`, using "/" separators.
+        """
+        path = self.manifest_path(digest)
+        try:
+            with open(path, mode="r") as manifest_file:
+                files = json.load(manifest_file)
+            self.touch(digest)
+        except FileNotFoundError:
+            tree = self.extract(digest)
+            files = {}
+            for dir_path, _, file_names in os.walk(tree):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    rel_path = os.path.relpath(file_path, tree)
+                    files[rel_path.replace(os.sep, "/")] = {
+                        "size": os.path.getsize(file_path),
+                        "digest": file_digest(file_path)}
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir())
+            with os.fdopen(fd, mode="w") as manifest_file:
+                json.dump(files, manifest_file, sort_keys=True)
+            os.replace(tmp_path, path)
+            self._grow(PACKAGE, digest, os.path.getsize(path))
+
+        prefix = subdir.strip("/") + "/" if subdir else ""
+        return {rel_path[len(prefix):]: entry
+                for rel_path, entry in files.items()
+                if rel_path.startswith(prefix)}
+
+    def link_tree(self, digest, dest, subdir="game"):
+        """Link the files of an extracted package into an instance.
+
+        Takes:
+            digest (str): The digest of a cached archive.
+            dest (str): The instance directory to link into.
+            subdir (str): The directory in the package tree to install.
+
+        Raises:
+            FileExistsError: A file from the package already exists in
+                             `dest`.
+
+        Returns a list of the installed paths, relative to `dest`.
+        """
+        source_root = os.path.join(self.extract(digest), subdir)
+        installed = []
+        for dir_path, dir_names, file_names in os.walk(source_root):
+            dir_names.sort()
+            rel_dir = os.path.relpath(dir_path, source_root)
+            target_dir = os.path.normpath(os.path.join(dest, rel_dir))
+            os.makedirs(target_dir, exist_ok=True)
+            for file_name in sorted(file_names):
+                link_file(os.path.join(dir_path, file_name),
+                          os.path.join(target_dir, file_name),
+                          self.link_mode)
+                installed.append(os.path.normpath(
+                    os.path.join(rel_dir, file_name)))
+        return installed
+
+    def reindex(self):
+        """Rebuild the index from the files in the cache.
+
+        Entries already indexed keep their last use time; new ones get the
+        time their newest file was written.
+        """
+        entries = {}
+
+        def add(kind, key, path):
+            stat = os.lstat(path)
+            size, last_used = entries.get((kind, key), (0, 0.0))
+            entries[kind, key] = (size + _disk_usage(path),
+                                  max(last_used, stat.st_mtime))
+
+        for kind, top in ((PACKAGE, "archives"), (PACKAGE, "trees"),
+                          (PACKAGE, "manifests"), (JAR, "jars")):
+            top_dir = os.path.join(self.root, top)
+            if not os.path.isdir(top_dir):
+                continue
+            for shard in os.listdir(top_dir):
+                shard_dir = os.path.join(top_dir, shard)
+                for key in os.listdir(shard_dir):
+                    add(kind, key, os.path.join(shard_dir, key))
+
+        aliases = []
+        alias_dir = os.path.join(self.root, "aliases")
+        if os.path.isdir(alias_dir):
+            for tarball in os.listdir(alias_dir):
+                with open(os.path.join(alias_dir, tarball),
+                          mode="r") as alias:
+                    digest = alias.read().strip()
+                if digest:
+                    aliases.append((tarball, digest))
+
+        with self._index_lock:
+            connection = self._connect()
+            with connection:
+                used = dict(((kind, key), last_used) for kind, key, last_used
+                            in connection.execute(
+                                "SELECT kind, key, last_used FROM entries"))
+                connection.execute("DELETE FROM entries")
+                connection.executemany(
+                    "INSERT INTO entries (kind, key, size, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    ((kind, key, size, used.get((kind, key), last_used))
+                     for (kind, key), (size, last_used) in entries.items()))
+                connection.execute("DELETE FROM aliases")
+                connection.executemany(
+                    "INSERT INTO aliases (tarball, digest) VALUES (?, ?)",
+                    aliases)
+                connection.execute("PRAGMA user_version = {}"
+                                   .format(_INDEX_VERSION))
+            self._indexed = True
+
+    def size(self):
+        """Get the total size of the cache entries, in bytes."""
+        with self._index_lock:
+            connection = self._connect()
+            if not self._indexed:
+                self.reindex()
+            return connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _evict(self, kind, key):
+        """Remove the files of a cache entry."""
+        if kind == JAR:
+            _remove(self.jar_path(key))
+            return
+        # The archive goes first so nothing picks up a half removed
+        # package; the tree is moved aside before it's deleted for the
+        # same reason.
+        _remove(self.archive_path(key))
+        tree = self.tree_path(key)
+        if os.path.isdir(tree):
+            doomed = os.path.join(self.make_staging_dir(), "tree")
+            try:
+                os.rename(tree, doomed)
+            except FileNotFoundError:
+                pass
+            _remove(os.path.dirname(doomed))
+        _remove(self.manifest_path(key))
+        _remove(self._sharded("verified", key))
+
+    def collect(self, max_size, referenced=(), min_age=600.0, dry_run=False):
+        """Evict least recently used entries until the cache fits a size.
+
+        Packages in `referenced`, entries used in the last `min_age`
+        seconds and entries locked by an operation using them (see
+        `lock`) are never evicted, so the cache can stay over `max_size`.
+        Leftovers of interrupted operations older than `min_age` are
+        removed from the staging area too.
+
+        Takes:
+            max_size (int): The size to shrink the cache to, in bytes. 0
+                            evicts every entry that may be evicted.
+            referenced (set of str): Digests of packages that are
+                                     installed somewhere.
+            min_age (float): Seconds since its last use before an entry
+                             may be evicted.
+            dry_run (bool): Only report what would be evicted.
+
+        Returns a list of (kind, key, size) tuples of the evicted entries,
+        least recently used first.
+        """
+        with metrics.span("cache.collect", max_size=max_size,
+                          dry_run=dry_run) as span, self._index_lock:
+            connection = self._connect()
+            total = self.size()
+            cutoff = time.time() - min_age
+            victims = []
+            evicted = []
+            try:
+                rows = connection.execute(
+                    "SELECT kind, key, size FROM entries "
+                    "WHERE last_used < ? ORDER BY last_used", (cutoff,)) \
+                    if total > max_size else ()
+                for kind, key, size in rows:
+                    if total <= max_size:
+                        break
+                    if kind == PACKAGE and key in referenced:
+                        continue
+                    if not dry_run:
+                        lock = self.lock(key, shared=False)
+                        try:
+                            lock.acquire(blocking=False)
+                        except LockBusy:
+                            # Something is using it right now.
+                            continue
+                        try:
+                            self._evict(kind, key)
+                            evicted.append((kind, key))
+                            lock.remove()
+                        finally:
+                            lock.release()
+                    victims.append((kind, key, size))
+                    total -= size
+            finally:
+                with connection:
+                    connection.executemany(
+                        "DELETE FROM entries WHERE kind = ? AND key = ?",
+                        evicted)
+                    packages = [(key,) for kind, key in evicted
+                                if kind == PACKAGE]
+                    for key in packages:
+                        for (tarball,) in connection.execute(
+                                "SELECT tarball FROM aliases "
+                                "WHERE digest = ?", key).fetchall():
+                            _remove(os.path.join(self.root, "aliases",
+                                                 tarball))
+                    connection.executemany(
+                        "DELETE FROM aliases WHERE digest = ?", packages)
+                for (kind, key) in evicted:
+                    self._touched.pop((kind, key), None)
+            span.set(entries=len(victims),
+                     bytes=sum(size for _, _, size in victims))
+            if dry_run:
+                return victims
+
+            tmp_dir = os.path.join(self.root, "tmp")
+            if os.path.isdir(tmp_dir):
+                for entry in os.listdir(tmp_dir):
+                    path = os.path.join(tmp_dir, entry)
+                    try:
+                        if os.lstat(path).st_mtime < cutoff:
+                            _remove(path)
+                    except FileNotFoundError:
+                        pass
+            return victims
@@ -0,0 +1,458 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Instance Registry
+
+All instance configurations live in one SQLite database,
+`<gdhome>/instances/registry.db`, indexed by name, by game path and by
+installed package, so listing instances or finding the ones using a
+package never has to open a file per instance.
+
+Instances used to be stored as `<gdhome>/instances/<name>.json`. Those
+files are imported the first time the registry is opened and renamed to
+`<name>.json.migrated`.
+
+The registry also holds each instance's file manifest: every file
+GoldDust installed, with its size, mtime, digest and owning package (see
+golddust.manifest).
+"""
+
+
+import json
+import os
+import sqlite3
+import threading
+
+from golddust import metrics
+
+REGISTRY_FILE_NAME = "registry.db"
+
+_SCHEMA_VERSION = 3
+
+_BUSY_TIMEOUT = 60.0
+"""Seconds to wait for another connection's write transaction."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    longname TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS instances_path ON instances (path);
+CREATE TABLE IF NOT EXISTS instance_packages (
+    instance TEXT NOT NULL REFERENCES instances (name) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,
+    digest TEXT,
+    PRIMARY KEY (instance, package)
+);
+CREATE INDEX IF NOT EXISTS instance_packages_package
+    ON instance_packages (package, version);
+CREATE INDEX IF NOT EXISTS instance_packages_digest
+    ON instance_packages (digest);
+CREATE TABLE IF NOT EXISTS instance_files (
+    instance TEXT NOT NULL REFERENCES instances (name) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    package TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (instance, path)
+);
+CREATE INDEX IF NOT EXISTS instance_files_package
+    ON instance_files (instance, package);
+"""
+
+_COLUMNS = ("name", "path", "longname")
+
+
+class InstanceConfig:
+    """A game instance configuration.
+
+    The packages installed in an instance are only read from the registry
+    the first time `packages` is used.
+
+    Takes:
+        registry (InstanceRegistry): The registry the instance belongs to.
+        name (str): The instance name.
+    """
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._packages = None
+        self.name = name
+        """The short name of this instance."""
+        self.path = ""
+        """The path to this instance's game files on disk."""
+        self.longname = ""
+        """The long-form user-friendly name for this instance."""
+        self.jar = None
+        """The instance's munged game JAR (see GoldDust.compose_jar), if it
+        has one: a dict of its "path" relative to the instance and its
+        "key" in the package cache."""
+
+    @property
+    def packages(self):
+        """Installed packages by name. Each is a dict with the installed
+        "version" and the archive "digest"."""
+        if self._packages is None:
+            self._packages = self._registry.packages(self.name)
+        return self._packages
+
+    def load(self):
+        """Reload this config from the registry.
+
+        Raises:
+            KeyError: The instance isn't in the registry.
+        """
+        self._registry.load(self)
+
+    def save(self):
+        """Save this config (and its packages, if they were loaded) to the
+        registry."""
+        self._registry.save(self)
+
+
+class InstanceRegistry:
+    """The database of all instances of a GoldDust home.
+
+    Takes:
+        instances_dir (str): The `<gdhome>/instances` directory.
+    """
+    def __init__(self, instances_dir):
+        self.instances_dir = instances_dir
+        self.path = os.path.join(instances_dir, REGISTRY_FILE_NAME)
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(self.instances_dir, exist_ok=True)
+            # Other processes' write transactions are waited for, rather
+            # than failing with "database is locked".
+            connection = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA foreign_keys = ON")
+            connection.execute("PRAGMA journal_mode = WAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < _SCHEMA_VERSION:
+                with connection:
+                    connection.executescript(_SCHEMA)
+                    if version < 1:
+                        self._migrate(connection)
+                    connection.execute("PRAGMA user_version = {}"
+                                       .format(_SCHEMA_VERSION))
+            self._connection = connection
+        return self._connection
+
+    def _migrate(self, connection):
+        """Import the old per-instance JSON files."""
+        migrated = []
+        for entry in sorted(os.listdir(self.instances_dir)):
+            if not entry.endswith(".json"):
+                continue
+            file_path = os.path.join(self.instances_dir, entry)
+            with open(file_path, mode="r") as config_file:
+                data = json.load(config_file)
+            data.pop("_file_path", None)
+            config = InstanceConfig(self, entry[:-len(".json")])
+            config.__dict__.update(data)
+            self._write(connection, config)
+            migrated.append(file_path)
+        for file_path in migrated:
+            os.replace(file_path, file_path + ".migrated")
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _config(self, row):
+        name, path, longname, data = row
+        config = InstanceConfig(self, name)
+        config.__dict__.update(json.loads(data))
+        config.path = path
+        config.longname = longname
+        return config
+
+    def _query(self, where="", parameters=()):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT name, path, longname, data FROM instances {} "
+                "ORDER BY name".format(where), parameters).fetchall()
+        return [self._config(row) for row in rows]
+
+    @staticmethod
+    def _write(connection, config):
+        data = {key: value for key, value in config.__dict__.items()
+                if not key.startswith("_") and key not in _COLUMNS}
+        connection.execute(
+            "INSERT INTO instances (name, path, longname, data) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET "
+            "path = excluded.path, longname = excluded.longname, "
+            "data = excluded.data",
+            (config.name, config.path, config.longname or "",
+             json.dumps(data, sort_keys=True)))
+        if config._packages is not None:
+            connection.execute("DELETE FROM instance_packages "
+                               "WHERE instance = ?", (config.name,))
+            connection.executemany(
+                "INSERT INTO instance_packages "
+                "(instance, package, version, digest) VALUES (?, ?, ?, ?)",
+                [(config.name, package, info["version"], info.get("digest"))
+                 for package, info in config._packages.items()])
+
+    def new(self, name):
+        """Get a fresh, unsaved InstanceConfig for a new instance.
+
+        Raises:
+            FileExistsError: The name is already in use.
+        """
+        if name in self:
+            raise FileExistsError("Instance name is already in use.")
+        config = InstanceConfig(self, name)
+        config._packages = {}
+        return config
+
+    def save(self, config):
+        """Add or update an instance."""
+        with metrics.span("config.save", instance=config.name), self._lock:
+            connection = self._connect()
+            with connection:
+                self._write(connection, config)
+
+    def load(self, config):
+        """Refresh an InstanceConfig from the registry.
+
+        Raises:
+            KeyError: The instance isn't in the registry.
+        """
+        stored = self.get(config.name)
+        config.__dict__.update(stored.__dict__)
+
+    def get(self, name):
+        """Get an instance's configuration.
+
+        Raises:
+            KeyError: The instance isn't in the registry.
+
+        Returns an InstanceConfig.
+        """
+        with metrics.span("config.load", kind="instance", instance=name):
+            configs = self._query("WHERE name = ?", (name,))
+        if not configs:
+            raise KeyError("No instance named {}.".format(name))
+        return configs[0]
+
+    def remove(self, name):
+        """Remove an instance and its package records.
+
+        Raises:
+            KeyError: The instance isn't in the registry.
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                cursor = connection.execute(
+                    "DELETE FROM instances WHERE name = ?", (name,))
+        if not cursor.rowcount:
+            raise KeyError("No instance named {}.".format(name))
+
+    def names(self):
+        """Get the sorted names of all instances."""
+        with self._lock:
+            return [row[0] for row in self._connect().execute(
+                "SELECT name FROM instances ORDER BY name")]
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT 1 FROM instances WHERE name = ?",
+                (name,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter(self._query())
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM instances").fetchone()[0]
+
+    def find_by_path(self, path):
+        """Get the instance whose game files are at a path, or None."""
+        configs = self._query("WHERE path = ?", (os.path.abspath(path),))
+        return configs[0] if configs else None
+
+    def find_by_package(self, package, version=None):
+        """Get the instances a package is installed in.
+
+        Takes:
+            package (str): The package name.
+            version (str): Only match this installed version, if given.
+
+        Returns a list of InstanceConfig.
+        """
+        where = ("WHERE name IN (SELECT instance FROM instance_packages "
+                 "WHERE package = ?{})".format(
+                     " AND version = ?" if version is not None else ""))
+        parameters = (package,) if version is None else (package, version)
+        return self._query(where, parameters)
+
+    def references(self):
+        """Count the instances each cached package is installed in.
+
+        Returns a dict of instance counts by archive digest (see
+        golddust.pkgcache).
+        """
+        with self._lock:
+            return dict(self._connect().execute(
+                "SELECT digest, COUNT(*) FROM instance_packages "
+                "WHERE digest IS NOT NULL GROUP BY digest"))
+
+    def packages(self, name):
+        """Get the packages installed in an instance.
+
+        Returns a dict of {"version", "digest"} dicts by package name.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT package, version, digest FROM instance_packages "
+                "WHERE instance = ?", (name,)).fetchall()
+        return {package: {"version": version, "digest": digest}
+                for package, version, digest in rows}
+
+    def files(self, name):
+        """Get an instance's file manifest.
+
+        Returns a dict of {"package", "size", "mtime_ns", "digest"} dicts
+        by path relative to the instance, using "/" separators.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT path, package, size, mtime_ns, digest "
+                "FROM instance_files WHERE instance = ?", (name,)).fetchall()
+        return {path: {"package": package, "size": size,
+                       "mtime_ns": mtime_ns, "digest": digest}
+                for path, package, size, mtime_ns, digest in rows}
+
+    @staticmethod
+    def _record(connection, name, package, version, digest, files):
+        connection.execute(
+            "INSERT OR REPLACE INTO instance_packages "
+            "(instance, package, version, digest) VALUES (?, ?, ?, ?)",
+            (name, package, version, digest))
+        connection.execute(
+            "DELETE FROM instance_files WHERE instance = ? AND package = ?",
+            (name, package))
+        connection.executemany(
+            "INSERT OR REPLACE INTO instance_files "
+            "(instance, path, package, size, mtime_ns, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(name, path, package, entry["size"], entry["mtime_ns"],
+              entry["digest"]) for path, entry in files.items()])
+
+    @staticmethod
+    def _forget(connection, name, package):
+        connection.execute(
+            "DELETE FROM instance_packages WHERE instance = ? AND package = ?",
+            (name, package))
+        connection.execute(
+            "DELETE FROM instance_files WHERE instance = ? AND package = ?",
+            (name, package))
+
+    def record_package(self, name, package, version, digest, files):
+        """Record that a package version was installed into an instance.
+
+        The package's installed version and its part of the file manifest
+        are replaced in one transaction.
+
+        Takes:
+            name (str): The instance name.
+            package (str): The package name.
+            version (str): The installed version.
+            digest (str): The digest of the installed archive.
+            files (dict): The package's manifest entries by path.
+        """
+        self.record_batch([(name, package, version, digest, files)], [])
+
+    def restamp(self, name, stamps):
+        """Update the recorded size and mtime of installed files whose
+        contents were checked to be intact (see golddust.manifest).
+
+        Takes:
+            name (str): The instance name.
+            stamps (dict): {"size", "mtime_ns"} dicts by path.
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "UPDATE instance_files SET size = ?, mtime_ns = ? "
+                    "WHERE instance = ? AND path = ?",
+                    [(stamp["size"], stamp["mtime_ns"], name, path)
+                     for path, stamp in stamps.items()])
+
+    def forget_package(self, name, package):
+        """Drop a package and its files from an instance's records."""
+        self.record_batch([], [(name, package)])
+
+    def record_batch(self, installs, removals):
+        """Record package changes across instances in one transaction.
+
+        Takes:
+            installs (list): (instance, package, version, digest, files)
+                             tuples, as for `record_package`.
+            removals (list): (instance, package) tuples to forget. These
+                             are applied before `installs`.
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                for name, package in removals:
+                    self._forget(connection, name, package)
+                for install in installs:
+                    self._record(connection, *install)
+
+    def records(self, name):
+        """Get everything the registry knows about an instance's contents.
+
+        Returns a dict with the "packages" (see `packages`) and "files"
+        (see `files`) of the instance.
+        """
+        return {"packages": self.packages(name), "files": self.files(name)}
+
+    def restore_records(self, name, records):
+        """Replace an instance's package and file records.
+
+        Takes:
+            name (str): The instance name.
+            records (dict): Records as returned by `records`.
+        """
+        files_by_package = {}
+        for path, entry in records["files"].items():
+            files_by_package.setdefault(entry["package"], {})[path] = entry
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM instance_packages "
+                                   "WHERE instance = ?", (name,))
+                connection.execute("DELETE FROM instance_files "
+                                   "WHERE instance = ?", (name,))
+                for package, info in records["packages"].items():
+                    self._record(connection, name, package, info["version"],
+                                 info.get("digest"),
+                                 files_by_package.get(package, {}))
@@ -0,0 +1,320 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Repository Index
+
+A repository publishes the metadata of all its packages as one compact,
+versioned index, so clients never fetch per-package metadata. Every time
+`gdrepo update` changes the index it gets a new generation number, and
+small deltas from recent generations to the new one are published next to
+it. Clients keep a local copy and normally only fetch a delta.
+
+Repository layout:
+    <repo>/index/
+      head.json                 {"format", "generation", "digest",
+                                 "deltas": [generations with a delta]}
+      head.json.sig             Signature of head.json, if signed.
+      index-<gen>.json.gz       The full index of a generation.
+      delta-<from>-<to>.json.gz Changes between two generations.
+
+Indexes map package names to versions to the package metadata (see
+`Package.to_dict`), without the redundant name and version. The digest is
+taken over the canonical JSON of that mapping, so a client can check that
+applying a delta reproduced exactly the published index.
+"""
+
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+from golddust.packages import Package
+
+
+INDEX_DIR_NAME = "index"
+HEAD_FILE_NAME = "head.json"
+
+FORMAT_VERSION = 1
+
+
+def index_file_name(generation):
+    """The file name of a full index generation."""
+    return "index-{}.json.gz".format(generation)
+
+
+def delta_file_name(from_generation, to_generation):
+    """The file name of a delta between two generations."""
+    return "delta-{}-{}.json.gz".format(from_generation, to_generation)
+
+
+def _canonical(data):
+    return json.dumps(data, sort_keys=True,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def encode(data):
+    """Encode an index, delta or head document as compact gzipped JSON."""
+    return gzip.compress(_canonical(data), mtime=0)
+
+
+def decode(raw):
+    """Decode a document written by `encode`."""
+    return json.loads(gzip.decompress(raw).decode("utf-8"))
+
+
+def _strip(metadata):
+    return {key: value for key, value in metadata.items()
+            if key not in ("name", "version")}
+
+
+class RepositoryIndex:
+    """The metadata of every package in a repository."""
+    def __init__(self):
+        self.generation = 0
+        """The generation number; 0 for an empty, never-published index."""
+        self.packages = {}
+        """Package metadata dicts by name, then by version."""
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create an index from its document form."""
+        if data.get("format") != FORMAT_VERSION:
+            raise ValueError("Unsupported index format.")
+        index = cls()
+        index.generation = data["generation"]
+        index.packages = data["packages"]
+        return index
+
+    def to_dict(self):
+        """Get the document form of this index."""
+        return {"format": FORMAT_VERSION, "generation": self.generation,
+                "packages": self.packages}
+
+    @classmethod
+    def load(cls, path):
+        """Read an index file.
+
+        Returns the RepositoryIndex, or an empty one if the file doesn't
+        exist.
+        """
+        try:
+            with open(path, mode="rb") as index_file:
+                return cls.from_dict(decode(index_file.read()))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path):
+        """Write this index to a file, atomically replacing it."""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, mode="wb") as index_file:
+            index_file.write(encode(self.to_dict()))
+        os.replace(tmp_path, path)
+
+    def digest(self):
+        """Get the hex digest of the canonical package mapping."""
+        return hashlib.sha256(_canonical(self.packages)).hexdigest()
+
+    def add(self, package):
+        """Add or replace a package's metadata.
+
+        Takes:
+            package (golddust.packages.Package): The package to add.
+        """
+        self.packages.setdefault(package.name, {})[package.version] = \
+            _strip(package.to_dict())
+
+    def get(self, name, version):
+        """Get a package from the index.
+
+        Raises:
+            KeyError: The index has no such package.
+
+        Returns a golddust.packages.Package.
+        """
+        metadata = dict(self.packages[name][version])
+        metadata.update(name=name, version=version)
+        return Package.from_dict(metadata)
+
+    def versions(self, name):
+        """Get the versions of a package name in the index.
+
+        Returns a list of version strings, empty if the name is unknown.
+        """
+        return list(self.packages.get(name, {}))
+
+    def __iter__(self):
+        for name in sorted(self.packages):
+            for version in sorted(self.packages[name]):
+                yield self.get(name, version)
+
+    def __len__(self):
+        return sum(len(versions) for versions in self.packages.values())
+
+    def delta_to(self, newer):
+        """Compute the delta that turns this index into a newer one.
+
+        Takes:
+            newer (RepositoryIndex): The target index.
+
+        Returns the delta document as a dict.
+        """
+        changed = {}
+        removed = {}
+        for name, versions in newer.packages.items():
+            old_versions = self.packages.get(name, {})
+            for version, metadata in versions.items():
+                if old_versions.get(version) != metadata:
+                    changed.setdefault(name, {})[version] = metadata
+        for name, versions in self.packages.items():
+            new_versions = newer.packages.get(name, {})
+            gone = [version for version in versions
+                    if version not in new_versions]
+            if gone:
+                removed[name] = sorted(gone)
+        return {"format": FORMAT_VERSION, "from": self.generation,
+                "to": newer.generation, "digest": newer.digest(),
+                "changed": changed, "removed": removed}
+
+    def apply_delta(self, delta):
+        """Apply a delta document to this index.
+
+        Raises:
+            ValueError: The delta doesn't start at this generation, or the
+                        result doesn't match the delta's digest. The index
+                        is left unchanged in that case.
+        """
+        if delta.get("format") != FORMAT_VERSION \
+                or delta["from"] != self.generation:
+            raise ValueError("Delta doesn't apply to this index generation.")
+
+        packages = {name: dict(versions)
+                    for name, versions in self.packages.items()}
+        for name, versions in delta["removed"].items():
+            for version in versions:
+                packages.get(name, {}).pop(version, None)
+            if not packages.get(name):
+                packages.pop(name, None)
+        for name, versions in delta["changed"].items():
+            packages.setdefault(name, {}).update(versions)
+
+        if hashlib.sha256(_canonical(packages)).hexdigest() \
+                != delta["digest"]:
+            raise ValueError("Index digest mismatch after applying delta.")
+        self.packages = packages
+        self.generation = delta["to"]
+
+
+def scan_packages(repo_dir):
+    """Collect the package metadata files in a repository directory.
+
+    Takes:
+        repo_dir (str): The repository root, containing gdmake output.
+
+    Returns a new RepositoryIndex (generation 0) of the packages found.
+    """
+    index = RepositoryIndex()
+    for entry in sorted(os.listdir(repo_dir)):
+        if not entry.endswith(".json") or entry.startswith("."):
+            continue
+        with open(os.path.join(repo_dir, entry), mode="r") as metadata_file:
+            try:
+                metadata = json.load(metadata_file)
+            except ValueError:
+                continue
+        if not isinstance(metadata, dict) or "name" not in metadata \
+                or "version" not in metadata or "archives" not in metadata:
+            continue
+        index.add(Package.from_dict(metadata))
+    return index
+
+
+def _write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, mode="wb") as output:
+        output.write(data)
+    os.replace(tmp_path, path)
+
+
+def publish(repo_dir, secret_key=None, keep=10):
+    """Update a repository's index from its package metadata files.
+
+    If the packages changed since the current generation, a new generation
+    is written along with deltas to it from the last `keep` generations.
+    Older generations and their deltas are removed.
+
+    Takes:
+        repo_dir (str): The repository root, containing gdmake output.
+        secret_key (golddust.signify.SecretKey): Key to sign head.json with,
+                                                 or None to leave it
+                                                 unsigned.
+        keep (int): How many earlier generations clients can get a delta
+                    from.
+
+    Returns the current RepositoryIndex.
+    """
+    index_dir = os.path.join(repo_dir, INDEX_DIR_NAME)
+    os.makedirs(index_dir, exist_ok=True)
+
+    head = {}
+    head_path = os.path.join(index_dir, HEAD_FILE_NAME)
+    try:
+        with open(head_path, mode="r") as head_file:
+            head = json.load(head_file)
+    except FileNotFoundError:
+        pass
+    current = RepositoryIndex()
+    if head:
+        current = RepositoryIndex.load(
+            os.path.join(index_dir, index_file_name(head["generation"])))
+
+    latest = scan_packages(repo_dir)
+    if head and latest.digest() == current.digest():
+        return current
+    latest.generation = current.generation + 1
+
+    _write(os.path.join(index_dir, index_file_name(latest.generation)),
+           encode(latest.to_dict()))
+    oldest = max(1, latest.generation - keep)
+    deltas = []
+    for generation in range(oldest, latest.generation):
+        older = RepositoryIndex.load(
+            os.path.join(index_dir, index_file_name(generation)))
+        if older.generation != generation:
+            continue
+        _write(os.path.join(index_dir,
+                            delta_file_name(generation, latest.generation)),
+               encode(older.delta_to(latest)))
+        deltas.append(generation)
+
+    head = {"format": FORMAT_VERSION, "generation": latest.generation,
+            "digest": latest.digest(), "deltas": deltas}
+    head_data = _canonical(head)
+    if secret_key is not None:
+        signature = secret_key.sign(lambda: (head_data,))
+        _write(os.path.join(index_dir, HEAD_FILE_NAME + ".sig"),
+               signature.to_string().encode("ascii"))
+    _write(head_path, head_data)
+
+    # Keep deltas that go to one of the kept generations, so clients that
+    # read an older head.json mid-update still find their delta.
+    for entry in os.listdir(index_dir):
+        parts = entry.split(".")[0].split("-")
+        if parts[0] in ("index", "delta") and int(parts[1]) < oldest:
+            os.remove(os.path.join(index_dir, entry))
+    return latest
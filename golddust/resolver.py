@@ -0,0 +1,387 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Dependency Resolver
+
+Computes which version of each package to install for a set of
+requirements, honouring every package's dependencies and conflicts.
+
+Each package name's versions are sorted newest first once, and every
+constraint string is turned into a bitmask over that list (memoized per
+name and constraint), so narrowing a name's candidates is a single AND.
+
+Names are decided in topological order of the dependency graph, so a
+package's version is normally only picked once everything that could
+constrain it has been decided; names with at most one candidate left go
+first. Candidates are tried newest first, and a dead end learns the set of
+decisions that caused it. Learned conflicts prune every later branch
+containing the same decisions, and the search jumps straight back to the
+most recent decision involved instead of retrying unrelated ones.
+"""
+
+
+import heapq
+
+from golddust import metrics
+from golddust.versions import parse_spec, parse_version
+
+
+class ResolutionError(Exception):
+    """No set of package versions satisfies the requirements."""
+    pass
+
+
+class _Frame:
+    """A name being decided on the search stack."""
+    __slots__ = ("name", "candidates", "next", "decision", "mark", "causes")
+
+    def __init__(self, name, candidates, causes):
+        self.name = name
+        self.candidates = candidates
+        self.next = 0
+        self.decision = None
+        self.mark = 0
+        self.causes = causes
+
+
+class Resolver:
+    """Resolves requirements against the packages of an index.
+
+    Takes:
+        index: Where candidates come from, normally a
+               golddust.repoindex.RepositoryIndex. Anything with
+               `versions(name)` and `get(name, version)` works. Packages
+               with no archive this host can read are skipped.
+    """
+    def __init__(self, index):
+        self.index = index
+        self._versions = {}
+        self._masks = {}
+        self._packages = {}
+        self._dependency_names = {}
+
+    def _sorted_versions(self, name):
+        """Get a name's version strings, newest first (memoized).
+
+        Versions with no archive this host can read are left out.
+        """
+        versions = self._versions.get(name)
+        if versions is None:
+            versions = sorted(
+                (version for version in self.index.versions(name)
+                 if self._package(name, version).installable()),
+                key=parse_version, reverse=True)
+            self._versions[name] = versions
+        return versions
+
+    def _mask(self, name, spec, negate=False):
+        """Get the bitmask of a name's versions matching a constraint.
+
+        Bit i stands for the i-th newest version (memoized).
+        """
+        key = (name, spec, negate)
+        mask = self._masks.get(key)
+        if mask is None:
+            matcher = parse_spec(spec)
+            mask = 0
+            for bit, version in enumerate(self._sorted_versions(name)):
+                if matcher.matches(parse_version(version)) != negate:
+                    mask |= 1 << bit
+            self._masks[key] = mask
+        return mask
+
+    def _package(self, name, version):
+        key = (name, version)
+        package = self._packages.get(key)
+        if package is None:
+            package = self.index.get(name, version)
+            self._packages[key] = package
+        return package
+
+    def _dependencies_of(self, name):
+        """Get every name any version of a package depends on (memoized)."""
+        names = self._dependency_names.get(name)
+        if names is None:
+            names = set()
+            for version in self._sorted_versions(name):
+                names.update(self._package(name, version).dependencies)
+            names = sorted(names)
+            self._dependency_names[name] = names
+        return names
+
+    def _topological_rank(self, roots):
+        """Rank the names reachable from `roots` so that lower ranks come
+        before all of their possible dependencies."""
+        order = []
+        seen = set()
+        for root in roots:
+            if root in seen:
+                continue
+            seen.add(root)
+            stack = [(root, iter(self._dependencies_of(root)))]
+            while stack:
+                name, deps = stack[-1]
+                for dep in deps:
+                    if dep not in seen:
+                        seen.add(dep)
+                        stack.append((dep, iter(self._dependencies_of(dep))))
+                        break
+                else:
+                    stack.pop()
+                    order.append(name)
+        return {name: -position for position, name in enumerate(order)}
+
+    def resolve(self, requirements):
+        """Compute an install plan.
+
+        Takes:
+            requirements (dict): Version constraint strings by package name.
+
+        Raises:
+            ResolutionError: The requirements can't be satisfied.
+
+        Returns a list of golddust.packages.Package, dependencies before
+        the packages that need them.
+        """
+        with metrics.span("resolve", requirements=len(requirements)) as span:
+            plan = _Search(self, requirements).run()
+            span.set(packages=len(plan))
+        return plan
+
+
+class _Search:
+    """The state of one resolution."""
+    def __init__(self, resolver, requirements):
+        self.resolver = resolver
+        self.requirements = requirements
+        self.allowed = {}
+        """Current candidate bitmask by name."""
+        self.counts = {}
+        """Number of bits set in `allowed`, by name."""
+        self.sources = {}
+        """Decisions that constrained each name (None for the root)."""
+        self.required = {}
+        """How many requirers each name currently has."""
+        self.decided = {}
+        """Chosen version by name."""
+        self.trail = []
+        """Undo records, newest last."""
+        self.nogoods = {}
+        """Learned conflicting decision sets, by member decision."""
+        self.rank = resolver._topological_rank(sorted(requirements))
+        """Decision order of names; see Resolver._topological_rank."""
+        self.queue = []
+        """Heap of (priority, name); entries are checked when popped."""
+
+    def _priority(self, name):
+        return (self.counts[name] > 1, self.rank.get(name, 0))
+
+    def _enqueue(self, name):
+        if self.required.get(name) and name not in self.decided:
+            heapq.heappush(self.queue, (self._priority(name), name))
+
+    def _constrain(self, name, mask, source, requires):
+        """Narrow a name's candidates, recording how to undo it."""
+        previous = self.allowed.get(name)
+        if previous is None:
+            previous = (1 << len(self.resolver._sorted_versions(name))) - 1
+        narrowed = previous & mask
+        self.trail.append((name, self.allowed.get(name), source, requires))
+        self.allowed[name] = narrowed
+        self.counts[name] = bin(narrowed).count("1")
+        self.sources.setdefault(name, []).append(source)
+        if requires:
+            self.required[name] = self.required.get(name, 0) + 1
+        self._enqueue(name)
+
+    def _unwind(self, mark):
+        """Undo constraints back to a trail length."""
+        while len(self.trail) > mark:
+            name, previous, _, requires = self.trail.pop()
+            if previous is None:
+                del self.allowed[name]
+                del self.counts[name]
+            else:
+                self.allowed[name] = previous
+                self.counts[name] = bin(previous).count("1")
+            self.sources[name].pop()
+            if requires:
+                self.required[name] -= 1
+            if name in self.counts:
+                self._enqueue(name)
+
+    def _select(self):
+        """Pick the next undecided required name to decide."""
+        queue = self.queue
+        while queue:
+            priority, name = queue[0]
+            if self.required.get(name) and name not in self.decided \
+                    and priority == self._priority(name):
+                return name
+            heapq.heappop(queue)
+        return None
+
+    def _causes(self, name):
+        return {source for source in self.sources.get(name, ())
+                if source is not None}
+
+    def _learn(self, nogood):
+        nogood = frozenset(nogood)
+        for decision in nogood:
+            self.nogoods.setdefault(decision, []).append(nogood)
+
+    def _violated_nogood(self, decision):
+        for nogood in self.nogoods.get(decision, ()):
+            if all(member == decision
+                   or self.decided.get(member[0]) == member[1]
+                   for member in nogood):
+                return nogood
+        return None
+
+    def _decide(self, decision):
+        """Apply a decision's dependencies and conflicts.
+
+        Returns None, or the set of decisions clashing with it.
+        """
+        name, version = decision
+        resolver = self.resolver
+        package = resolver._package(name, version)
+        self.decided[name] = version
+
+        for dep_name, spec in package.dependencies.items():
+            mask = resolver._mask(dep_name, spec)
+            self._constrain(dep_name, mask, decision, True)
+            chosen = self.decided.get(dep_name)
+            if chosen is not None and not self._has(dep_name, chosen, mask):
+                return {decision, (dep_name, chosen)}
+            if chosen is None and not self.allowed[dep_name]:
+                return {decision} | self._causes(dep_name)
+
+        for other, spec in package.conflicts.items():
+            mask = resolver._mask(other, spec, negate=True)
+            self._constrain(other, mask, decision, False)
+            chosen = self.decided.get(other)
+            if chosen is not None and not self._has(other, chosen, mask):
+                return {decision, (other, chosen)}
+        return None
+
+    def _has(self, name, version, mask):
+        return bool(mask >> self.resolver._sorted_versions(name)
+                    .index(version) & 1)
+
+    def _candidates(self, name):
+        versions = self.resolver._sorted_versions(name)
+        mask = self.allowed[name]
+        return [version for bit, version in enumerate(versions)
+                if mask >> bit & 1]
+
+    def run(self):
+        resolver = self.resolver
+        for name, spec in self.requirements.items():
+            self._constrain(name, resolver._mask(name, spec), None, True)
+
+        stack = []
+        conflict = None
+        while True:
+            if conflict is None:
+                name = self._select()
+                if name is None:
+                    return self._plan()
+                stack.append(_Frame(name, self._candidates(name),
+                                    self._causes(name)))
+            else:
+                # Jump back to the newest decision involved in the conflict.
+                while stack:
+                    frame = stack[-1]
+                    decision = frame.decision
+                    self._undo(frame)
+                    if decision in conflict:
+                        self._learn(conflict)
+                        frame.causes |= conflict - {decision}
+                        break
+                    stack.pop()
+                else:
+                    raise ResolutionError(self._describe(conflict))
+                conflict = None
+
+            frame = stack[-1]
+            frame.decision = None
+            while frame.next < len(frame.candidates):
+                decision = (frame.name, frame.candidates[frame.next])
+                frame.next += 1
+                nogood = self._violated_nogood(decision)
+                if nogood is not None:
+                    frame.causes |= nogood - {decision}
+                    continue
+                mark = len(self.trail)
+                clash = self._decide(decision)
+                if clash is None:
+                    frame.decision = decision
+                    frame.mark = mark
+                    break
+                self._unwind(mark)
+                del self.decided[frame.name]
+                self._enqueue(frame.name)
+                self._learn(clash)
+                frame.causes |= clash - {decision}
+
+            if frame.decision is None:
+                conflict = frame.causes
+                stack.pop()
+
+    def _undo(self, frame):
+        """Take back a frame's current decision."""
+        if frame.decision is not None:
+            self._unwind(frame.mark)
+            del self.decided[frame.name]
+            frame.decision = None
+            self._enqueue(frame.name)
+
+    def _describe(self, conflict):
+        if not self.requirements:
+            return "Nothing to resolve."
+        names = sorted(name for name, count in self.required.items()
+                       if count and not self.counts.get(name))
+        if names:
+            return "No version of {} satisfies the requirements.".format(
+                ", ".join(names))
+        return "Requirements {} can't be satisfied together.".format(
+            ", ".join("{} {}".format(name, spec or "*") for name, spec
+                      in sorted(self.requirements.items())))
+
+    def _plan(self):
+        """Order the decided packages so dependencies come first."""
+        resolver = self.resolver
+        plan = []
+        visited = set()
+
+        for root in sorted(self.decided):
+            if root in visited:
+                continue
+            visited.add(root)
+            stack = [(root, iter(sorted(resolver._package(
+                root, self.decided[root]).dependencies)))]
+            while stack:
+                name, deps = stack[-1]
+                for dep in deps:
+                    if dep not in visited:
+                        visited.add(dep)
+                        stack.append((dep, iter(sorted(resolver._package(
+                            dep, self.decided[dep]).dependencies))))
+                        break
+                else:
+                    stack.pop()
+                    plan.append(resolver._package(name, self.decided[name]))
+        return plan
@@ -0,0 +1,673 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Package Search
+
+A search index is a SQLite database built from a repository index (see
+golddust.repoindex): `<gdhome>/repos/<repo>/search.db` for clients, and
+`<repo>/.gdsearch.db` for `gdrepo search`.
+
+Every package name has a row in `names`, and each of its versions a row
+in `packages`. The rest of the index maps terms to sets of names, each a
+blob of sorted, packed name ids:
+
+    trigrams        Three character substrings of the words of a name and
+                    its descriptions.
+    name_trigrams   The same, of names alone.
+    facet_names     Facet values: the game versions, loaders and
+                    dependencies of any version of a name. `facets` says
+                    which versions have them.
+
+A query intersects the sets of its words and facets, rarest first. If
+only a few names are left, each is checked for the query words and facets
+themselves, in name order until enough match; otherwise (or if the sizes
+of the sets alone say so many names are left) walking every name in order
+finds enough matches quickly. Names starting with the query come first, then
+names containing its words, then names matching by description.
+
+The index is updated a name at a time. When a repository index is
+refreshed with a delta, only the names the delta touches are read;
+otherwise every name's metadata is compared with a digest of what was
+indexed.
+"""
+
+
+import array
+import bisect
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from golddust import metrics, repoindex
+from golddust.versions import Version
+
+
+SEARCH_FILE_NAME = "search.db"
+
+REPOSITORY_SEARCH_FILE_NAME = ".gdsearch.db"
+
+FACETS = ("game_version", "loader", "dependency")
+
+_SCHEMA_VERSION = 1
+
+_BUSY_TIMEOUT = 60.0
+"""Seconds to wait for another connection's write transaction."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS names (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS names_lower ON names (lower(name));
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    name_id INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    age INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    description TEXT NOT NULL,
+    game_versions TEXT NOT NULL,
+    loader TEXT NOT NULL,
+    dependencies TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name_id, age);
+CREATE TABLE IF NOT EXISTS facets (
+    package INTEGER NOT NULL,
+    facet TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (package, facet, value)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT PRIMARY KEY,
+    names BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS name_trigrams (
+    trigram TEXT PRIMARY KEY,
+    names BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS facet_names (
+    facet TEXT NOT NULL,
+    value TEXT NOT NULL,
+    names BLOB NOT NULL,
+    PRIMARY KEY (facet, value)
+) WITHOUT ROWID;
+"""
+
+_ID_TYPE = "I"
+
+_ID_SIZE = array.array(_ID_TYPE).itemsize
+
+_NARROW = 256
+"""Stop intersecting name sets once there are this few candidates;
+checking their text is cheaper than reading more sets."""
+
+_WORD = re.compile(r"\w+")
+
+
+def trigrams(text):
+    """Get the set of trigrams of the words of a text, lowercased."""
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        grams.update(word[start:start + 3]
+                     for start in range(len(word) - 2))
+    return grams
+
+
+def _digest(versions):
+    return hashlib.sha256(json.dumps(versions, sort_keys=True)
+                          .encode("utf-8")).hexdigest()
+
+
+def _facets(game_versions, loader, dependencies):
+    facets = {("game_version", value) for value in game_versions}
+    if loader:
+        facets.add(("loader", loader.lower()))
+    facets.update(("dependency", name) for name in dependencies)
+    return facets
+
+
+def _unpack(blob):
+    ids = array.array(_ID_TYPE)
+    ids.frombytes(blob)
+    return ids
+
+
+def _intersect(candidates, sets):
+    """Keep only the candidates in any of a list of name sets."""
+    if len(candidates) * 64 < sum(map(len, sets)):
+        # Few candidates are quicker to look up in the sorted sets than
+        # the sets are to hash.
+        def present(name_id):
+            for ids in sets:
+                at = bisect.bisect_left(ids, name_id)
+                if at < len(ids) and ids[at] == name_id:
+                    return True
+            return False
+        return set(filter(present, candidates))
+    if len(sets) == 1:
+        candidates.intersection_update(sets[0])
+        return candidates
+    return candidates.intersection(set().union(*sets))
+
+
+class _NameSets:
+    """Changes to a table of name sets, collected over a whole update so
+    each set is rewritten once.
+
+    Takes:
+        table (str): The table.
+        columns (tuple of str): The columns keying its sets.
+    """
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.added = {}
+        self.removed = {}
+
+    def add(self, keys, name_id):
+        for key in keys:
+            self.added.setdefault(key, []).append(name_id)
+
+    def remove(self, keys, name_id):
+        for key in keys:
+            self.removed.setdefault(key, []).append(name_id)
+
+    def apply(self, connection):
+        key = " AND ".join("{} = ?".format(column)
+                           for column in self.columns)
+        for changed in sorted(set(self.added) | set(self.removed)):
+            row = connection.execute(
+                "SELECT names FROM {} WHERE {}".format(self.table, key),
+                changed).fetchone()
+            ids = _unpack(row[0]) if row else array.array(_ID_TYPE)
+            removed = self.removed.get(changed, ())
+            added = self.added.get(changed, ())
+            if (len(removed) + len(added)) * 64 < len(ids):
+                # A few changes to a large set are quicker to make in place.
+                for name_id in removed:
+                    at = bisect.bisect_left(ids, name_id)
+                    if at < len(ids) and ids[at] == name_id:
+                        del ids[at]
+                for name_id in added:
+                    at = bisect.bisect_left(ids, name_id)
+                    if at == len(ids) or ids[at] != name_id:
+                        ids.insert(at, name_id)
+            else:
+                ids = set(ids)
+                ids.difference_update(removed)
+                ids.update(added)
+                ids = array.array(_ID_TYPE, sorted(ids))
+            if ids:
+                connection.execute(
+                    "INSERT OR REPLACE INTO {} ({}, names) VALUES ({}, ?)"
+                    .format(self.table, ", ".join(self.columns),
+                            ", ".join("?" * len(self.columns))),
+                    changed + (ids.tobytes(),))
+            elif row:
+                connection.execute("DELETE FROM {} WHERE {}".format(
+                    self.table, key), changed)
+
+
+class SearchIndex:
+    """A search index of the packages of a repository.
+
+    Takes:
+        path (str): The database file. It is created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < _SCHEMA_VERSION:
+                with connection:
+                    connection.executescript(_SCHEMA)
+                    connection.execute("PRAGMA user_version = {}"
+                                       .format(_SCHEMA_VERSION))
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def _state(connection, key, default):
+        row = connection.execute("SELECT value FROM state WHERE key = ?",
+                                 (key,)).fetchone()
+        return row[0] if row else default
+
+    @property
+    def generation(self):
+        """The generation of the repository index this was last updated
+        from; 0 if it never was."""
+        with self._lock:
+            return self._state(self._connect(), "generation", 0)
+
+    def __len__(self):
+        with self._lock:
+            return self._state(self._connect(), "packages", 0)
+
+    @staticmethod
+    def _remove(connection, name_id, name, sets):
+        """Remove a name and its versions from the index."""
+        rows = connection.execute(
+            "SELECT id, text, game_versions, loader, dependencies "
+            "FROM packages WHERE name_id = ?", (name_id,)).fetchall()
+        grams = set()
+        facets = set()
+        for package_id, text, game_versions, loader, dependencies in rows:
+            grams |= trigrams(text)
+            facets |= _facets(json.loads(game_versions), loader,
+                              json.loads(dependencies))
+            connection.execute("DELETE FROM facets WHERE package = ?",
+                               (package_id,))
+        sets["trigrams"].remove(((gram,) for gram in grams), name_id)
+        sets["name_trigrams"].remove(
+            ((gram,) for gram in trigrams(name)), name_id)
+        sets["facet_names"].remove(facets, name_id)
+        connection.execute("DELETE FROM packages WHERE name_id = ?",
+                           (name_id,))
+        connection.execute("DELETE FROM names WHERE id = ?", (name_id,))
+
+    @staticmethod
+    def _add(connection, name, versions, digest, sets):
+        """Add a name and its versions (metadata dicts by version) to the
+        index."""
+        name_id = connection.execute(
+            "INSERT INTO names (name, digest) VALUES (?, ?)",
+            (name, digest)).lastrowid
+        grams = set()
+        facets = set()
+        newest_first = sorted(versions, key=Version, reverse=True)
+        for age, version in enumerate(newest_first):
+            metadata = versions[version]
+            description = metadata.get("description", "")
+            game_versions = list(metadata.get("game_versions", []))
+            loader = metadata.get("loader", "")
+            dependencies = sorted(metadata.get("dependencies", {}))
+            text = "{}\n{}".format(name, description).lower()
+            grams |= trigrams(text)
+            package_id = connection.execute(
+                "INSERT INTO packages (name_id, version, age, text, "
+                "description, game_versions, loader, dependencies) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name_id, version, age, text, description,
+                 json.dumps(game_versions), loader,
+                 json.dumps(dependencies))).lastrowid
+            package_facets = _facets(game_versions, loader, dependencies)
+            connection.executemany(
+                "INSERT INTO facets (package, facet, value) VALUES (?, ?, ?)",
+                [(package_id,) + facet for facet in package_facets])
+            facets |= package_facets
+        sets["trigrams"].add(((gram,) for gram in grams), name_id)
+        sets["name_trigrams"].add(((gram,) for gram in trigrams(name)),
+                                  name_id)
+        sets["facet_names"].add(facets, name_id)
+
+    def update(self, index, delta=None):
+        """Bring the search index up to date with a repository index.
+
+        Takes:
+            index (golddust.repoindex.RepositoryIndex): The repository
+                                                        index.
+            delta (dict): The delta document `index` was last updated
+                with, if any. If it starts at this search index's
+                generation, only the names it touches are read.
+
+        Returns the number of names whose entries were rewritten.
+        """
+        with self._lock, metrics.span("search.update") as span:
+            connection = self._connect()
+            with connection:
+                # Another process may be updating it too; what it wrote
+                # must be read under the write lock.
+                connection.execute("BEGIN IMMEDIATE")
+                indexed = {name: (name_id, digest) for name_id, name, digest
+                           in connection.execute(
+                               "SELECT id, name, digest FROM names")}
+                if delta is not None and self._state(
+                        connection, "generation", None) == delta["from"]:
+                    names = set(delta["changed"]) | set(delta["removed"])
+                else:
+                    names = set(indexed) | set(index.packages)
+
+                sets = {"trigrams": _NameSets("trigrams", ("trigram",)),
+                        "name_trigrams": _NameSets("name_trigrams",
+                                                   ("trigram",)),
+                        "facet_names": _NameSets("facet_names",
+                                                 ("facet", "value"))}
+                rewritten = 0
+                for name in sorted(names):
+                    versions = index.packages.get(name)
+                    digest = _digest(versions) if versions else None
+                    name_id, old_digest = indexed.get(name, (None, None))
+                    if digest == old_digest:
+                        continue
+                    if name_id is not None:
+                        self._remove(connection, name_id, name, sets)
+                    if versions:
+                        self._add(connection, name, versions, digest, sets)
+                    rewritten += 1
+                for name_sets in sets.values():
+                    name_sets.apply(connection)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO state (key, value) "
+                    "VALUES (?, ?)",
+                    [("generation", index.generation),
+                     ("names", connection.execute(
+                         "SELECT COUNT(*) FROM names").fetchone()[0]),
+                     ("packages", connection.execute(
+                         "SELECT COUNT(*) FROM packages").fetchone()[0])])
+            span.set(names=rewritten)
+        return rewritten
+
+    @staticmethod
+    def _candidates(connection, table, words, facets, rare):
+        """Find the names that may contain every word and have every
+        facet.
+
+        Takes:
+            connection (sqlite3.Connection): The database.
+            table (str): The trigram table to look the words up in.
+            words (list of str): Words of three or more characters.
+            facets (list): A (facet, values) tuple for each facet to match;
+                           any of the values will do.
+            rare (int): See `_rare`.
+
+        Returns a set of name ids, or None if `rare` or more names may
+        match.
+        """
+        grams = {word: trigrams(word) for word in words}
+        every = sorted(set().union(*grams.values()))
+        sizes = {}
+        if every:
+            sizes = dict(connection.execute(
+                "SELECT trigram, length(names) FROM {} WHERE trigram IN "
+                "({})".format(table, ", ".join("?" * len(every))), every))
+            if len(sizes) < len(every):
+                return set()
+        # Trigrams of one word mostly come together, so the rarest trigram
+        # of each word and the facets are intersected first.
+        lookups = [(sizes[gram], table, gram) for gram in every]
+        first = [min((sizes[gram], table, gram)
+                     for gram in word_grams) for word_grams in grams.values()]
+        for facet, values in facets:
+            blobs = [blob for blob, in connection.execute(
+                "SELECT names FROM facet_names WHERE facet = ? AND value IN "
+                "({})".format(", ".join("?" * len(values))),
+                [facet] + values)]
+            if not blobs:
+                return set()
+            first.append((sum(map(len, blobs)), None, blobs))
+
+        def names(lookup):
+            _, source, key = lookup
+            if source is None:
+                return [_unpack(blob) for blob in key]
+            return [_unpack(connection.execute(
+                "SELECT names FROM {} WHERE trigram = ?".format(source),
+                (key,)).fetchone()[0])]
+
+        first.sort(key=lambda lookup: lookup[0])
+        # Guessing the sets are independent, the names left can be
+        # estimated without reading them.
+        total = max(SearchIndex._state(connection, "names", 0), 1)
+        estimate = total
+        for size, _, _ in first:
+            estimate *= min(size / _ID_SIZE / total, 1)
+        if estimate >= rare:
+            return None
+        candidates = set().union(*names(first[0]))
+        for lookup in first[1:]:
+            if len(candidates) < rare:
+                break
+            candidates = _intersect(candidates, names(lookup))
+        if len(candidates) >= rare:
+            return None
+        for lookup in sorted(first[1:] + lookups, key=lambda item: item[0]):
+            # Sets holding most names hardly narrow the candidates.
+            if len(candidates) <= _NARROW or lookup[0] / _ID_SIZE > total / 2:
+                break
+            candidates = _intersect(candidates, names(lookup))
+        return candidates
+
+    @staticmethod
+    def _rare(connection, limit):
+        """Below how many possible matches checking each one is quicker
+        than walking the names in order until `limit` match."""
+        return int((limit * SearchIndex._state(connection, "names", 0))
+                   ** 0.5)
+
+    @staticmethod
+    def _select(connection, ids, where, parameters, limit, rank):
+        """Get the newest version matching `where` of each name, by name.
+
+        Takes:
+            connection (sqlite3.Connection): The database.
+            ids (set of int): Only check these names, or None to walk every
+                              name in order.
+            where (list of str): Conditions on `n` and `p`.
+            parameters (list): The parameters of `where`.
+            limit (int): The most results to return.
+            rank (int): The rank to give the results.
+
+        Returns a list of rows for `_results`.
+        """
+        def select(where, parameters, limit):
+            # SQLite has no statistics to choose a join order with.
+            return connection.execute(
+                "SELECT n.name, p.version, p.description, p.game_versions, "
+                "p.loader, MIN(p.age), {rank} FROM names n CROSS JOIN "
+                "packages p ON p.name_id = n.id {where} GROUP BY n.name "
+                "ORDER BY n.name LIMIT ?".format(
+                    rank=rank, where="WHERE " + " AND ".join(where)
+                    if where else ""),
+                parameters + [limit]).fetchall()
+
+        if ids is None:
+            return select(where, parameters, limit)
+        # Ordering the ids alone is cheap, so only as many names as it
+        # takes to find enough matches are checked, in growing chunks.
+        ordered = [name_id for name_id, in connection.execute(
+            "SELECT n.id FROM json_each(?) j CROSS JOIN names n "
+            "ON n.id = j.value ORDER BY n.name", (json.dumps(sorted(ids)),))]
+        rows = []
+        start = 0
+        chunk = limit * 2
+        while start < len(ordered) and len(rows) < limit:
+            rows += select(
+                ["n.id IN (SELECT value FROM json_each(?))"] + where,
+                [json.dumps(ordered[start:start + chunk])] + parameters,
+                limit - len(rows))
+            start += chunk
+            chunk *= 2
+        return rows
+
+    def search(self, query="", game_version=None, loader=None,
+               dependency=None, limit=50):
+        """Find packages by name or description, and by facets.
+
+        Takes:
+            query (str): Words that must all appear in a package's name or
+                         description, case insensitively. Parts of words
+                         match too, but a query without any word of three
+                         or more characters only matches the start of
+                         names. Empty to match every package.
+            game_version (str): Only packages for this game version. A
+                                version such as "1.7" also matches
+                                "1.7.10".
+            loader (str): Only packages for this mod loader.
+            dependency (str): Only packages depending on this package.
+            limit (int): The most results to return.
+
+        Returns a list of dicts with the "name", "version", "description",
+        "game_versions" and "loader" of the newest matching version of each
+        matching package name. Names starting with the query come first,
+        then other names containing every query word, then names matching
+        by description alone, each by name.
+        """
+        lowered = query.strip().lower()
+        words = _WORD.findall(lowered)
+        long_words = [word for word in words if len(word) >= 3]
+
+        with self._lock, metrics.span("search.query") as span:
+            connection = self._connect()
+            facets = []
+            if game_version:
+                facets.append(("game_version", [
+                    value for value, in connection.execute(
+                        "SELECT value FROM facet_names WHERE facet = ? "
+                        "AND (value = ? OR (value > ? AND value < ?))",
+                        ("game_version", game_version, game_version + ".",
+                         game_version + "/"))]))
+            if loader:
+                facets.append(("loader", [loader.lower()]))
+            if dependency:
+                facets.append(("dependency", [dependency]))
+            facet_where = []
+            facet_parameters = []
+            for facet, values in facets:
+                facet_where.append(
+                    "EXISTS (SELECT 1 FROM facets f WHERE f.package = p.id "
+                    "AND f.facet = ? AND f.value IN ({}))".format(
+                        ", ".join("?" * len(values))))
+                facet_parameters += [facet] + values
+
+            rare = self._rare(connection, limit)
+            rows = []
+            if not lowered:
+                ids = None
+                if facets:
+                    ids = self._candidates(connection, None, [], facets,
+                                           rare)
+                if ids != set():
+                    rows = self._select(connection, ids, facet_where,
+                                        facet_parameters, limit, 0)
+                span.set(results=len(rows))
+                return self._results(rows)
+
+            prefix = [lowered, lowered[:-1] + chr(ord(lowered[-1]) + 1)]
+            starts = "lower(n.name) >= ? AND lower(n.name) < ?"
+            ids = {name_id for name_id, in connection.execute(
+                "SELECT id FROM names WHERE lower(name) >= ? "
+                "AND lower(name) < ?", prefix)}
+            if ids:
+                rows = self._select(connection, ids, facet_where,
+                                    facet_parameters, limit, 0)
+            if long_words:
+                in_name = " AND ".join(
+                    ["instr(lower(n.name), ?) > 0"] * len(words))
+                if len(rows) < limit:
+                    ids = self._candidates(connection, "name_trigrams",
+                                           long_words, facets, rare)
+                    if ids != set():
+                        rows += self._select(
+                            connection, ids,
+                            [in_name, "NOT ({})".format(starts)]
+                            + facet_where,
+                            words + prefix + facet_parameters,
+                            limit - len(rows), 1)
+                if len(rows) < limit:
+                    ids = self._candidates(connection, "trigrams",
+                                           long_words, facets, rare)
+                    if ids != set():
+                        rows += self._select(
+                            connection, ids,
+                            ["NOT ({})".format(in_name)]
+                            + ["instr(p.text, ?) > 0"] * len(words)
+                            + facet_where,
+                            words + words + facet_parameters,
+                            limit - len(rows), 2)
+            span.set(results=len(rows))
+        return self._results(rows)
+
+    @staticmethod
+    def _results(rows):
+        return [{"name": name, "version": version,
+                 "description": description,
+                 "game_versions": json.loads(game_versions),
+                 "loader": loader}
+                for name, version, description, game_versions, loader, _, _
+                in rows]
+
+    def facet_values(self, facet):
+        """Count the package names with each value of a facet.
+
+        Takes:
+            facet (str): One of `FACETS`.
+
+        Returns a dict of name counts by facet value.
+        """
+        with self._lock:
+            return {value: size // _ID_SIZE
+                    for value, size in self._connect().execute(
+                        "SELECT value, length(names) FROM facet_names "
+                        "WHERE facet = ? ORDER BY value", (facet,))}
+
+
+def repository_search(repo_dir, create=True):
+    """Open the search index of a repository directory, bringing it up to
+    date with the repository's published index (see
+    golddust.repoindex.publish).
+
+    Takes:
+        repo_dir (str): The repository root.
+        create (bool): Build the search index if the repository doesn't
+                       have one yet.
+
+    Returns a SearchIndex, or None if there is none and `create` is false.
+    """
+    path = os.path.join(repo_dir, REPOSITORY_SEARCH_FILE_NAME)
+    if not create and not os.path.isfile(path):
+        return None
+    search = SearchIndex(path)
+    index_dir = os.path.join(repo_dir, repoindex.INDEX_DIR_NAME)
+    try:
+        with open(os.path.join(index_dir, repoindex.HEAD_FILE_NAME),
+                  mode="r") as head_file:
+            head = json.load(head_file)
+    except FileNotFoundError:
+        return search
+    generation = search.generation
+    if head["generation"] != generation:
+        index = repoindex.RepositoryIndex.load(os.path.join(
+            index_dir, repoindex.index_file_name(head["generation"])))
+        delta = None
+        if generation in head["deltas"]:
+            with open(os.path.join(index_dir, repoindex.delta_file_name(
+                    generation, head["generation"])), mode="rb") as delta_file:
+                delta = repoindex.decode(delta_file.read())
+        search.update(index, delta)
+    return search
@@ -0,0 +1,298 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Repository Server
+
+`gdrepo serve` serves a repository directory over HTTP, so it can be
+listed as a mirror in clients' configurations. Given upstream mirrors, it
+is a caching proxy instead: each file is fetched from upstream (with
+golddust.download, over all upstream mirrors) the first time any client
+asks for it and served from disk afterwards, so a LAN of many hosts pulls
+each package from upstream only once. Concurrent requests for a file that
+isn't cached yet wait for the same upstream fetch. The cache directory has
+the repository layout, so it can also be served as a repository itself.
+
+Everything in a repository except the index head is immutable once
+published. The proxy checks the head (and its signature) upstream again
+once it is older than `head_ttl` seconds, and keeps serving the cached
+one if upstream can't be reached.
+
+Files are served with an ETag (If-None-Match gets a 304), single byte
+ranges (for golddust.download's split downloads) and keep-alive, and
+bodies are sent with `sendfile`, straight from the page cache to the
+socket, where the platform supports it.
+"""
+
+
+import http.server
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from golddust.download import DownloadError, Downloader
+from golddust.repoindex import HEAD_FILE_NAME, INDEX_DIR_NAME
+
+
+_MUTABLE = {INDEX_DIR_NAME + "/" + HEAD_FILE_NAME,
+            INDEX_DIR_NAME + "/" + HEAD_FILE_NAME + ".sig"}
+"""Files that change in place when a repository is updated."""
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+_TMP_DIR_NAME = ".gdtmp"
+
+
+def parse_range(header, size):
+    """Parse a single-range Range header.
+
+    Takes:
+        header (str): The Range header value.
+        size (int): The size of the file.
+
+    Returns a tuple of (start, end) with `end` exclusive, None if the header
+    should be ignored (it's malformed or asks for several ranges), or False
+    if the range can't be satisfied.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            return False
+        return max(0, size - suffix), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or end <= start:
+        return False
+    return start, end
+
+
+def etag(stat):
+    """Get the ETag of a file from its `os.stat` result."""
+    return '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "GoldDust"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def _serve(self, body):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        local = self.server.ensure(path.lstrip("/"))
+        if local is None:
+            self.send_error(404)
+            return
+
+        with open(local, mode="rb") as served:
+            stat = os.fstat(served.fileno())
+            tag = etag(stat)
+            matches = [value.strip() for value
+                       in self.headers.get("If-None-Match", "").split(",")]
+            if tag in matches or "*" in matches:
+                self.send_response(304)
+                self.send_header("ETag", tag)
+                self.end_headers()
+                return
+
+            start, end = 0, stat.st_size
+            status = 200
+            requested = self.headers.get("Range")
+            if requested and self.headers.get("If-Range", tag) == tag:
+                byte_range = parse_range(requested, stat.st_size)
+                if byte_range is False:
+                    self.send_response(416)
+                    self.send_header("Content-Range",
+                                     "bytes */{}".format(stat.st_size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if byte_range is not None:
+                    start, end = byte_range
+                    status = 206
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", tag)
+            self.send_header("Cache-Control",
+                             "no-cache" if self.server.is_mutable(local)
+                             else "public, max-age=31536000, immutable")
+            if status == 206:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                    start, end - 1, stat.st_size))
+            self.end_headers()
+            if body and end > start:
+                self.connection.sendfile(served, start, end - start)
+                self.server.count(end - start)
+
+
+class RepositoryServer(http.server.ThreadingHTTPServer):
+    """Serves a repository directory, optionally as a caching proxy.
+
+    Takes:
+        address (tuple): The (host, port) to listen on.
+        root (str): The repository directory, or the cache directory when
+                    proxying.
+        upstream (list of str): Upstream mirror URLs to proxy. None to
+                                serve `root` as it is.
+        head_ttl (float): Seconds before a cached index head is checked
+                          upstream again.
+        verbose (bool): Log every request to stderr.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, root, upstream=None, head_ttl=60.0,
+                 verbose=False):
+        self.root = os.path.abspath(root)
+        self.downloader = Downloader(upstream) if upstream else None
+        self.head_ttl = head_ttl
+        self.verbose = verbose
+        self.upstream_fetches = 0
+        """Number of files fetched from upstream."""
+        self.bytes_served = 0
+        """Number of body bytes sent to clients."""
+        self._lock = threading.Lock()
+        self._fetching = {}
+        self._checked = {}
+        super().__init__(address, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        if self.downloader is not None:
+            self.downloader.close()
+
+    def count(self, size):
+        """Add to `bytes_served`."""
+        with self._lock:
+            self.bytes_served += size
+
+    def local_path(self, path):
+        """Get the local file for a repository path.
+
+        Returns str, or None if the path is unsafe (such as one leaving the
+        root).
+        """
+        parts = path.split("/")
+        if not path or any(part in ("", ".", "..") or part.startswith(".")
+                           or "\\" in part for part in parts):
+            return None
+        return os.path.join(self.root, *parts)
+
+    def is_mutable(self, local):
+        """Check whether a local file is one that changes in place."""
+        relative = os.path.relpath(local, self.root).replace(os.sep, "/")
+        return relative in _MUTABLE
+
+    def _fresh(self, path, local):
+        if not os.path.isfile(local):
+            return False
+        if path not in _MUTABLE:
+            return True
+        checked = self._checked.get(path)
+        return checked is not None \
+            and time.monotonic() - checked < self.head_ttl
+
+    def _fetch(self, path, local):
+        tmp_dir = os.path.join(self.root, _TMP_DIR_NAME)
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)
+        try:
+            self.downloader.fetch(path, tmp_path)
+            with self._lock:
+                self.upstream_fetches += 1
+            if os.path.isfile(local) and _same_contents(local, tmp_path):
+                # Keep the old file so its ETag stays valid.
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, local)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._checked[path] = time.monotonic()
+
+    def ensure(self, path):
+        """Get the local file for a repository path, fetching it from
+        upstream first if proxying and it isn't cached or is stale.
+
+        Returns str, or None if there is no such file.
+        """
+        local = self.local_path(path)
+        if local is None:
+            return None
+        if self.downloader is None or self._fresh(path, local):
+            return local if os.path.isfile(local) else None
+
+        # The head and its signature are refreshed together, so they match.
+        paths = sorted(_MUTABLE) if path in _MUTABLE else [path]
+        key = paths[0]
+        with self._lock:
+            done = self._fetching.get(key)
+            leader = done is None
+            if leader:
+                done = self._fetching[key] = threading.Event()
+        if leader:
+            try:
+                for name in paths:
+                    try:
+                        self._fetch(name, self.local_path(name))
+                    except (DownloadError, OSError) as err:
+                        # A stale copy is better than nothing if upstream
+                        # is down.
+                        self.log_error("Upstream fetch of %s failed: %s",
+                                       name, err)
+            finally:
+                with self._lock:
+                    del self._fetching[key]
+                done.set()
+        else:
+            done.wait()
+        return local if os.path.isfile(local) else None
+
+    def log_error(self, format, *args):
+        if self.verbose:
+            sys.stderr.write((format % args) + "\n")
+
+
+def _same_contents(path, other_path):
+    if os.path.getsize(path) != os.path.getsize(other_path):
+        return False
+    with open(path, mode="rb") as first, open(other_path, mode="rb") as other:
+        while True:
+            chunk = first.read(64 * 1024)
+            if chunk != other.read(64 * 1024):
+                return False
+            if not chunk:
+                return True
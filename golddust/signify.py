@@ -0,0 +1,260 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""OpenBSD signify Compatible Keys and Signatures
+
+Reads and writes the key and detached signature files of OpenBSD's
+`signify` utility, which GoldDust uses to sign packages. Each file is an
+"untrusted comment:" line followed by a base64 line:
+
+    public key:  "Ed" | keynum[8] | public key[32]
+    secret key:  "Ed" | "BK" | kdfrounds[4] | salt[16] | checksum[8] |
+                 keynum[8] | secret key[64]
+    signature:   "Ed" | keynum[8] | signature[64]
+
+Passphrase-protected secret keys (kdfrounds > 0) are not supported; make
+keys with `signify -G -n` or `generate_keypair`.
+"""
+
+
+import base64
+import hashlib
+import os
+import struct
+
+from golddust import ed25519
+
+
+_PKALG = b"Ed"
+_KDFALG = b"BK"
+_COMMENT_PREFIX = "untrusted comment: "
+
+# Below this many signatures per process, starting processes costs more
+# than it saves.
+_MIN_BATCH_PER_WORKER = 32
+
+
+class BadSignatureError(Exception):
+    """A signature didn't match the signed data or key."""
+    pass
+
+
+def _decode(text, expected_length):
+    lines = text.strip().splitlines()
+    if len(lines) < 2 or not lines[0].startswith(_COMMENT_PREFIX):
+        raise ValueError("Not a signify file.")
+    data = base64.b64decode(lines[1], validate=True)
+    if len(data) != expected_length or data[:2] != _PKALG:
+        raise ValueError("Unsupported signify key or signature.")
+    return data
+
+
+def _encode(comment, data):
+    return "{}{}\n{}\n".format(_COMMENT_PREFIX, comment,
+                               base64.b64encode(data).decode("ascii"))
+
+
+class PublicKey:
+    """A signify public key.
+
+    Takes:
+        keynum (bytes): The 8 byte key number.
+        key (bytes): The 32 byte Ed25519 public key.
+    """
+    def __init__(self, keynum, key):
+        self.keynum = keynum
+        self.key = key
+
+    @classmethod
+    def from_string(cls, text):
+        """Parse the contents of a signify public key file."""
+        data = _decode(text, 42)
+        return cls(data[2:10], data[10:])
+
+    @classmethod
+    def load(cls, path):
+        """Read a signify public key file."""
+        with open(path, mode="r") as key_file:
+            return cls.from_string(key_file.read())
+
+    def to_string(self, comment="golddust public key"):
+        """Format as the contents of a signify public key file."""
+        return _encode(comment, _PKALG + self.keynum + self.key)
+
+
+class SecretKey:
+    """An unencrypted signify secret key.
+
+    Takes:
+        keynum (bytes): The 8 byte key number.
+        seed (bytes): The 32 byte Ed25519 secret key.
+    """
+    def __init__(self, keynum, seed):
+        self.keynum = keynum
+        self.seed = seed
+        self.public_key = PublicKey(keynum, ed25519.public_key(seed))
+
+    @classmethod
+    def from_string(cls, text):
+        """Parse the contents of a signify secret key file.
+
+        Raises:
+            ValueError: The key is malformed or passphrase-protected.
+        """
+        data = _decode(text, 104)
+        if data[2:4] != _KDFALG:
+            raise ValueError("Unsupported signify key derivation.")
+        rounds, = struct.unpack(">I", data[4:8])
+        if rounds != 0:
+            raise ValueError("Passphrase-protected keys are not supported.")
+        checksum, keynum, secret = data[24:32], data[32:40], data[40:]
+        if hashlib.sha512(secret).digest()[:8] != checksum:
+            raise ValueError("Secret key checksum mismatch.")
+        return cls(keynum, secret[:32])
+
+    @classmethod
+    def load(cls, path):
+        """Read a signify secret key file."""
+        with open(path, mode="r") as key_file:
+            return cls.from_string(key_file.read())
+
+    def to_string(self, comment="golddust secret key"):
+        """Format as the contents of a signify secret key file."""
+        secret = self.seed + self.public_key.key
+        data = (_PKALG + _KDFALG + struct.pack(">I", 0) + bytes(16)
+                + hashlib.sha512(secret).digest()[:8] + self.keynum + secret)
+        return _encode(comment, data)
+
+    def sign(self, chunks):
+        """Sign a message.
+
+        Ed25519 signing reads the message twice, so `chunks` must be
+        callable to start a new pass.
+
+        Takes:
+            chunks (callable): Returns an iterable of the message's bytes.
+
+        Returns the Signature.
+        """
+        return Signature(self.keynum, ed25519.sign_chunks(self.seed, chunks))
+
+    def sign_file(self, path):
+        """Sign the contents of a file.
+
+        Returns the Signature.
+        """
+        def chunks():
+            with open(path, mode="rb") as source:
+                yield from iter(lambda: source.read(1024 * 1024), b"")
+        return self.sign(chunks)
+
+
+class Signature:
+    """A detached signify signature.
+
+    Takes:
+        keynum (bytes): The 8 byte number of the signing key.
+        signature (bytes): The 64 byte Ed25519 signature.
+    """
+    def __init__(self, keynum, signature):
+        self.keynum = keynum
+        self.signature = signature
+
+    @classmethod
+    def from_string(cls, text):
+        """Parse the contents of a signify signature file."""
+        data = _decode(text, 74)
+        return cls(data[2:10], data[10:])
+
+    @classmethod
+    def load(cls, path):
+        """Read a signify signature file."""
+        with open(path, mode="r") as sig_file:
+            return cls.from_string(sig_file.read())
+
+    def to_string(self, comment="verify with golddust public key"):
+        """Format as the contents of a signify signature file."""
+        return _encode(comment, _PKALG + self.keynum + self.signature)
+
+    def verifier(self, public_key):
+        """Get an incremental verifier of this signature.
+
+        Takes:
+            public_key (PublicKey): The key the data should be signed by.
+
+        Raises:
+            BadSignatureError: The signature was made with a different key.
+
+        Returns an ed25519.StreamVerifier to feed the signed data to.
+        """
+        if self.keynum != public_key.keynum:
+            raise BadSignatureError("Signature was made with another key.")
+        return ed25519.StreamVerifier(public_key.key, self.signature)
+
+
+def _verify_chunk(checks):
+    """Check (public key, signature, challenge) tuples, batched.
+
+    Returns a list of bools, one per check.
+    """
+    if not checks:
+        return []
+    if ed25519.verify_batch(checks):
+        return [True] * len(checks)
+    if len(checks) == 1:
+        return [False]
+    # Find the bad signatures by halving.
+    middle = len(checks) // 2
+    return _verify_chunk(checks[:middle]) + _verify_chunk(checks[middle:])
+
+
+def verify_batch(verifiers, workers=None):
+    """Finish many signature checks at once.
+
+    The checks are split between up to `workers` processes, and each
+    process checks its share with Ed25519 batch verification.
+
+    Takes:
+        verifiers (list of ed25519.StreamVerifier): Verifiers (see
+            `Signature.verifier`) that have been fed their whole message.
+        workers (int): Maximum number of processes. Defaults to the number
+                       of CPUs; 1 checks in this process.
+
+    Returns a list of bools, True for each valid signature.
+    """
+    checks = [(verifier.public_key, verifier.signature, verifier.challenge())
+              for verifier in verifiers]
+    workers = min(workers or os.cpu_count() or 1,
+                  len(checks) // _MIN_BATCH_PER_WORKER)
+    if workers <= 1:
+        return _verify_chunk(checks)
+
+    import concurrent.futures
+
+    step = -(-len(checks) // workers)
+    chunks = [checks[start:start + step]
+              for start in range(0, len(checks), step)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return [valid for results in pool.map(_verify_chunk, chunks)
+                for valid in results]
+
+
+def generate_keypair():
+    """Generate a new unencrypted signify key pair.
+
+    Returns a tuple of (PublicKey, SecretKey).
+    """
+    secret = SecretKey(os.urandom(8), ed25519.generate_secret_key())
+    return secret.public_key, secret
@@ -0,0 +1,177 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Instance Snapshots
+
+A snapshot is a numbered generation of an instance's directory, kept next
+to the instance (on the same filesystem) along with the registry records
+of what was installed at the time:
+
+    <parent>/.<instance dir>.gdsnapshots/
+      <generation>/         The instance directory as it was.
+      <generation>.json     {"generation", "created", "description",
+                             "records"}
+
+Snapshots are cheap: files installed from packages, which GoldDust never
+writes in place, are hardlinked; every other file (saves, options edited
+by the game) is reflinked where the filesystem supports it and copied
+otherwise, so writing to it never changes the snapshot.
+
+The hardlinks are a limitation, though. Unless the filesystem supports
+reflinks, a package file is the same file in the instance, every snapshot
+holding it and the package cache tree. If the game or the user edits one
+in place, such as a config file shipped by a package, the edit shows up
+in all of them and rolling back won't undo it. `GoldDust.verify_instance`
+with `repair` restores such files from the package archive.
+
+Rolling back swaps the instance directory and a snapshot with two
+renames. The state rolled back from becomes a new generation, so a
+rollback can itself be undone.
+"""
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from golddust.pkgcache import clone_tree
+
+
+def snapshot_root(instance_path):
+    """Get the directory holding an instance's snapshots."""
+    parent, name = os.path.split(os.path.abspath(instance_path))
+    return os.path.join(parent, ".{}.gdsnapshots".format(name))
+
+
+class SnapshotStore:
+    """The snapshot generations of one instance.
+
+    Takes:
+        instance_path (str): The instance directory.
+    """
+    def __init__(self, instance_path):
+        self.instance_path = os.path.abspath(instance_path)
+        self.root = snapshot_root(instance_path)
+
+    def _tree(self, generation):
+        return os.path.join(self.root, str(generation))
+
+    def _info_path(self, generation):
+        return os.path.join(self.root, "{}.json".format(generation))
+
+    def _write_info(self, generation, description, records):
+        info = {"generation": generation, "created": time.time(),
+                "description": description, "records": records}
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, mode="w") as info_file:
+            json.dump(info, info_file, sort_keys=True)
+        os.replace(tmp_path, self._info_path(generation))
+        return info
+
+    def load(self, generation):
+        """Get a snapshot's info dict, including its "records".
+
+        Raises:
+            KeyError: There is no such generation.
+        """
+        try:
+            with open(self._info_path(generation), mode="r") as info_file:
+                return json.load(info_file)
+        except FileNotFoundError:
+            raise KeyError("No snapshot generation {}.".format(generation))
+
+    def generations(self):
+        """Get the sorted generation numbers of all snapshots."""
+        try:
+            entries = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(int(entry[:-len(".json")]) for entry in entries
+                      if entry.endswith(".json")
+                      and entry[:-len(".json")].isdigit())
+
+    def _next_generation(self):
+        generations = self.generations()
+        return generations[-1] + 1 if generations else 1
+
+    def create(self, records, description="", link_mode="auto"):
+        """Snapshot the instance directory.
+
+        Takes:
+            records (dict): The instance's registry records (see
+                            `InstanceRegistry.records`). Files listed in
+                            them are hardlinked.
+            description (str): A note to keep with the snapshot.
+            link_mode (str): How package files are linked; see
+                             golddust.pkgcache.link_file.
+
+        Returns the info dict of the new snapshot.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        generation = self._next_generation()
+        staging = tempfile.mkdtemp(dir=self.root)
+        try:
+            clone_tree(self.instance_path, staging, link_mode,
+                       shared=set(records["files"]))
+            os.rename(staging, self._tree(generation))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return self._write_info(generation, description, records)
+
+    def swap(self, generation, records, description=""):
+        """Put a snapshot in place of the instance directory.
+
+        The current directory becomes a new snapshot generation.
+
+        Takes:
+            generation (int): The generation to restore.
+            records (dict): The instance's current registry records, kept
+                            with the new generation.
+            description (str): A note to keep with the new generation.
+
+        Raises:
+            KeyError: There is no such generation.
+
+        Returns a tuple of (the restored snapshot's info dict, the new
+        generation's info dict).
+        """
+        restored = self.load(generation)
+        new_generation = self._next_generation()
+        os.rename(self.instance_path, self._tree(new_generation))
+        try:
+            os.rename(self._tree(generation), self.instance_path)
+        except BaseException:
+            os.rename(self._tree(new_generation), self.instance_path)
+            raise
+        os.remove(self._info_path(generation))
+        return restored, self._write_info(new_generation, description,
+                                          records)
+
+    def delete(self, generation):
+        """Delete a snapshot.
+
+        Raises:
+            KeyError: There is no such generation.
+        """
+        self.load(generation)
+        os.remove(self._info_path(generation))
+        shutil.rmtree(self._tree(generation), ignore_errors=True)
+
+    def delete_all(self):
+        """Delete every snapshot of the instance."""
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,148 @@
+# Copyright 2015-2017 John "LuaMilkshake" Marion
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GoldDust Versions and Version Constraints
+
+Mod versions come in every shape ("1.7.10", "10.13.4.1614",
+"1.0.0-beta2"), so versions are compared loosely: they are split into
+runs of digits and runs of letters, numbers compare numerically, and a
+version with extra letters is older than the same version without them
+("1.0-beta" < "1.0" < "1.0.1").
+
+Constraints are comma-separated clauses which must all hold:
+
+    ">=1.2,<2"    At least 1.2, below 2.
+    "==1.7.*"     Any 1.7 version.
+    "!=1.3"       Anything but 1.3.
+    "*" or ""     Any version.
+"""
+
+
+import functools
+import re
+
+
+_PART = re.compile(r"\d+|[a-zA-Z]+")
+_CLAUSE = re.compile(r"^(==|!=|>=|<=|>|<)?\s*(.+)$")
+
+
+@functools.total_ordering
+class Version:
+    """A comparable package version.
+
+    Takes:
+        text (str): The version string.
+    """
+    __slots__ = ("text", "key")
+
+    def __init__(self, text):
+        self.text = text
+        parts = []
+        for part in _PART.findall(text):
+            if part.isdigit():
+                parts.append((1, int(part)))
+            else:
+                parts.append((-1, part.lower()))
+        parts.append((0,))
+        self.key = tuple(parts)
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "Version({!r})".format(self.text)
+
+    def startswith(self, prefix):
+        """Check whether this version begins with all parts of `prefix`."""
+        prefix_key = prefix.key[:-1]
+        return self.key[:len(prefix_key)] == prefix_key
+
+
+parse_version = functools.lru_cache(maxsize=None)(Version)
+"""Get the (shared) Version for a version string."""
+
+
+class VersionSpec:
+    """A set of version constraints.
+
+    Takes:
+        text (str): The constraint string, such as ">=1.2,<2".
+
+    Raises:
+        ValueError: The constraint string is malformed.
+    """
+    def __init__(self, text):
+        self.text = text.strip()
+        self._clauses = []
+        for clause in self.text.split(","):
+            clause = clause.strip()
+            if clause in ("", "*"):
+                continue
+            match = _CLAUSE.match(clause)
+            if not match:
+                raise ValueError("Bad version constraint: {}".format(clause))
+            operator, version = match.group(1) or "==", match.group(2)
+            wildcard = version.endswith(".*")
+            if wildcard:
+                if operator not in ("==", "!="):
+                    raise ValueError("Wildcards need == or !=: {}"
+                                     .format(clause))
+                version = version[:-2]
+            self._clauses.append((operator, parse_version(version),
+                                  wildcard))
+
+    def __str__(self):
+        return self.text or "*"
+
+    def __repr__(self):
+        return "VersionSpec({!r})".format(self.text)
+
+    def matches(self, version):
+        """Check whether a Version satisfies every clause."""
+        for operator, bound, wildcard in self._clauses:
+            if wildcard:
+                if version.startswith(bound) != (operator == "=="):
+                    return False
+            elif operator == "==":
+                if version != bound:
+                    return False
+            elif operator == "!=":
+                if version == bound:
+                    return False
+            elif operator == ">=":
+                if version < bound:
+                    return False
+            elif operator == "<=":
+                if bound < version:
+                    return False
+            elif operator == ">":
+                if not bound < version:
+                    return False
+            elif not version < bound:
+                return False
+        return True
+
+
+parse_spec = functools.lru_cache(maxsize=None)(VersionSpec)
+"""Get the (shared) VersionSpec for a constraint string."""
@@ -37,8 +37,13 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'gdgame=golddust.clitools.gdgame:main'
+            'gdgame=golddust.clitools.gdgame:main',
+            'gdmake=golddust.clitools.gdmake:main',
+            'gdrepo=golddust.clitools.gdrepo:main',
         ],
     },
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     keywords='minecraft forge mods packages',
 )